@@ -0,0 +1,36 @@
+"""Document digests
+
+Revision ID: 0b5e9d4c7a18
+Revises: f6c3d8a2b471
+Create Date: 2026-10-17 19:26:05.871344
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b5e9d4c7a18'
+down_revision: Union[str, Sequence[str], None] = 'f6c3d8a2b471'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('document_digests',
+    sa.Column('document_id', sa.Integer(), nullable=False),
+    sa.Column('outline', sa.Text(), nullable=False),
+    sa.Column('key_terms', sa.JSON(), nullable=False),
+    sa.Column('section_summaries', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('document_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('document_digests')
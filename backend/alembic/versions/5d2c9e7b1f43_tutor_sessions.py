@@ -0,0 +1,36 @@
+"""Tutor sessions
+
+Revision ID: 5d2c9e7b1f43
+Revises: 0b5e9d4c7a18
+Create Date: 2026-10-17 21:04:12.418093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2c9e7b1f43'
+down_revision: Union[str, Sequence[str], None] = '0b5e9d4c7a18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('tutor_sessions',
+    sa.Column('document_id', sa.Integer(), nullable=False),
+    sa.Column('anchor_chunk_ids', sa.JSON(), nullable=True),
+    sa.Column('summary', sa.Text(), nullable=False, server_default=''),
+    sa.Column('summarized_through', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('document_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('tutor_sessions')
@@ -0,0 +1,33 @@
+"""Chat history index
+
+Revision ID: 8f1a6b3d2e57
+Revises: 5d2c9e7b1f43
+Create Date: 2026-10-17 22:37:48.150264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f1a6b3d2e57'
+down_revision: Union[str, Sequence[str], None] = '5d2c9e7b1f43'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        'ix_chat_messages_document_created_id',
+        'chat_messages',
+        ['document_id', 'created_at', 'id'],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_messages_document_created_id', table_name='chat_messages')
@@ -0,0 +1,48 @@
+"""Ingestion jobs
+
+Revision ID: a3e1c7d94b20
+Revises: 6ecbb7941111
+Create Date: 2026-10-17 09:12:44.318202
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3e1c7d94b20'
+down_revision: Union[str, Sequence[str], None] = '6ecbb7941111'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('ingestion_jobs',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=True),
+    sa.Column('document_id', sa.Integer(), nullable=True),
+    sa.Column('filename', sa.String(), nullable=False),
+    sa.Column('file_path', sa.String(), nullable=False),
+    sa.Column('category', sa.String(), nullable=True),
+    sa.Column('study_focus', sa.String(), nullable=True),
+    sa.Column('force_upload', sa.Boolean(), nullable=True),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('stage', sa.String(), nullable=True),
+    sa.Column('stages', sa.JSON(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_ingestion_jobs_owner_id'), 'ingestion_jobs', ['owner_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_ingestion_jobs_owner_id'), table_name='ingestion_jobs')
+    op.drop_table('ingestion_jobs')
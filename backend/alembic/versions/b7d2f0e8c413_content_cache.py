@@ -0,0 +1,43 @@
+"""Content cache
+
+Revision ID: b7d2f0e8c413
+Revises: a3e1c7d94b20
+Create Date: 2026-10-17 11:40:02.557913
+
+"""
+from typing import Sequence, Union
+
+import pgvector
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d2f0e8c413'
+down_revision: Union[str, Sequence[str], None] = 'a3e1c7d94b20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('content_cache',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('value', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_content_cache_kind'), 'content_cache', ['kind'], unique=False)
+    op.create_table('embedding_cache',
+    sa.Column('text_hash', sa.String(), nullable=False),
+    sa.Column('embedding', pgvector.sqlalchemy.vector.VECTOR(dim=768), nullable=False),
+    sa.PrimaryKeyConstraint('text_hash')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('embedding_cache')
+    op.drop_index(op.f('ix_content_cache_kind'), table_name='content_cache')
+    op.drop_table('content_cache')
@@ -0,0 +1,38 @@
+"""Chunk vector indexes
+
+Revision ID: c4f8a1e6d2b9
+Revises: b7d2f0e8c413
+Create Date: 2026-10-17 14:05:37.902416
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f8a1e6d2b9'
+down_revision: Union[str, Sequence[str], None] = 'b7d2f0e8c413'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(op.f('ix_document_chunks_document_id'), 'document_chunks', ['document_id'], unique=False)
+    op.create_index(
+        'ix_document_chunks_embedding_hnsw',
+        'document_chunks',
+        ['embedding'],
+        unique=False,
+        postgresql_using='hnsw',
+        postgresql_with={'m': 16, 'ef_construction': 64},
+        postgresql_ops={'embedding': 'vector_cosine_ops'},
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_document_chunks_embedding_hnsw', table_name='document_chunks')
+    op.drop_index(op.f('ix_document_chunks_document_id'), table_name='document_chunks')
@@ -0,0 +1,43 @@
+"""Document centroid backfill and owner index
+
+Revision ID: d91b3e5a7c06
+Revises: c4f8a1e6d2b9
+Create Date: 2026-10-17 15:22:10.481530
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd91b3e5a7c06'
+down_revision: Union[str, Sequence[str], None] = 'c4f8a1e6d2b9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Backfill centroids for documents ingested before they were written.
+    op.execute("""
+        UPDATE documents d
+        SET embedding = c.centroid
+        FROM (
+            SELECT document_id, AVG(embedding) AS centroid
+            FROM document_chunks
+            WHERE embedding IS NOT NULL
+            GROUP BY document_id
+        ) c
+        WHERE d.id = c.document_id
+            AND d.embedding IS NULL
+    """)
+    # Cross-references rank exactly within one owner's documents, found through this index;
+    # an ANN index on the centroids would only be write overhead.
+    op.create_index(op.f('ix_documents_owner_id'), 'documents', ['owner_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_documents_owner_id'), table_name='documents')
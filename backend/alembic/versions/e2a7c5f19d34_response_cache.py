@@ -0,0 +1,39 @@
+"""Response cache
+
+Revision ID: e2a7c5f19d34
+Revises: d91b3e5a7c06
+Create Date: 2026-10-17 16:48:51.206377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a7c5f19d34'
+down_revision: Union[str, Sequence[str], None] = 'd91b3e5a7c06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('response_cache',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('model', sa.String(), nullable=False),
+    sa.Column('task', sa.String(), nullable=True),
+    sa.Column('response_text', sa.Text(), nullable=False),
+    sa.Column('size_bytes', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('last_used_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_response_cache_last_used_at'), 'response_cache', ['last_used_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_response_cache_last_used_at'), table_name='response_cache')
+    op.drop_table('response_cache')
@@ -0,0 +1,46 @@
+"""LLM usage
+
+Revision ID: f6c3d8a2b471
+Revises: e2a7c5f19d34
+Create Date: 2026-10-17 18:12:37.540912
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f6c3d8a2b471'
+down_revision: Union[str, Sequence[str], None] = 'e2a7c5f19d34'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('llm_usage',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('document_id', sa.Integer(), nullable=True),
+    sa.Column('task', sa.String(), nullable=False),
+    sa.Column('model', sa.String(), nullable=False),
+    sa.Column('calls', sa.Integer(), nullable=False),
+    sa.Column('errors', sa.Integer(), nullable=False),
+    sa.Column('prompt_tokens', sa.BigInteger(), nullable=False),
+    sa.Column('output_tokens', sa.BigInteger(), nullable=False),
+    sa.Column('latency_ms', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_llm_usage_day'), 'llm_usage', ['day'], unique=False)
+    op.create_index(op.f('ix_llm_usage_user_id'), 'llm_usage', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_llm_usage_user_id'), table_name='llm_usage')
+    op.drop_index(op.f('ix_llm_usage_day'), table_name='llm_usage')
+    op.drop_table('llm_usage')
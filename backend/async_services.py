@@ -0,0 +1,298 @@
+import asyncio
+
+from google.generativeai.types import GenerationConfig
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+import services
+from cache import semantic_answer_cache
+from llm import gateway as llm
+from singleflight import single_flight
+from services import (TUTOR_FALLBACK, ChatService, GraderService, MindMapService, QuizService, StudyPackService,
+                      StudyPlanService, get_document, latest_flashcard_set_id, latest_mindmap, latest_quiz,
+                      latest_study_pack, latest_study_plan, study_pack_version, study_plan_version)
+
+# Coroutine versions of the model-heavy services. Queries and saves reuse
+# the sync services through AsyncSession.run_sync; only the model call and
+# the source fitting are awaited, so a request waiting on Gemini holds no
+# worker thread. Reads are committed with end_read before a model call, so
+# it holds no pooled connection either.
+
+
+async def end_read(db: AsyncSession):
+    """Ends the read transaction that run_sync began, returning its
+    connection to the pool. Commit, not rollback: a rollback would expire
+    the objects just loaded."""
+    await db.commit()
+
+
+async def document_source(doc: models.Document) -> str:
+    # Token counting is CPU-bound, or a provider call; keep it off the event loop.
+    return await asyncio.to_thread(services.document_source, doc)
+
+
+class AsyncQuizService:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+
+    async def generate_quiz(self, document_id: int, user_id: int, force_fresh: bool = False):
+        return await single_flight.arun(self.db, "quiz", document_id, user_id,
+                                        lambda: self._generate_quiz(document_id, user_id, force_fresh), latest_quiz)
+
+
+    async def _generate_quiz(self, document_id: int, user_id: int, force_fresh: bool = False):
+        doc = await self.db.run_sync(get_document, document_id, user_id)
+        if not doc:
+            print(f"Error: Document {document_id} not found.")
+            return None
+        await end_read(self.db)
+
+        prompt = QuizService._quiz_prompt()
+        try:
+            config = GenerationConfig(response_mime_type="application/json")
+            source = await document_source(doc)
+            response = await llm.agenerate(prompt, task="quiz.generate", generation_config=config, cache=True,
+                                           force_fresh=force_fresh, source=source, source_id=doc.id,
+                                           user_id=user_id)
+            return await self.db.run_sync(lambda db: QuizService(db)._save_quiz(doc.id, user_id, response.text))
+
+        except Exception as e:
+            print(f"!!! Quiz Generation Error: {e}")
+            return None
+
+
+    async def generate_flashcards(self, document_id: int, user_id: int, force_fresh: bool = False):
+        return await single_flight.arun(self.db, "flashcards", document_id, user_id,
+                                        lambda: self._generate_flashcards(document_id, user_id, force_fresh),
+                                        latest_flashcard_set_id, version=lambda set_id: set_id)
+
+
+    async def _generate_flashcards(self, document_id: int, user_id: int, force_fresh: bool = False):
+        doc = await self.db.run_sync(get_document, document_id, user_id)
+        if not doc:
+            return None
+        await end_read(self.db)
+
+        prompt = QuizService._flashcards_prompt()
+        try:
+            config = GenerationConfig(response_mime_type="application/json")
+            source = await document_source(doc)
+            response = await llm.agenerate(prompt, task="flashcards.generate", generation_config=config, cache=True,
+                                           force_fresh=force_fresh, source=source, source_id=doc.id,
+                                           user_id=user_id)
+            return await self.db.run_sync(lambda db: QuizService(db)._save_flashcards(doc.id, response.text))
+
+        except Exception as e:
+            print(f"!!! Flashcard Generation Error: {e}")
+            return None
+
+
+class AsyncMindMapService:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+
+    async def get_mindmap_by_doc(self, doc_id: int, user_id: int):
+        return await self.db.run_sync(lambda db: MindMapService(db).get_mindmap_by_doc(doc_id, user_id))
+
+
+    async def generate_mindmap(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        return await single_flight.arun(self.db, "mindmap", doc_id, user_id,
+                                        lambda: self._generate_mindmap(doc_id, user_id, force_fresh), latest_mindmap)
+
+
+    async def _generate_mindmap(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        doc = await self.db.run_sync(get_document, doc_id, user_id)
+        if not doc:
+            return None
+        await end_read(self.db)
+
+        prompt = MindMapService._mindmap_prompt()
+        try:
+            source = await document_source(doc)
+            response = await llm.agenerate(prompt, task="mindmap.generate", cache=True, force_fresh=force_fresh,
+                                           source=source, source_id=doc.id, user_id=user_id)
+            return await self.db.run_sync(lambda db: MindMapService(db)._save_mindmap(doc.id, response.text))
+
+        except Exception as e:
+            print(f"!!! MindMap Generation Error: {e}")
+            return None
+
+
+class AsyncStudyPackService:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+
+    async def generate_study_pack(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        return await single_flight.arun(self.db, "study_pack", doc_id, user_id,
+                                        lambda: self._generate_study_pack(doc_id, user_id, force_fresh),
+                                        latest_study_pack, version=study_pack_version)
+
+
+    async def _generate_study_pack(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        doc = await self.db.run_sync(get_document, doc_id, user_id)
+        if not doc:
+            return None
+        await end_read(self.db)
+
+        prompt = StudyPackService._pack_prompt()
+        try:
+            config = GenerationConfig(response_mime_type="application/json")
+            source = await document_source(doc)
+            response = await llm.agenerate(prompt, task="study_pack.generate", generation_config=config, cache=True,
+                                           force_fresh=force_fresh, source=source, source_id=doc.id,
+                                           user_id=user_id)
+            return await self.db.run_sync(lambda db: StudyPackService(db)._save_pack(doc.id, user_id, response.text))
+
+        except Exception as e:
+            await self.db.rollback()
+            print(f"!!! Study Pack Generation Error: {e}")
+            return None
+
+
+class AsyncChatService:
+    def __init__(self, db: AsyncSession, user_id: int = None):
+        self.db = db
+        self.user_id = user_id
+
+
+    async def ask_document(self, doc_id: int, question: str, ef_search: int = None):
+        await self._save_message(doc_id, 'user', question)
+
+        q_embedding = await llm.aembed(question, task="chat.query_embedding", user_id=self.user_id,
+                                       document_id=doc_id)
+
+        answer_text = semantic_answer_cache.lookup(doc_id, q_embedding)
+        if answer_text is None:
+            prompt = await self.db.run_sync(
+                lambda db: self._sync(db)._answer_prompt(doc_id, question, q_embedding, ef_search)
+            )
+            await end_read(self.db)
+            response = await llm.agenerate(prompt, task="chat.answer", user_id=self.user_id, document_id=doc_id)
+            answer_text = response.text
+            semantic_answer_cache.store(doc_id, q_embedding, answer_text)
+
+        await self._save_message(doc_id, 'ai', answer_text)
+        return answer_text
+
+
+    async def start_socratic_session(self, doc_id: int):
+        doc = await self.db.run_sync(get_document, doc_id)
+        if not doc:
+            return None
+
+        last_message = await self.db.run_sync(lambda db: self._sync(db)._last_tutor_message(doc_id))
+        if last_message is not None:
+            return last_message
+        await end_read(self.db)
+
+        prompt = ChatService._tutor_start_prompt()
+        source = await document_source(doc)
+        response = await llm.agenerate(prompt, task="tutor.start", source=source, source_id=doc.id,
+                                       user_id=self.user_id)
+        ai_question = response.text
+
+        await self._save_message(doc_id, 'tutor_ai', ai_question)
+        return ai_question
+
+
+    async def handle_tutor_response(self, doc_id: int, user_answer: str):
+        try:
+            # Building the prompt makes model calls too (summary, embeddings).
+            prompt = await self._tutor_prompt(doc_id, user_answer)
+            config = GenerationConfig(response_mime_type="application/json")
+            response = await llm.agenerate(prompt, task="tutor.reply", generation_config=config,
+                                           user_id=self.user_id, document_id=doc_id)
+            return await self.db.run_sync(lambda db: self._sync(db)._finish_tutor_turn(doc_id, response.text))
+
+        except Exception as e:
+            print(f"Tutor Error: {e}")
+            # Fallback
+            return dict(TUTOR_FALLBACK)
+
+
+    async def _tutor_prompt(self, doc_id: int, user_answer: str) -> str:
+        # ChatService._tutor_prompt with the summary and embedding calls awaited.
+        turn = await self.db.run_sync(lambda db: self._sync(db)._begin_tutor_turn(doc_id, user_answer))
+        if turn["fold"]:
+            response = await llm.agenerate(ChatService._tutor_summary_prompt(turn["summary"], turn["fold"]),
+                                           task="tutor.summary", user_id=self.user_id, document_id=doc_id)
+            turn["summary"] = await self.db.run_sync(
+                lambda db: self._sync(db)._save_tutor_summary(doc_id, response.text, turn["fold_through"])
+            )
+            await end_read(self.db)
+
+        embeddings = await llm.aembed(turn["queries"], task="tutor.query_embedding", user_id=self.user_id,
+                                      document_id=doc_id)
+        anchors, retrieved = await self.db.run_sync(
+            lambda db: self._sync(db)._tutor_context(doc_id, turn["anchor_ids"], embeddings)
+        )
+        # Token counting for the budget is CPU-bound; keep it off the event loop.
+        return await asyncio.to_thread(ChatService._render_tutor_prompt, turn, user_answer, anchors, retrieved)
+
+
+    async def _save_message(self, doc_id: int, role: str, content: str):
+        await self.db.run_sync(lambda db: self._sync(db)._save_message(doc_id, role, content))
+
+
+    def _sync(self, db) -> ChatService:
+        return ChatService(db, user_id=self.user_id)
+
+
+class AsyncGraderService:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+
+    async def evaluate_essay(self, doc_id: int, user_id: int, essay_text: str):
+        doc = await self.db.run_sync(get_document, doc_id)
+        if not doc:
+            raise ValueError("Document not found.")
+        await end_read(self.db)
+
+        prompt = GraderService._grading_prompt(essay_text)
+        try:
+            config = GenerationConfig(response_mime_type='application/json')
+            source = await document_source(doc)
+            response = await llm.agenerate(prompt, task="grader.evaluate", generation_config=config,
+                                           source=source, source_id=doc.id, user_id=user_id)
+            return await self.db.run_sync(
+                lambda db: GraderService(db)._save_submission(doc.id, user_id, essay_text, response.text)
+            )
+
+        except Exception as e:
+            print(f"Grading Error: {e}")
+            return None
+
+
+class AsyncStudyPlanService:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+
+    async def generate_study_plan(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        return await single_flight.arun(self.db, "study_plan", doc_id, user_id,
+                                        lambda: self._generate_study_plan(doc_id, user_id, force_fresh),
+                                        latest_study_plan, version=study_plan_version)
+
+
+    async def _generate_study_plan(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        doc = await self.db.run_sync(get_document, doc_id, user_id)
+        if not doc:
+            return None
+        await end_read(self.db)
+
+        prompt = StudyPlanService._plan_prompt(doc)
+        try:
+            config = GenerationConfig(response_mime_type='application/json')
+            source = await document_source(doc)
+            response = await llm.agenerate(prompt, task="study_plan.generate", generation_config=config, cache=True,
+                                           force_fresh=force_fresh, source=source, source_id=doc.id,
+                                           user_id=user_id)
+            return await self.db.run_sync(lambda db: StudyPlanService(db)._save_plan(doc.id, response.text))
+
+        except Exception as e:
+            print(f"Study Plan error: {e}")
+            return None
@@ -1,9 +1,5 @@
 import google.generativeai as genai
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+import llm  # configures the API key
 
 print("--- Elérhető modellek ---")
 for m in genai.list_models():
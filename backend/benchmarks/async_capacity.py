@@ -0,0 +1,92 @@
+"""Concurrent-request capacity of the blocking gateway against the async one.
+
+Each simulated request makes one generate call to the fake backend with a
+fixed latency, the dominant cost of the quiz, chat and grader endpoints.
+The blocking mode runs the calls on a 40-thread pool, the size of the
+threadpool FastAPI uses for `def` endpoints. The async mode awaits
+`agenerate` directly on the event loop, as the `async def` endpoints do.
+Scheduler quotas and slot limits are raised so that only the serving model
+is compared. No database is involved; endpoint_capacity.py measures the
+real endpoints, connection pool included.
+
+Usage:
+    python benchmarks/async_capacity.py --latency-ms 2000 --concurrency 10 40 100 400
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_cache import DocumentContextCache
+from llm import LLMGateway
+from llm_backends import FakeBackend
+from scheduler import Scheduler
+from usage import UsageRecorder
+
+THREADPOOL_SIZE = 40
+
+
+def make_gateway(latency_ms: float) -> LLMGateway:
+    # Usage is never flushed, so the run needs no database.
+    usage = UsageRecorder(flush_seconds=float("inf"), flush_every=10 ** 9)
+    scheduler = Scheduler(max_in_flight=10 ** 6, max_in_flight_per_model=10 ** 6, rpm=10 ** 9, tpm=10 ** 12)
+    return LLMGateway(backend=FakeBackend(latency_ms=latency_ms), context_cache=DocumentContextCache(), usage=usage,
+                      scheduler=scheduler)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_blocking(gateway: LLMGateway, concurrency: int) -> list[float]:
+    loop = asyncio.get_running_loop()
+    # Latency counts from arrival, so time spent queued for a thread is included.
+    arrived = time.perf_counter()
+
+    def request(i: int) -> float:
+        gateway.generate(f"Question {i}", task="chat.answer")
+        return time.perf_counter() - arrived
+
+    with ThreadPoolExecutor(max_workers=THREADPOOL_SIZE) as pool:
+        return await asyncio.gather(*(loop.run_in_executor(pool, request, i) for i in range(concurrency)))
+
+
+async def run_async(gateway: LLMGateway, concurrency: int) -> list[float]:
+    arrived = time.perf_counter()
+
+    async def request(i: int) -> float:
+        await gateway.agenerate(f"Question {i}", task="chat.answer")
+        return time.perf_counter() - arrived
+
+    return await asyncio.gather(*(request(i) for i in range(concurrency)))
+
+
+def report(mode: str, concurrency: int, latencies: list[float], wall: float):
+    print(f"{mode:>8} c={concurrency:<5} {concurrency / wall:8.1f} req/s  "
+          f"p50 {statistics.median(latencies):6.2f}s  p95 {percentile(latencies, 0.95):6.2f}s  "
+          f"max {max(latencies):6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency-ms", type=float, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 40, 100, 400])
+    args = parser.parse_args()
+
+    gateway = make_gateway(args.latency_ms)
+    print(f"Fake model latency {args.latency_ms:.0f} ms, blocking threadpool {THREADPOOL_SIZE}")
+    for concurrency in args.concurrency:
+        for mode, runner in (("blocking", run_blocking), ("async", run_async)):
+            started = time.perf_counter()
+            latencies = asyncio.run(runner(gateway, concurrency))
+            report(mode, concurrency, latencies, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Checks that cross-references find a related document for a user who owns
+a small share of the corpus.
+
+Inside one transaction that is rolled back at the end, it adds a corpus
+user with --corpus random documents and a second user with two documents
+whose centroids are close, each with a few chunks. It then asks
+DocumentService.related_snippets for the first one's neighbours and fails
+unless the second one comes back, printing the lookup latency.
+
+Usage:
+    python benchmarks/cross_references.py --corpus 20000
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+from sqlalchemy import insert
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from database import SessionLocal
+from services import DocumentService
+
+DIM = 768
+
+
+def unit(vector: np.ndarray) -> list[float]:
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def add_user(db, name: str) -> models.User:
+    user = models.User(username=f"{name}-{uuid.uuid4().hex[:8]}", hashed_password="-")
+    db.add(user)
+    db.flush()
+    return user
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=int, default=20_000, help="documents owned by other users")
+    parser.add_argument("--batch", type=int, default=5_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    db = SessionLocal()
+    try:
+        corpus_user = add_user(db, "bench-corpus")
+        for start in range(0, args.corpus, args.batch):
+            db.execute(insert(models.Document), [
+                {"filename": f"corpus-{start + i}.pdf", "content": "-", "owner_id": corpus_user.id,
+                 "embedding": unit(rng.normal(size=DIM))}
+                for i in range(min(args.batch, args.corpus - start))
+            ])
+
+        user = add_user(db, "bench-owner")
+        topic = rng.normal(size=DIM)
+        docs = []
+        for name in ("lecture.pdf", "notes.pdf"):
+            doc = models.Document(filename=name, content="-", owner_id=user.id,
+                                  embedding=unit(topic + rng.normal(scale=0.2, size=DIM)))
+            db.add(doc)
+            db.flush()
+            db.execute(insert(models.DocumentChunk), [
+                {"document_id": doc.id, "chunk_index": i, "content": f"{name} chunk {i}",
+                 "embedding": unit(topic + rng.normal(scale=0.5, size=DIM))}
+                for i in range(5)
+            ])
+            docs.append(doc)
+
+        started = time.perf_counter()
+        results = DocumentService().related_snippets(db, docs[0].id, user.id, docs[0].embedding)
+        ms = (time.perf_counter() - started) * 1000
+
+        found = [row[2] for row in results]
+        print(f"{args.corpus} corpus documents, 2 owned: related {found} in {ms:.1f} ms")
+        if docs[1].id not in found:
+            print("FAIL: the related document was not found")
+            sys.exit(1)
+        print("OK")
+    finally:
+        db.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Concurrent-request capacity of the real async endpoints against Postgres.
+
+Serves the app in-process over ASGI with the fake model backend, so each
+request runs the endpoint's own queries, saves and session handling
+around a model call of fixed latency. A scratch user and document are
+created for the run and deleted afterwards. Requests go to the essay
+grading endpoint, which neither caches nor coalesces, at each
+concurrency level. Alongside latency it reports the most async pool
+connections checked out at once and the most connections Postgres saw
+idle in transaction. Both should stay far below the concurrency: a
+request must not hold a connection while it waits on the model.
+
+Needs the usual database settings and SECRET_KEY in the environment.
+
+Usage:
+    python benchmarks/endpoint_capacity.py --latency-ms 2000 --concurrency 50 200 1000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["LLM_BACKEND"] = "fake"
+
+import httpx
+from sqlalchemy import text as sql_text
+
+import auth
+import database
+import models
+from llm import gateway
+from main import app
+from scheduler import Scheduler
+
+ESSAY = "A fotoszintézis a kloroplasztiszokban zajlik, és fényenergiát alakít kémiai energiává."
+
+IDLE_IN_TRANSACTION = sql_text(
+    "SELECT count(*) FROM pg_stat_activity "
+    "WHERE datname = current_database() AND state = 'idle in transaction'"
+)
+
+
+def create_fixture() -> tuple[int, int, str]:
+    with database.SessionLocal() as db:
+        user = models.User(username=f"bench-{uuid.uuid4().hex[:8]}", hashed_password="-")
+        db.add(user)
+        db.flush()
+        doc = models.Document(filename="bench.pdf", content=ESSAY * 200, owner_id=user.id)
+        db.add(doc)
+        db.commit()
+        return user.id, doc.id, auth.create_access_token({"sub": user.username})
+
+
+def drop_fixture(user_id: int, doc_id: int):
+    with database.SessionLocal() as db:
+        db.query(models.EssaySubmission).filter(models.EssaySubmission.document_id == doc_id).delete()
+        db.query(models.Document).filter(models.Document.id == doc_id).delete()
+        db.query(models.User).filter(models.User.id == user_id).delete()
+        db.commit()
+
+
+class Sampler:
+    """Polls the pool and pg_stat_activity from a thread until stopped."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.max_checked_out = 0
+        self.max_idle_in_transaction = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+    def _run(self):
+        with database.engine.connect() as conn:
+            while not self._stop.wait(self.interval):
+                self.max_checked_out = max(self.max_checked_out, database.async_engine.pool.checkedout())
+                idle = conn.execute(IDLE_IN_TRANSACTION).scalar()
+                conn.rollback()
+                self.max_idle_in_transaction = max(self.max_idle_in_transaction, idle)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(doc_id: int, token: str, concurrency: int) -> tuple[list[float], int]:
+    transport = httpx.ASGITransport(app=app)
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        arrived = time.perf_counter()
+
+        async def request(i: int) -> tuple[float, bool]:
+            response = await client.post(f"/documents/{doc_id}/essay/grade", headers=headers,
+                                         json={"essay_text": f"{ESSAY} ({i})"})
+            return time.perf_counter() - arrived, response.status_code == 200
+
+        results = await asyncio.gather(*(request(i) for i in range(concurrency)))
+    # asyncpg connections belong to this event loop; the next level runs on a new one.
+    await database.async_engine.dispose()
+    return [latency for latency, _ in results], sum(1 for _, ok in results if not ok)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency-ms", type=float, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 1000])
+    args = parser.parse_args()
+
+    # Quotas and slot limits are lifted so that only the serving path is measured.
+    gateway.backend.latency_ms = args.latency_ms
+    gateway.scheduler = Scheduler(max_in_flight=10 ** 6, max_in_flight_per_model=10 ** 6, rpm=10 ** 9, tpm=10 ** 12)
+
+    user_id, doc_id, token = create_fixture()
+    print(f"Fake model latency {args.latency_ms:.0f} ms, async pool {database.ASYNC_DB_POOL_SIZE}")
+    try:
+        for concurrency in args.concurrency:
+            started = time.perf_counter()
+            with Sampler() as sampler:
+                latencies, failed = asyncio.run(run(doc_id, token, concurrency))
+            wall = time.perf_counter() - started
+            print(f"c={concurrency:<5} {concurrency / wall:8.1f} req/s  "
+                  f"p50 {statistics.median(latencies):6.2f}s  p95 {percentile(latencies, 0.95):6.2f}s  "
+                  f"failed {failed}  pool max {sampler.max_checked_out}  "
+                  f"idle in transaction max {sampler.max_idle_in_transaction}")
+    finally:
+        drop_fixture(user_id, doc_id)
+
+
+if __name__ == "__main__":
+    main()
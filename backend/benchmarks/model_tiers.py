@@ -0,0 +1,118 @@
+"""Latency, cost and JSON validity of each model tier on the JSON tasks.
+
+Runs the quiz, flashcard and essay-grading prompts against one sample
+source on every tier's model, bypassing routing, and reports median and
+p95 latency, average cost per call and the share of responses that parse
+as JSON. Use it before moving a task to a cheaper tier in routing.
+Responses are not cached, so each run reaches the model.
+
+Usage:
+    python benchmarks/model_tiers.py --backend gemini --runs 5
+    python benchmarks/model_tiers.py --backend fake --tiers lite standard
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.generativeai.types import GenerationConfig
+
+from context_cache import DocumentContextCache
+from llm import LLMGateway
+from llm_backends import make_backend
+from routing import MODEL_TIERS
+from scheduler import Scheduler
+from services import GraderService, QuizService
+from usage import UsageRecorder, estimate_cost, token_counts
+
+SOURCE = """Photosynthesis converts light energy into chemical energy stored in glucose.
+It takes place in the chloroplasts of plant cells, in two stages. The light-dependent
+reactions in the thylakoid membranes split water, release oxygen and produce ATP and
+NADPH. The Calvin cycle in the stroma then uses that ATP and NADPH to fix carbon
+dioxide into three-carbon sugars, catalysed by the enzyme RuBisCO. The rate of
+photosynthesis is limited by light intensity, carbon dioxide concentration and
+temperature; whichever is in shortest supply sets the pace."""
+
+ESSAY = """Photosynthesis happens in the mitochondria, where plants turn oxygen into sugar.
+Light is needed to make the Calvin cycle produce water. Temperature does not matter
+because enzymes work the same at any temperature."""
+
+TASKS = {
+    "quiz.generate": QuizService._quiz_prompt(),
+    "flashcards.generate": QuizService._flashcards_prompt(),
+    "grader.evaluate": GraderService._grading_prompt(ESSAY),
+}
+
+
+def make_gateway(backend: str) -> LLMGateway:
+    # Usage is never flushed and quotas are lifted, so the run needs no database
+    # and measures the model alone.
+    usage = UsageRecorder(flush_seconds=float("inf"), flush_every=10 ** 9)
+    scheduler = Scheduler(max_in_flight=10 ** 6, max_in_flight_per_model=10 ** 6, rpm=10 ** 9, tpm=10 ** 12)
+    return LLMGateway(backend=make_backend(backend), context_cache=DocumentContextCache(), usage=usage,
+                      scheduler=scheduler)
+
+
+def is_json(text: str) -> bool:
+    try:
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_tier(gateway: LLMGateway, model: str, runs: int) -> dict:
+    config = GenerationConfig(response_mime_type="application/json")
+    latencies, costs, valid, errors = [], [], 0, 0
+    for task, prompt in TASKS.items():
+        for _ in range(runs):
+            started = time.perf_counter()
+            try:
+                response = gateway.generate(prompt, task=task, model=model, generation_config=config,
+                                            source=SOURCE)
+            except Exception as e:
+                print(f"  {model} {task}: {type(e).__name__}: {e}")
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            costs.append(estimate_cost(model, *token_counts(response)))
+            valid += is_json(response.text)
+    return {"latencies": latencies, "costs": costs, "valid": valid, "errors": errors}
+
+
+def report(tier: str, model: str, result: dict):
+    latencies = result["latencies"]
+    attempts = len(latencies) + result["errors"]
+    if not latencies:
+        print(f"{tier:>8} {model:<24} all {attempts} calls failed")
+        return
+    print(f"{tier:>8} {model:<24} p50 {statistics.median(latencies):6.2f}s  "
+          f"p95 {percentile(latencies, 0.95):6.2f}s  ${statistics.mean(result['costs']):.6f}/call  "
+          f"json {result['valid'] / attempts:6.1%}  errors {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", default="gemini", choices=["gemini", "fake", "record", "replay"])
+    parser.add_argument("--runs", type=int, default=3, help="calls per task and tier")
+    parser.add_argument("--tiers", nargs="+", default=list(MODEL_TIERS))
+    args = parser.parse_args()
+
+    gateway = make_gateway(args.backend)
+    print(f"{len(TASKS)} JSON tasks x {args.runs} runs per tier on the {args.backend} backend")
+    for tier in args.tiers:
+        model = MODEL_TIERS[tier]
+        report(tier, model, run_tier(gateway, model, args.runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Checks that two users' background embedding calls share the scheduler.
+
+With one slot held, a first user queues --calls chunk-embedding calls and a
+second user then queues a quarter as many. The slot is released and the
+grant order recorded. Weighted fair queueing should interleave the two
+users, so every one of the second user's calls must be granted within
+twice its count. The same run with both users unattributed, as chunk
+embeddings were before they carried a user id, is printed for comparison.
+Exits 1 when the attributed run does not interleave. Needs no database
+or network.
+
+Usage:
+    python benchmarks/scheduler_fairness.py --calls 40
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import Scheduler
+
+MODEL = "text-embedding-004"
+TASK = "document.chunk_embedding"
+COST = 5_000
+
+
+def wait_for_queue(scheduler: Scheduler, depth: int):
+    while sum(queue["waiting"] for queue in scheduler.snapshot()["queues"]) < depth:
+        time.sleep(0.001)
+
+
+def grant_order(first_user, second_user, calls: int) -> list[str]:
+    scheduler = Scheduler(max_in_flight=1, max_in_flight_per_model=1, rpm=10 ** 9, tpm=10 ** 12, limits={},
+                          weights={}, aging_seconds=0)
+    order, lock = [], threading.Lock()
+
+    def call(label: str, user_id):
+        with scheduler.slot(MODEL, TASK, user_id, COST):
+            with lock:
+                order.append(label)
+
+    held = scheduler.acquire(MODEL, TASK, "holder", COST)
+    threads = []
+    for label, user_id, count in (("a", first_user, calls), ("b", second_user, max(1, calls // 4))):
+        for _ in range(count):
+            thread = threading.Thread(target=call, args=(label, user_id))
+            thread.start()
+            threads.append(thread)
+        # Each user's calls are queued before the next user's, like one upload landing before another.
+        wait_for_queue(scheduler, len(threads))
+
+    scheduler.release(held)
+    for thread in threads:
+        thread.join()
+    return order
+
+
+def last_grant(order: list[str], label: str) -> int:
+    return max(i for i, item in enumerate(order) if item == label) + 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=40, help="background embeds queued by the first user")
+    args = parser.parse_args()
+
+    second_calls = max(1, args.calls // 4)
+    for name, users in (("unattributed", (None, None)), ("per user", (1, 2))):
+        order = grant_order(*users, args.calls)
+        print(f"{name:>12}: {''.join(order)}  (second user done after {last_grant(order, 'b')} grants)")
+
+    if last_grant(order, "b") > 2 * second_calls:
+        print("FAIL: the second user's embeds waited behind the first user's upload")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Peak memory per upload: the old buffered path against the streamed one.
+
+The buffered path mirrors the original handler: `await file.read()`, a
+copy into fitz via `stream=` and `+=` over every page. The streamed path
+copies the upload to disk in fixed chunks with `save_upload` and opens
+the PDF by path. Each mode runs in a fresh process, so `ru_maxrss`
+reflects that mode only.
+
+Usage:
+    python benchmarks/upload_memory.py --pages 300
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FILLER = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_pdf(path: str, pages: int):
+    import fitz
+
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (36, 36, -36, -36), f"Page {i}\n{FILLER}", fontsize=8)
+    doc.save(path)
+
+
+def run_buffered(path: str, results):
+    import io
+    import fitz
+
+    baseline = peak_rss_mb()
+    with open(path, "rb") as src:
+        file_bytes = src.read()
+
+    doc = fitz.open(stream=io.BytesIO(file_bytes).getvalue(), filetype="pdf")
+    text_content = ""
+    for page in doc:
+        text_content += page.get_text()
+
+    results.put(("buffered", peak_rss_mb() - baseline, len(text_content)))
+
+
+def run_streamed(path: str, results):
+    from fastapi import UploadFile
+    from extraction import PdfExtractor
+    from uploads import save_upload
+
+    baseline = peak_rss_mb()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dest = os.path.join(tmp_dir, "upload.pdf")
+        with open(path, "rb") as src:
+            asyncio.run(save_upload(UploadFile(file=src, filename="upload.pdf"), dest))
+
+        # Inline extraction keeps all work in this process so it shows up in ru_maxrss.
+        text_content = "".join(PdfExtractor(max_workers=1).iter_pages(dest))
+
+    results.put(("streamed", peak_rss_mb() - baseline, len(text_content)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "bench.pdf")
+        make_pdf(pdf_path, args.pages)
+        size_mb = os.path.getsize(pdf_path) / (1024 * 1024)
+        print(f"PDF: {args.pages} pages, {size_mb:.1f} MB")
+
+        for target in (run_buffered, run_streamed):
+            results = ctx.Queue()
+            proc = ctx.Process(target=target, args=(pdf_path, results))
+            proc.start()
+            mode, peak_mb, chars = results.get()
+            proc.join()
+            print(f"{mode:>9}: peak +{peak_mb:.1f} MB over baseline ({chars} chars extracted)")
+
+
+if __name__ == "__main__":
+    main()
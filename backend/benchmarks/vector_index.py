@@ -0,0 +1,170 @@
+"""Latency and recall of chunk vector search with and without an ANN index.
+
+Fills a scratch table shaped like document_chunks with clustered random
+768-d vectors, 200 chunks per document. It measures exact top-k with a
+sequential scan as ground truth, then the same queries through an HNSW or
+IVFFlat index for each ef_search / probes value. The scratch table is
+dropped at the end.
+
+With --filtered every query is restricted to one document, as chat and
+tutor retrieval are. The global index then only filters its ef_search
+candidates, so besides recall the report counts queries that came back
+with fewer than k rows. The filtered runs compare that post-filter, the
+same query with hnsw.iterative_scan = relaxed_order (pgvector 0.8+), and
+the exact scan over the document_id btree that services.nearest_chunks
+uses for documents up to VECTOR_EXACT_MAX_CHUNKS chunks.
+
+Usage:
+    python benchmarks/vector_index.py --sizes 10000 100000 1000000 --index hnsw --ef-search 20 40 100
+    python benchmarks/vector_index.py --sizes 100000 --index ivfflat --probes 1 10 40
+    python benchmarks/vector_index.py --sizes 100000 1000000 --filtered --ef-search 40 100
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import engine
+
+TABLE = "bench_document_chunks"
+DIM = 768
+CHUNKS_PER_DOCUMENT = 200
+
+GLOBAL_QUERY = f"SELECT id FROM {TABLE} ORDER BY embedding <=> %(query)s::vector LIMIT %(k)s"
+FILTERED_QUERY = f"""
+    SELECT id FROM {TABLE} WHERE document_id = %(document_id)s
+    ORDER BY embedding <=> %(query)s::vector LIMIT %(k)s
+"""
+# Same shape as services.EXACT_NEAREST_CHUNKS.
+EXACT_FILTERED_QUERY = f"""
+    WITH doc_chunks AS MATERIALIZED (
+        SELECT id, embedding FROM {TABLE} WHERE document_id = %(document_id)s
+    )
+    SELECT id FROM doc_chunks ORDER BY embedding <=> %(query)s::vector LIMIT %(k)s
+"""
+
+
+def vector_literal(vector) -> str:
+    return "[" + ",".join(f"{x:.6f}" for x in vector) + "]"
+
+
+def random_vectors(rng, n: int, centers: np.ndarray) -> np.ndarray:
+    # Clustered like real chunk embeddings: many chunks per document topic.
+    labels = rng.integers(0, len(centers), size=n)
+    vectors = centers[labels] + rng.normal(scale=0.3, size=(n, DIM))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_table(raw, rng, size: int, centers: np.ndarray, batch: int = 20000):
+    with raw.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        cur.execute(f"CREATE TABLE {TABLE} (id serial PRIMARY KEY, document_id integer, embedding vector({DIM}))")
+        for start in range(0, size, batch):
+            count = min(batch, size - start)
+            buf = io.StringIO()
+            for i, vector in enumerate(random_vectors(rng, count, centers)):
+                buf.write(f"{(start + i) // CHUNKS_PER_DOCUMENT}\t{vector_literal(vector)}\n")
+            buf.seek(0)
+            cur.copy_expert(f"COPY {TABLE} (document_id, embedding) FROM STDIN", buf)
+        cur.execute(f"CREATE INDEX ON {TABLE} (document_id)")
+        cur.execute(f"ANALYZE {TABLE}")
+    raw.commit()
+
+
+def search(cur, sql: str, params: dict, settings: dict) -> tuple[list[int], float]:
+    for name, value in settings.items():
+        cur.execute(f"SET LOCAL {name} = {value}")
+    started = time.perf_counter()
+    cur.execute(sql, params)
+    ids = [row[0] for row in cur.fetchall()]
+    return ids, (time.perf_counter() - started) * 1000
+
+
+def run_queries(raw, sql: str, queries: list[dict], settings: dict) -> tuple[list[list[int]], list[float]]:
+    results, latencies = [], []
+    with raw.cursor() as cur:
+        for params in queries:
+            ids, ms = search(cur, sql, params, settings)
+            results.append(ids)
+            latencies.append(ms)
+            raw.rollback()
+    return results, latencies
+
+
+def report(label: str, latencies: list[float], found: list[list[int]], truth: list[list[int]], k: int):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    recall = sum(len(set(a) & set(b)) for a, b in zip(found, truth)) / sum(len(b) for b in truth)
+    short = sum(len(ids) < min(k, len(expected)) for ids, expected in zip(found, truth))
+    print(f"  {label:<40} p50 {statistics.median(latencies):8.2f} ms   p95 {p95:8.2f} ms   "
+          f"recall@k {recall:.3f}   short {short}/{len(found)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--index", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[20, 40, 100])
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 10, 40])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--filtered", action="store_true", help="restrict each query to one document")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    centers = rng.normal(size=(256, DIM))
+    vectors = [vector_literal(v) for v in random_vectors(rng, args.queries, centers)]
+
+    raw = engine.raw_connection()
+    try:
+        for size in args.sizes:
+            print(f"--- {size} chunks ---")
+            load_table(raw, rng, size, centers)
+            documents = max(1, size // CHUNKS_PER_DOCUMENT)
+            queries = [{"query": vector, "k": args.k, "document_id": int(rng.integers(0, documents))}
+                       for vector in vectors]
+            sql = FILTERED_QUERY if args.filtered else GLOBAL_QUERY
+
+            truth, latencies = run_queries(raw, sql, queries, {"enable_indexscan": "off"})
+            report("exact (no index scan)", latencies, truth, truth, args.k)
+
+            started = time.perf_counter()
+            with raw.cursor() as cur:
+                if args.index == "hnsw":
+                    cur.execute(f"CREATE INDEX ON {TABLE} USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)")
+                else:
+                    lists = max(1, int(size ** 0.5))
+                    cur.execute(f"CREATE INDEX ON {TABLE} USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists})")
+            raw.commit()
+            print(f"  index build: {time.perf_counter() - started:.1f}s")
+
+            if args.index == "hnsw":
+                variants = [("hnsw.ef_search", value) for value in args.ef_search]
+            else:
+                variants = [("ivfflat.probes", value) for value in args.probes]
+
+            for name, value in variants:
+                found, latencies = run_queries(raw, sql, queries, {name: value})
+                report(f"{name}={value}", latencies, found, truth, args.k)
+                if args.filtered and args.index == "hnsw":
+                    found, latencies = run_queries(raw, sql, queries, {name: value, "hnsw.iterative_scan": "relaxed_order"})
+                    report(f"{name}={value} iterative", latencies, found, truth, args.k)
+
+            if args.filtered:
+                found, latencies = run_queries(raw, EXACT_FILTERED_QUERY, queries, {})
+                report("exact (document_id btree)", latencies, found, truth, args.k)
+    finally:
+        with raw.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        raw.commit()
+        raw.close()
+
+
+if __name__ == "__main__":
+    main()
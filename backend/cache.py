@@ -0,0 +1,327 @@
+import dataclasses
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+import models
+from database import SessionLocal
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+
+RESPONSE_CACHE_MAX_MB = int(os.getenv("RESPONSE_CACHE_MAX_MB", "256"))
+RESPONSE_CACHE_EVICT_EVERY = int(os.getenv("RESPONSE_CACHE_EVICT_EVERY", "50"))
+
+
+def content_hash(data: bytes | str) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path: str, block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+
+    def record(self, kind: str, hits: int = 0, misses: int = 0):
+        with self._lock:
+            counter = self._counters.setdefault(kind, {"hits": 0, "misses": 0})
+            counter["hits"] += hits
+            counter["misses"] += misses
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {}
+            for kind, counter in self._counters.items():
+                total = counter["hits"] + counter["misses"]
+                result[kind] = {
+                    **counter,
+                    "hit_rate": round(counter["hits"] / total, 3) if total else 0.0,
+                }
+            return result
+
+
+# --- Content-addressed cache for ingestion results ---
+
+class ContentCache:
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self.stats = CacheStats()
+
+
+    def get(self, kind: str, key: str):
+        try:
+            with self.session_factory() as db:
+                entry = db.get(models.ContentCacheEntry, f"{kind}:{key}")
+                value = entry.value if entry else None
+        except Exception as e:
+            print(f"Cache read error ({kind}): {e}")
+            value = None
+
+        self.stats.record(kind, hits=int(value is not None), misses=int(value is None))
+        return value
+
+
+    def set(self, kind: str, key: str, value):
+        try:
+            with self.session_factory() as db:
+                db.execute(pg_insert(models.ContentCacheEntry).values(
+                    key=f"{kind}:{key}", kind=kind, value=value
+                ).on_conflict_do_nothing())
+                db.commit()
+        except Exception as e:
+            print(f"Cache write error ({kind}): {e}")
+
+
+    def get_embeddings(self, model: str, texts: list[str]) -> dict[str, list]:
+        hashes = {self.embedding_key(model, text) for text in texts}
+        if not hashes:
+            return {}
+
+        try:
+            with self.session_factory() as db:
+                rows = db.query(models.EmbeddingCacheEntry).filter(
+                    models.EmbeddingCacheEntry.text_hash.in_(hashes)
+                ).all()
+                found = {row.text_hash: row.embedding.tolist() for row in rows}
+        except Exception as e:
+            print(f"Cache read error (embedding): {e}")
+            found = {}
+
+        self.stats.record("embedding", hits=len(found), misses=len(hashes) - len(found))
+        return found
+
+
+    def set_embeddings(self, model: str, embeddings: dict[str, list]):
+        if not embeddings:
+            return
+
+        try:
+            with self.session_factory() as db:
+                db.execute(pg_insert(models.EmbeddingCacheEntry).values([
+                    {"text_hash": self.embedding_key(model, text), "embedding": vector}
+                    for text, vector in embeddings.items()
+                ]).on_conflict_do_nothing())
+                db.commit()
+        except Exception as e:
+            print(f"Cache write error (embedding): {e}")
+
+
+    def embedding_key(self, model: str, text: str) -> str:
+        return content_hash(f"{model}\n{text}")
+
+
+content_cache = ContentCache()
+
+
+# --- Persistent cache for model responses ---
+
+class CachedResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = None
+
+
+class ResponseCache:
+    """Model responses keyed by model name, normalized prompt and generation
+    config. Entries live in Postgres; once the stored text grows past
+    max_bytes the least recently used rows are deleted."""
+
+    def __init__(self, session_factory=SessionLocal, max_bytes: int = RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+                 evict_every: int = RESPONSE_CACHE_EVICT_EVERY):
+        self.session_factory = session_factory
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.stats = CacheStats()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+
+    def key(self, model: str, prompt, generation_config=None) -> str:
+        if isinstance(prompt, str):
+            prompt_text = re.sub(r"\s+", " ", prompt).strip()
+        else:
+            prompt_text = json.dumps(prompt, sort_keys=True, default=str)
+
+        if dataclasses.is_dataclass(generation_config):
+            generation_config = dataclasses.asdict(generation_config)
+        config_text = json.dumps(generation_config, sort_keys=True, default=str)
+
+        return content_hash(f"{model}\n{config_text}\n{content_hash(prompt_text)}")
+
+
+    def get(self, key: str) -> CachedResponse | None:
+        text = None
+        try:
+            with self.session_factory() as db:
+                entry = db.get(models.ResponseCacheEntry, key)
+                if entry:
+                    text = entry.response_text
+                    entry.last_used_at = func.now()
+                    db.commit()
+        except Exception as e:
+            print(f"Cache read error (response): {e}")
+
+        self.stats.record("response", hits=int(text is not None), misses=int(text is None))
+        return CachedResponse(text) if text is not None else None
+
+
+    def set(self, key: str, model: str, task: str, text: str):
+        try:
+            with self.session_factory() as db:
+                statement = pg_insert(models.ResponseCacheEntry).values(
+                    key=key, model=model, task=task, response_text=text, size_bytes=len(text.encode("utf-8"))
+                )
+                db.execute(statement.on_conflict_do_update(
+                    index_elements=["key"],
+                    set_={
+                        "response_text": statement.excluded.response_text,
+                        "size_bytes": statement.excluded.size_bytes,
+                        "last_used_at": func.now(),
+                    },
+                ))
+                db.commit()
+        except Exception as e:
+            print(f"Cache write error (response): {e}")
+            return
+
+        with self._lock:
+            self._writes += 1
+            should_evict = self._writes % self.evict_every == 0
+        if should_evict:
+            self.evict()
+
+
+    def evict(self):
+        try:
+            with self.session_factory() as db:
+                total = db.query(func.coalesce(func.sum(models.ResponseCacheEntry.size_bytes), 0)).scalar()
+                if total <= self.max_bytes:
+                    return
+
+                freed = 0
+                rows = db.query(models.ResponseCacheEntry.key, models.ResponseCacheEntry.size_bytes).order_by(
+                    models.ResponseCacheEntry.last_used_at.asc()
+                ).yield_per(500)
+                stale = []
+                for key, size in rows:
+                    stale.append(key)
+                    freed += size
+                    if total - freed <= self.max_bytes * 0.9:
+                        break
+
+                db.query(models.ResponseCacheEntry).filter(
+                    models.ResponseCacheEntry.key.in_(stale)
+                ).delete(synchronize_session=False)
+                db.commit()
+                print(f"--- Response cache evicted {len(stale)} entries ({freed / (1024 * 1024):.1f} MB) ---")
+        except Exception as e:
+            print(f"Cache eviction error (response): {e}")
+
+
+response_cache = ResponseCache()
+
+
+# --- Semantic cache for chat answers ---
+
+class SemanticAnswerCache:
+    """Answers keyed by document and question embedding.
+
+    A question hits when its cosine similarity to a cached question on the
+    same document reaches the threshold. Entries expire after the TTL and
+    the least recently used ones are evicted past max_entries. The cache
+    lives in process memory, so each worker keeps its own.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_doc = {}
+        self._next_id = 0
+
+
+    def lookup(self, doc_id: int, embedding) -> str | None:
+        query = self._normalize(embedding)
+        answer = None
+
+        with self._lock:
+            self._expire(doc_id)
+            entry_ids = list(self._by_doc.get(doc_id, ()))
+            if entry_ids:
+                matrix = np.stack([self._entries[entry_id][1] for entry_id in entry_ids])
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id = entry_ids[best]
+                    self._entries.move_to_end(entry_id)
+                    answer = self._entries[entry_id][2]
+
+        self.stats.record("answer", hits=int(answer is not None), misses=int(answer is None))
+        return answer
+
+
+    def store(self, doc_id: int, embedding, answer: str):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (doc_id, self._normalize(embedding), answer, time.monotonic())
+            self._by_doc.setdefault(doc_id, set()).add(entry_id)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+
+    def invalidate(self, doc_id: int):
+        with self._lock:
+            for entry_id in list(self._by_doc.get(doc_id, ())):
+                self._remove(entry_id)
+
+
+    def _expire(self, doc_id: int):
+        cutoff = time.monotonic() - self.ttl
+        for entry_id in list(self._by_doc.get(doc_id, ())):
+            if self._entries[entry_id][3] < cutoff:
+                self._remove(entry_id)
+
+
+    def _remove(self, entry_id: int):
+        doc_id = self._entries.pop(entry_id)[0]
+        doc_entries = self._by_doc.get(doc_id)
+        if doc_entries is not None:
+            doc_entries.discard(entry_id)
+            if not doc_entries:
+                del self._by_doc[doc_id]
+
+
+    def _normalize(self, embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+semantic_answer_cache = SemanticAnswerCache()
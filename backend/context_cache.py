@@ -0,0 +1,224 @@
+import datetime
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import google.generativeai as genai
+
+from cache import content_hash
+
+CONTEXT_CACHE_PROVIDER = os.getenv("CONTEXT_CACHE_PROVIDER", "gemini")
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", "8000"))
+
+SOURCE_HEADER = "Source material:\n"
+
+
+class GeminiContextProvider:
+    """Handles are the CachedContent objects returned by create, so building
+    a model needs no lookup round trip."""
+
+    def create(self, model_name: str, text: str, ttl: float, display_name: str):
+        from google.generativeai import caching
+
+        return caching.CachedContent.create(
+            model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+            display_name=display_name,
+            contents=[SOURCE_HEADER + text],
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+
+
+    def delete(self, handle):
+        handle.delete()
+
+
+    def model_for(self, handle, model_name: str):
+        return genai.GenerativeModel.from_cached_content(cached_content=handle)
+
+
+class InlineContextModel:
+    """Model wrapper that sends the cached text inline with every prompt."""
+
+    def __init__(self, model, text: str):
+        self.model = model
+        self.text = text
+
+
+    def generate_content(self, prompt, **kwargs):
+        return self.model.generate_content([SOURCE_HEADER + self.text, prompt], **kwargs)
+
+
+    async def generate_content_async(self, prompt, **kwargs):
+        return await self.model.generate_content_async([SOURCE_HEADER + self.text, prompt], **kwargs)
+
+
+class FakeContextProvider:
+    """Offline stand-in for the provider cache. Handles are kept in memory
+    and models send the text inline, so the manager's create, reuse,
+    expiry and delete paths can be exercised without the network."""
+
+    def __init__(self, model_factory=genai.GenerativeModel):
+        self.model_factory = model_factory
+        self.contents = {}
+        self.created = 0
+        self.deleted = 0
+        self._ids = itertools.count(1)
+
+
+    def create(self, model_name: str, text: str, ttl: float, display_name: str) -> str:
+        name = f"cachedContents/fake-{next(self._ids)}"
+        self.contents[name] = text
+        self.created += 1
+        return name
+
+
+    def delete(self, name: str):
+        if self.contents.pop(name, None) is not None:
+            self.deleted += 1
+
+
+    def model_for(self, name: str, model_name: str):
+        return InlineContextModel(self.model_factory(model_name), self.contents[name])
+
+
+# --- Per-document context cache ---
+
+class DocumentContextCache:
+    """Keeps one provider-side cached content handle per document, model and
+    source slice. The handle is created on first use, reused until its TTL
+    is close to running out, and deleted with the document. Text below
+    min_chars, or text the provider refuses to cache, is sent inline.
+
+    Creation is a provider round trip, so it runs under a lock of its own
+    key only; the shared lock guards the maps and is never held across a
+    provider call. Key locks live while someone holds or waits on them, and
+    expired handles and refusals are swept whenever a handle is created,
+    so a long-running worker does not accumulate keys."""
+
+    def __init__(self, provider=None, ttl: float = CONTEXT_CACHE_TTL, min_chars: int = CONTEXT_CACHE_MIN_CHARS):
+        self.provider = provider
+        self.ttl = ttl
+        self.min_chars = min_chars
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refused = {}
+        self._key_locks = {}
+        # Creates in flight; invalidate drops a document's, so their handles are thrown away.
+        self._creating = {}
+
+
+    def model_for(self, doc_id: int, model_name: str, text: str):
+        if self.provider is None or len(text) < self.min_chars:
+            return None
+
+        key = (doc_id, model_name, content_hash(text))
+        with self._lock:
+            handle, refused = self._usable(key), self._is_refused(key)
+        if refused:
+            return None
+        if handle is not None:
+            return self.provider.model_for(handle, model_name)
+
+        with self._key_lock(key):
+            with self._lock:
+                # Another request may have created it while this one waited.
+                handle, refused = self._usable(key), self._is_refused(key)
+                if handle is None and not refused:
+                    stale = self._entries.pop(key, None)
+                    self._sweep()
+                    token = self._creating[key] = object()
+            if refused:
+                return None
+            if handle is not None:
+                return self.provider.model_for(handle, model_name)
+
+            if stale is not None:
+                self._delete(stale[0])
+            try:
+                handle = self.provider.create(model_name, text, self.ttl, display_name=f"document-{doc_id}")
+            except Exception as e:
+                print(f"Context cache create failed for document {doc_id}: {e}")
+                with self._lock:
+                    if self._creating.pop(key, None) is token:
+                        self._refused[key] = time.monotonic() + self.ttl
+                return None
+
+            with self._lock:
+                current = self._creating.pop(key, None) is token
+                if current:
+                    self._entries[key] = (handle, time.monotonic() + self.ttl)
+            if not current:
+                self._delete(handle)
+                return None
+
+        return self.provider.model_for(handle, model_name)
+
+
+    def invalidate(self, doc_id: int):
+        with self._lock:
+            handles = [self._entries.pop(key)[0] for key in [key for key in self._entries if key[0] == doc_id]]
+            for pending in (self._refused, self._creating):
+                for key in [key for key in pending if key[0] == doc_id]:
+                    del pending[key]
+        for handle in handles:
+            self._delete(handle)
+
+
+    @contextmanager
+    def _key_lock(self, key):
+        # Reference counted, so the map only holds keys someone is creating or waiting on.
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+
+    def _sweep(self):
+        """Drops handles the provider has already expired and refusals that
+        ran out. Callers hold self._lock."""
+        now = time.monotonic()
+        self._entries = {key: entry for key, entry in self._entries.items() if entry[1] > now}
+        self._refused = {key: until for key, until in self._refused.items() if until > now}
+
+
+    def _is_refused(self, key) -> bool:
+        # Callers hold self._lock.
+        return self._refused.get(key, 0) > time.monotonic()
+
+
+    def _usable(self, key):
+        """The handle for key while it has more than a tenth of its TTL left;
+        renewing early means a request never races the provider's expiry.
+        Callers hold self._lock."""
+        entry = self._entries.get(key)
+        if entry is None or entry[1] - time.monotonic() < self.ttl * 0.1:
+            return None
+        return entry[0]
+
+
+    def _delete(self, handle):
+        try:
+            self.provider.delete(handle)
+        except Exception as e:
+            print(f"Context cache delete failed for {getattr(handle, 'name', handle)}: {e}")
+
+
+def _make_provider(name: str):
+    if name == "gemini":
+        return GeminiContextProvider()
+    if name == "fake":
+        return FakeContextProvider()
+    return None
+
+
+document_context_cache = DocumentContextCache(_make_provider(CONTEXT_CACHE_PROVIDER))
@@ -0,0 +1,146 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator
+
+import fitz
+
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 2)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))
+PDF_EXTRACT_TIMEOUT = float(os.getenv("PDF_EXTRACT_TIMEOUT", "120"))
+PDF_EXTRACT_MEMORY_MB = int(os.getenv("PDF_EXTRACT_MEMORY_MB", "1024"))
+
+
+class ExtractionLimitExceeded(Exception):
+    pass
+
+
+def _limit_worker_memory(limit_mb: int):
+    try:
+        import resource
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def _open_pdf(source: str | bytes):
+    if isinstance(source, str):
+        return fitz.open(source)
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def _extract_page_range(path: str, start: int, stop: int) -> list[str]:
+    with fitz.open(path) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+
+# --- PDF extraction engine ---
+
+class PdfExtractor:
+    """Extracts PDF text page by page.
+
+    Small documents are read inline. Larger ones are split into page
+    ranges that run on a process pool, and pages are yielded in order
+    as soon as their range is done, so callers can start chunking before
+    the whole file is parsed. Each document gets a wall-clock budget, and
+    every worker process runs under an address-space limit.
+    """
+
+    def __init__(self, max_workers: int = PDF_EXTRACT_WORKERS, pages_per_task: int = PDF_PAGES_PER_TASK,
+                 timeout: float = PDF_EXTRACT_TIMEOUT, memory_mb: int = PDF_EXTRACT_MEMORY_MB):
+        self.max_workers = max_workers
+        self.pages_per_task = pages_per_task
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self._pool = None
+        self._lock = threading.Lock()
+
+
+    def iter_pages(self, source: str | bytes) -> Iterator[str]:
+        deadline = time.monotonic() + self.timeout
+
+        with _open_pdf(source) as doc:
+            page_count = doc.page_count
+            if page_count < PDF_PARALLEL_MIN_PAGES or self.max_workers <= 1:
+                for page in doc:
+                    self._check_deadline(deadline)
+                    yield page.get_text()
+                return
+
+        if isinstance(source, str):
+            yield from self._iter_parallel(source, page_count, deadline)
+            return
+
+        # Workers open the file themselves, so spill the bytes to disk once
+        # instead of pickling the whole document into every task.
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+            tmp.write(source)
+            tmp.flush()
+            yield from self._iter_parallel(tmp.name, page_count, deadline)
+
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+    def _iter_parallel(self, path: str, page_count: int, deadline: float) -> Iterator[str]:
+        pool = self._get_pool()
+        futures = [
+            pool.submit(_extract_page_range, path, start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        ]
+
+        try:
+            for future in futures:
+                remaining = self._check_deadline(deadline)
+                try:
+                    pages = future.result(timeout=remaining)
+                except FutureTimeoutError:
+                    raise ExtractionLimitExceeded(f"PDF extraction exceeded {self.timeout:.0f}s")
+                except MemoryError:
+                    raise ExtractionLimitExceeded(f"PDF extraction exceeded {self.memory_mb} MB")
+                except BrokenProcessPool:
+                    self._reset_pool(pool)
+                    raise ExtractionLimitExceeded("PDF extraction worker crashed")
+                yield from pages
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+    def _check_deadline(self, deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ExtractionLimitExceeded(f"PDF extraction exceeded {self.timeout:.0f}s")
+        return remaining
+
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_limit_worker_memory,
+                    initargs=(self.memory_mb,),
+                )
+            return self._pool
+
+
+    def _reset_pool(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+pdf_extractor = PdfExtractor()
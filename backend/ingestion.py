@@ -0,0 +1,412 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+import models
+import services
+from database import SessionLocal
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+INGESTION_STAGE_WORKERS = int(os.getenv("INGESTION_STAGE_WORKERS", str(INGESTION_WORKERS * 4)))
+
+# A running job touches updated_at every heartbeat; one silent for INGESTION_STALE_SECONDS
+# lost its worker and is failed by the next process that starts.
+INGESTION_HEARTBEAT_SECONDS = float(os.getenv("INGESTION_HEARTBEAT_SECONDS", "30"))
+INGESTION_STALE_SECONDS = float(os.getenv("INGESTION_STALE_SECONDS", "300"))
+
+STAGES = ["extract", "validate", "summarize", "embed", "save", "cross_reference", "digest", "study_plan"]
+
+STAGE_TIMEOUTS = {
+    stage: float(os.getenv(f"INGESTION_TIMEOUT_{stage.upper()}", default))
+    for stage, default in {
+        "extract": "120",
+        "validate": "90",
+        "summarize": "180",
+        "embed": "300",
+        "save": "300",
+        "cross_reference": "90",
+        "digest": "300",
+        "study_plan": "180",
+    }.items()
+}
+
+
+class ValidationFailed(Exception):
+    pass
+
+
+class StageTimeout(Exception):
+    pass
+
+
+class Stage:
+    def __init__(self, name: str, func, depends_on: list[str] = (), timeout: float = None, required: bool = True):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+        self.timeout = timeout
+        self.required = required
+
+
+class StageGraph:
+    """Runs stages as soon as their dependencies finish, so independent
+    branches execute concurrently on the given executor.
+
+    Each stage function receives a dict of its dependencies' results.
+    Dependencies that were never added to the graph count as satisfied
+    and resolve to None. A failing or timed out optional stage also
+    resolves to None; a required one aborts the graph.
+
+    A running thread cannot be stopped, so an abort sets `cancelled`:
+    stages that have not started yet are skipped, and running ones are
+    expected to check it before model calls and side effects.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, on_state=None):
+        self.executor = executor
+        self.on_state = on_state or (lambda stage, state: None)
+        self.stages: dict[str, Stage] = {}
+        self.cancelled = threading.Event()
+
+
+    def add(self, name: str, func, depends_on: list[str] = (), timeout: float = None, required: bool = True):
+        self.stages[name] = Stage(name, func, depends_on, timeout, required)
+
+
+    def run(self) -> dict:
+        try:
+            return self._run()
+        except BaseException:
+            self.cancelled.set()
+            raise
+
+
+    def _run(self) -> dict:
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.depends_on if dep in self.stages):
+                    del pending[name]
+                    self.on_state(name, "running")
+                    deps = {dep: results.get(dep) for dep in stage.depends_on}
+                    deadline = time.monotonic() + stage.timeout if stage.timeout else None
+                    running[self.executor.submit(self._call, stage, deps)] = (stage, deadline)
+
+            if not running:
+                raise RuntimeError(f"Unresolvable stage dependencies: {', '.join(pending)}")
+
+            deadlines = [deadline for _, deadline in running.values() if deadline is not None]
+            wait_timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            done, _ = wait(running, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+
+            now = time.monotonic()
+            for future in list(running):
+                stage, deadline = running[future]
+                if future in done:
+                    del running[future]
+                    try:
+                        results[stage.name] = future.result()
+                        self.on_state(stage.name, "done")
+                    except Exception as e:
+                        self._fail(stage, "failed", e, results)
+                elif deadline is not None and now >= deadline:
+                    del running[future]
+                    future.cancel()
+                    error = StageTimeout(f"Stage '{stage.name}' timed out after {stage.timeout:.0f}s")
+                    self._fail(stage, "timeout", error, results)
+
+        return results
+
+
+    def _call(self, stage: Stage, deps: dict):
+        # The executor may only get to a stage after the graph was aborted.
+        services.raise_if_cancelled(self.cancelled)
+        return stage.func(deps)
+
+
+    def _fail(self, stage: Stage, state: str, error: Exception, results: dict):
+        self.on_state(stage.name, state)
+        if stage.required:
+            raise error
+
+        print(f"Optional stage '{stage.name}' {state}: {error}")
+        results[stage.name] = None
+
+
+# --- Ingestion job services ---
+
+class IngestionService:
+    def __init__(self, doc_service: services.DocumentService, max_workers: int = INGESTION_WORKERS):
+        self.doc_service = doc_service
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingestion")
+        self.stage_executor = ThreadPoolExecutor(max_workers=INGESTION_STAGE_WORKERS, thread_name_prefix="ingestion-stage")
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+
+    def new_upload_path(self, filename: str) -> tuple[str, str]:
+        job_id = uuid.uuid4().hex
+        ext = filename.split('.')[-1].lower()
+        return job_id, os.path.join(UPLOAD_DIR, f"{job_id}.{ext}")
+
+
+    def create_job(self, db: Session, job_id: str, file_path: str, filename: str, user_id: int, category: str = None, study_focus: str = None, force_upload: bool = False):
+        """Records a queued job for an upload already saved at file_path. The
+        upload is removed when the job cannot be recorded."""
+        job = models.IngestionJob(
+            id=job_id,
+            owner_id=user_id,
+            filename=filename,
+            file_path=file_path,
+            category=category,
+            study_focus=study_focus,
+            force_upload=force_upload,
+            status="queued",
+            stages={stage: "pending" for stage in STAGES},
+        )
+        try:
+            db.add(job)
+            db.commit()
+        except Exception:
+            db.rollback()
+            self._remove_upload(file_path)
+            raise
+        db.refresh(job)
+        return job
+
+
+    def submit(self, job_id: str):
+        self.executor.submit(self.run_job, job_id)
+
+
+    def get_job(self, db: Session, job_id: str, user_id: int):
+        return db.query(models.IngestionJob).filter(
+            models.IngestionJob.id == job_id,
+            models.IngestionJob.owner_id == user_id
+        ).first()
+
+
+    def resume_pending_jobs(self):
+        """Fails running jobs whose worker stopped sending heartbeats, with
+        their uploads and any document they left behind, and queues the rest.
+        Every worker process calls this on startup; jobs other workers are
+        still running keep their heartbeat fresh, and a queued job is claimed
+        by exactly one of the workers it is sent to."""
+        db = SessionLocal()
+        try:
+            stale_before = datetime.now(timezone.utc) - timedelta(seconds=INGESTION_STALE_SECONDS)
+            # Workers starting together skip the jobs another one is already failing.
+            stale = db.query(models.IngestionJob).filter(
+                models.IngestionJob.status == "running",
+                models.IngestionJob.updated_at < stale_before
+            ).with_for_update(skip_locked=True).all()
+            for job in stale:
+                self._fail_job(db, job, "Interrupted by server restart.")
+            db.commit()
+            for job in stale:
+                self._remove_upload(job.file_path)
+
+            queued = db.query(models.IngestionJob.id).filter(
+                models.IngestionJob.status == "queued"
+            ).all()
+            for (job_id,) in queued:
+                self.submit(job_id)
+        finally:
+            db.close()
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.stage_executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def run_job(self, job_id: str):
+        db = SessionLocal()
+        # Claim and mark running in one statement, so a job resubmitted by
+        # several workers runs once.
+        claimed = db.execute(update(models.IngestionJob).where(
+            models.IngestionJob.id == job_id,
+            models.IngestionJob.status == "queued"
+        ).values(status="running").returning(models.IngestionJob.id)).scalar()
+        db.commit()
+        if claimed is None:
+            db.close()
+            return
+
+        job = db.get(models.IngestionJob, job_id)
+        file_path = job.file_path
+        stop_heartbeat = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, stop_heartbeat), daemon=True).start()
+        try:
+            self._run_pipeline(db, job)
+            job.status = "completed"
+            job.stage = None
+            db.commit()
+            print(f"--- Ingestion job {job_id} completed ---")
+
+        except ValidationFailed as e:
+            job.status = "failed"
+            job.error = f"VALIDATION_FAILED: {e}"
+            db.commit()
+
+        except Exception as e:
+            print(f"Ingestion job {job_id} failed: {e}")
+            db.rollback()
+            # A timed out save may still be committing; locking the job row waits for
+            # it, and a document it left behind is removed with the failed job.
+            job = db.query(models.IngestionJob).filter(
+                models.IngestionJob.id == job_id
+            ).with_for_update().populate_existing().one()
+            self._fail_job(db, job, str(e))
+            db.commit()
+
+        finally:
+            stop_heartbeat.set()
+            db.close()
+            self._remove_upload(file_path)
+
+
+    def _fail_job(self, db: Session, job: models.IngestionJob, error: str):
+        # The caller holds the job row lock and commits.
+        if job.document_id is not None:
+            orphan = db.get(models.Document, job.document_id)
+            if orphan is not None:
+                db.delete(orphan)
+            job.document_id = None
+        job.status = "failed"
+        job.error = error
+
+
+    def _remove_upload(self, file_path: str):
+        try:
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+        except OSError as e:
+            print(f"Could not remove upload {file_path}: {e}")
+
+
+    def _heartbeat(self, job_id: str, stop: threading.Event):
+        def touch(session: Session):
+            session.execute(update(models.IngestionJob).where(
+                models.IngestionJob.id == job_id,
+                models.IngestionJob.status == "running"
+            ).values(updated_at=datetime.now(timezone.utc)))
+            session.commit()
+
+        while not stop.wait(INGESTION_HEARTBEAT_SECONDS):
+            try:
+                self._with_session(touch)
+            except Exception as e:
+                print(f"Ingestion job {job_id} heartbeat failed: {e}")
+
+
+    def _run_pipeline(self, db: Session, job: models.IngestionJob):
+        # Stage functions run on other threads, so they only see plain values
+        # and open their own sessions instead of touching the job's session.
+        job_id, file_path, filename, user_id = job.id, job.file_path, job.filename, job.owner_id
+        category, study_focus = job.category, job.study_focus
+
+        graph = StageGraph(self.stage_executor, on_state=lambda stage, state: self._set_stage(db, job, stage, state))
+
+        # Embedding consumes pages as extract produces them, then keeps running
+        # alongside validate and summarize; a failed validation cancels the graph
+        # and with it the remaining embedding batches.
+        pages = services.TextStream(graph.cancelled)
+        graph.add("extract", lambda deps: self.doc_service.extract_text(file_path, filename, stream=pages),
+                  timeout=STAGE_TIMEOUTS["extract"])
+        graph.add("embed", lambda deps: self.doc_service.embed_chunks(pages, cancelled=graph.cancelled,
+                                                                      user_id=user_id),
+                  timeout=STAGE_TIMEOUTS["embed"])
+
+        if job.force_upload:
+            self._set_stage(db, job, "validate", "skipped")
+        else:
+            graph.add("validate", lambda deps: self._validate(deps["extract"], user_id),
+                      depends_on=["extract"], timeout=STAGE_TIMEOUTS["validate"])
+
+        graph.add("summarize", lambda deps: self.doc_service.generate_summary(deps["extract"], study_focus=study_focus,
+                                                                                user_id=user_id,
+                                                                                cancelled=graph.cancelled),
+                  depends_on=["extract"], timeout=STAGE_TIMEOUTS["summarize"])
+
+        def save(deps):
+            references = (deps["validate"] or {}).get("references", [])
+            summary = deps["summarize"] + self.doc_service.format_references(references)
+            return self._with_session(lambda session: self.doc_service.save_document(
+                session, filename, deps["extract"], summary, user_id, category, study_focus,
+                before_commit=lambda session, doc: self._claim_document(session, job_id, doc, graph.cancelled),
+                embedded=deps["embed"]
+            ).id)
+
+        graph.add("save", save, depends_on=["extract", "validate", "summarize", "embed"],
+                  timeout=STAGE_TIMEOUTS["save"])
+
+        graph.add("cross_reference", lambda deps: self._with_session(
+            lambda session: self.doc_service.find_cross_references(session, deps["save"], deps["extract"], user_id)
+        ), depends_on=["extract", "save"], timeout=STAGE_TIMEOUTS["cross_reference"], required=False)
+
+        graph.add("digest", lambda deps: self._with_session(
+            lambda session: self.doc_service.build_digest(session, deps["save"], deps["extract"], user_id) is not None
+        ), depends_on=["extract", "save"], timeout=STAGE_TIMEOUTS["digest"], required=False)
+
+        if study_focus:
+            print(f"--- Auto generating Study Plan for {study_focus} ---")
+            graph.add("study_plan", lambda deps: self._with_session(
+                lambda session: services.StudyPlanService(session).generate_study_plan(deps["save"], user_id)
+            ), depends_on=["save", "digest"], timeout=STAGE_TIMEOUTS["study_plan"], required=False)
+        else:
+            self._set_stage(db, job, "study_plan", "skipped")
+
+        results = graph.run()
+
+        job.document_id = results["save"]
+        cross_ref_note = results.get("cross_reference")
+        if cross_ref_note:
+            doc = db.query(models.Document).filter(models.Document.id == results["save"]).first()
+            doc.summary += cross_ref_note
+        db.commit()
+
+
+    def _claim_document(self, session: Session, job_id: str, doc: models.Document, cancelled: threading.Event):
+        # Runs in the save transaction. The job row stays locked until the commit,
+        # so the job cannot be failed between this check and the document landing.
+        job = session.query(models.IngestionJob).filter(models.IngestionJob.id == job_id).with_for_update().first()
+        if cancelled.is_set() or job is None or job.status != "running":
+            raise services.OperationCancelled(f"Ingestion job {job_id} is no longer running")
+        job.document_id = doc.id
+
+
+    def _with_session(self, func):
+        session = SessionLocal()
+        try:
+            return func(session)
+        finally:
+            session.close()
+
+
+    def _validate(self, content: str, user_id: int = None) -> dict:
+        validation_result = self.doc_service.validate_content(content, user_id=user_id)
+
+        if not validation_result.get("is_valid", True):
+            raise ValidationFailed(validation_result.get("warning_message", "A dokumentum tartalma megkérdőjelezhető."))
+
+        if validation_result.get("warning_message"):
+            print(f"Upload proceeded with warning: {validation_result['warning_message']}")
+
+        return validation_result
+
+
+    def _set_stage(self, db: Session, job: models.IngestionJob, stage: str, state: str):
+        job.stages = {**job.stages, stage: state}
+        if state == "running":
+            job.stage = stage
+        db.commit()
@@ -0,0 +1,460 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+from dotenv import load_dotenv
+
+from cache import ResponseCache, response_cache
+from context_cache import SOURCE_HEADER, DocumentContextCache, document_context_cache
+from llm_backends import make_backend
+from routing import DEFAULT_MODEL, QUOTA_ERRORS, models_for
+from scheduler import Scheduler, SchedulerTimeoutError
+from usage import UsageRecorder, token_counts, usage_recorder
+
+load_dotenv()
+
+EMBEDDING_MODEL = "models/gemini-embedding-001"
+EMBEDDING_DIM = 768
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+# Expected output tokens per generate call, charged to the TPM bucket until the real count is known.
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "1000"))
+
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# A routed call moves on to its next model on these.
+FALLBACK_ERRORS = (*QUOTA_ERRORS, CircuitOpenError, SchedulerTimeoutError)
+
+
+class CircuitBreaker:
+    """Opens after a run of consecutive retryable failures and rejects calls
+    until the reset window passes; then one trial call is let through."""
+
+    def __init__(self, threshold: int = LLM_BREAKER_THRESHOLD, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half_open"
+            return "open"
+
+
+    def before_call(self) -> bool:
+        """Raises CircuitOpenError while open; True when this call is the
+        half-open trial, which must be closed with end_trial."""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_running:
+                raise CircuitOpenError("LLM circuit is open, try again later")
+            self._trial_running = True
+            return True
+
+
+    def end_trial(self):
+        # A trial that ends in an error outside the retryable set (a bad request,
+        # a scheduler timeout, a cancelled task) says nothing about the provider;
+        # the circuit stays half-open and the next call becomes the trial.
+        with self._lock:
+            self._trial_running = False
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+class CallMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+
+    def record(self, model: str, task: str, seconds: float, error: bool = False, retries: int = 0,
+               prompt_tokens: int = 0, output_tokens: int = 0, calls: int = 1, fallbacks: int = 0):
+        with self._lock:
+            entry = self._calls.setdefault((model, task), {
+                "calls": 0, "errors": 0, "retries": 0, "fallbacks": 0, "prompt_tokens": 0, "output_tokens": 0,
+                "total_seconds": 0.0, "max_seconds": 0.0,
+            })
+            entry["calls"] += calls
+            entry["errors"] += int(error)
+            entry["retries"] += retries
+            entry["fallbacks"] += fallbacks
+            entry["prompt_tokens"] += prompt_tokens
+            entry["output_tokens"] += output_tokens
+            entry["total_seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            return [
+                {
+                    "model": model,
+                    "task": task,
+                    **entry,
+                    "avg_seconds": round(entry["total_seconds"] / entry["calls"], 3) if entry["calls"] else 0.0,
+                }
+                for (model, task), entry in self._calls.items()
+            ]
+
+
+# --- LLM gateway ---
+
+class LLMGateway:
+    """Single entry point for every Gemini call.
+
+    Model instances are shared, every call waits its turn in the scheduler
+    (quota, in-flight caps, priority and per-user fairness), 429/5xx errors
+    are retried with jittered exponential backoff, and a per-model circuit
+    breaker stops hammering a failing backend. Every call is tagged with a
+    task name such as "quiz.generate" and its token counts and latency are
+    recorded per document and user.
+
+    The a-prefixed methods are the coroutine versions for the async
+    endpoints. They share the scheduler, breakers, metrics and caches with
+    the blocking methods but wait on the event loop instead of a worker
+    thread.
+    """
+
+    def __init__(self, max_retries: int = LLM_MAX_RETRIES, cache: ResponseCache = None,
+                 context_cache: DocumentContextCache = None, backend=None, usage: UsageRecorder = None,
+                 scheduler: Scheduler = None):
+        self.backend = backend or make_backend()
+        self.usage = usage or usage_recorder
+        self.cache = cache or response_cache
+        if context_cache is None:
+            # Provider-side context caches only exist on the real backend.
+            context_cache = document_context_cache if self.backend.supports_context_cache else DocumentContextCache()
+        self.context_cache = context_cache
+        self.scheduler = scheduler or Scheduler()
+        self.max_retries = max_retries
+        self.metrics = CallMetrics()
+        self._breakers = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+
+    def model(self, name: str = DEFAULT_MODEL):
+        with self._lock:
+            if name not in self._models:
+                self._models[name] = self.backend.model(name)
+            return self._models[name]
+
+
+    def generate(self, prompt, *, task: str, model: str = None, generation_config=None, cache: bool = False,
+                 force_fresh: bool = False, source: str = None, source_id: int = None, user_id: int = None,
+                 document_id: int = None):
+        """With cache=True an identical earlier response is returned instead of
+        calling the model; force_fresh skips the lookup but still refreshes
+        the stored entry.
+
+        `source` is document text the prompt refers to. With a `source_id` it
+        is served from the provider-side context cache when possible,
+        otherwise it is sent inline ahead of the prompt. Usage is attributed
+        to document_id, or source_id when that is not given.
+
+        Without an explicit `model` the task's tier picks the model, and a
+        quota error moves the call to the next tier (see routing)."""
+        models = [model] if model else models_for(task)
+        owner = {"user_id": user_id, "document_id": document_id or source_id}
+        cache_key = self.cache.key(models[0], self._contents(prompt, source), generation_config) if cache else None
+        if cache and not force_fresh:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        response, model_name = self._with_fallback(models, task, lambda model_name, last: self._call(
+            model_name, task, lambda: self._send(
+                model_name, task, prompt, source, source_id, generation_config=generation_config
+            ), owner, cost=self._cost(prompt, source), retry_quota=last))
+        # Fallback answers are not cached, so the next call gives the primary tier another chance.
+        if cache and model_name == models[0] and self._is_cacheable(response.text, generation_config):
+            self.cache.set(cache_key, model_name, task, response.text)
+        return response
+
+
+    async def agenerate(self, prompt, *, task: str, model: str = None, generation_config=None, cache: bool = False,
+                        force_fresh: bool = False, source: str = None, source_id: int = None, user_id: int = None,
+                        document_id: int = None):
+        models = [model] if model else models_for(task)
+        owner = {"user_id": user_id, "document_id": document_id or source_id}
+        cache_key = self.cache.key(models[0], self._contents(prompt, source), generation_config) if cache else None
+        if cache and not force_fresh:
+            cached = await asyncio.to_thread(self.cache.get, cache_key)
+            if cached is not None:
+                return cached
+
+        response, model_name = await self._awith_fallback(models, task, lambda model_name, last: self._acall(
+            model_name, task, lambda: self._asend(
+                model_name, task, prompt, source, source_id, generation_config=generation_config
+            ), owner, cost=self._cost(prompt, source), retry_quota=last))
+        if cache and model_name == models[0] and self._is_cacheable(response.text, generation_config):
+            await asyncio.to_thread(self.cache.set, cache_key, model_name, task, response.text)
+        return response
+
+
+    def stream(self, prompt, *, task: str, model: str = None, generation_config=None, source: str = None,
+               source_id: int = None, user_id: int = None, document_id: int = None):
+        # Retries and slots cover the request up to the first chunk; the rest
+        # of the stream is read without holding a slot. Token counts arrive
+        # with the last chunk, so the scheduler keeps the estimate.
+        models = [model] if model else models_for(task)
+        owner = {"user_id": user_id, "document_id": document_id or source_id}
+        response, model_name = self._with_fallback(models, task, lambda model_name, last: self._call(
+            model_name, task, lambda: self._send(
+                model_name, task, prompt, source, source_id, generation_config=generation_config, stream=True
+            ), owner, tokens=None, cost=self._cost(prompt, source), retry_quota=last))
+        chunk = None
+        for chunk in response:
+            yield chunk
+        prompt_tokens, output_tokens = token_counts(chunk)
+        self.metrics.record(model_name, task, 0.0, prompt_tokens=prompt_tokens, output_tokens=output_tokens, calls=0)
+        self.usage.record(model_name, task, calls=0, prompt_tokens=prompt_tokens, output_tokens=output_tokens, **owner)
+
+
+    def embed(self, content, *, task: str, model: str = EMBEDDING_MODEL, user_id: int = None,
+              document_id: int = None):
+        # Embedding responses carry no usage metadata; tokens are estimated at
+        # four characters each.
+        texts = [content] if isinstance(content, str) else content
+        estimated_tokens = sum(len(text) for text in texts) // 4
+        return self._call(model, task, lambda: self.backend.embed(
+            content, model_name=model, task=task, dimensions=EMBEDDING_DIM
+        ), {"user_id": user_id, "document_id": document_id}, tokens=lambda result: (estimated_tokens, 0),
+            cost=estimated_tokens)
+
+
+    async def aembed(self, content, *, task: str, model: str = EMBEDDING_MODEL, user_id: int = None,
+                     document_id: int = None):
+        texts = [content] if isinstance(content, str) else content
+        estimated_tokens = sum(len(text) for text in texts) // 4
+        return await self._acall(model, task, lambda: self.backend.aembed(
+            content, model_name=model, task=task, dimensions=EMBEDDING_DIM
+        ), {"user_id": user_id, "document_id": document_id}, tokens=lambda result: (estimated_tokens, 0),
+            cost=estimated_tokens)
+
+
+    def count_tokens(self, contents, *, task: str, model: str = None) -> int | None:
+        """Provider token count, or None when the backend cannot count."""
+        model_name = model or DEFAULT_MODEL
+        return self._call(model_name, task, lambda: self.backend.count_tokens(self.model(model_name), contents),
+                          {"user_id": None, "document_id": None}, tokens=None)
+
+
+    def _with_fallback(self, models: list[str], task: str, attempt):
+        """Runs attempt(model_name, is_last) on each model in turn until one
+        is not out of quota; returns the result and the model that gave it."""
+        for i, model_name in enumerate(models):
+            last = i == len(models) - 1
+            try:
+                return attempt(model_name, last), model_name
+            except FALLBACK_ERRORS as e:
+                if last:
+                    raise
+                self._fall_back(task, model_name, models[i + 1], e)
+
+
+    async def _awith_fallback(self, models: list[str], task: str, attempt):
+        for i, model_name in enumerate(models):
+            last = i == len(models) - 1
+            try:
+                return await attempt(model_name, last), model_name
+            except FALLBACK_ERRORS as e:
+                if last:
+                    raise
+                self._fall_back(task, model_name, models[i + 1], e)
+
+
+    def _fall_back(self, task: str, model_name: str, next_model: str, error: Exception):
+        print(f"LLM {task} on {model_name} unavailable ({type(error).__name__}), falling back to {next_model}")
+        self.metrics.record(model_name, task, 0.0, calls=0, fallbacks=1)
+
+
+    def _send(self, model_name: str, task: str, prompt, source: str, source_id: int, **kwargs):
+        if source is not None and source_id is not None:
+            cached_model = self.context_cache.model_for(source_id, model_name, source)
+            if cached_model is not None:
+                # The cached context already carries the source; send only the prompt.
+                return self.backend.generate(cached_model, prompt, model_name=model_name, task=task, **kwargs)
+        return self.backend.generate(self.model(model_name), self._contents(prompt, source),
+                                     model_name=model_name, task=task, **kwargs)
+
+
+    async def _asend(self, model_name: str, task: str, prompt, source: str, source_id: int, **kwargs):
+        if source is not None and source_id is not None:
+            # Creating a provider cache entry is a blocking call.
+            cached_model = await asyncio.to_thread(self.context_cache.model_for, source_id, model_name, source)
+            if cached_model is not None:
+                return await self.backend.agenerate(cached_model, prompt, model_name=model_name, task=task, **kwargs)
+        return await self.backend.agenerate(self.model(model_name), self._contents(prompt, source),
+                                            model_name=model_name, task=task, **kwargs)
+
+
+    def _cost(self, prompt, source: str) -> int:
+        # Four characters per token plus the expected answer; corrected once usage is reported.
+        text = prompt if isinstance(prompt, str) else json.dumps(prompt, default=str)
+        return (len(text) + len(source or "")) // 4 + LLM_EXPECTED_OUTPUT_TOKENS
+
+
+    def _contents(self, prompt, source: str):
+        if source is None:
+            return prompt
+        return [SOURCE_HEADER + source, prompt]
+
+
+    def _is_cacheable(self, text: str, generation_config) -> bool:
+        # Never pin a malformed JSON answer in the cache.
+        if getattr(generation_config, "response_mime_type", None) != "application/json":
+            return bool(text)
+        try:
+            json.loads(text)
+            return True
+        except ValueError:
+            return False
+
+
+    def breaker_states(self) -> dict:
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {name: breaker.state for name, breaker in breakers.items()}
+
+
+    def _call(self, model_name: str, task: str, func, owner: dict, tokens=token_counts, cost: int = 0,
+              retry_quota: bool = True):
+        breaker = self._breaker(model_name)
+        started = time.perf_counter()
+        attempt = 0
+
+        while True:
+            trial = False
+            try:
+                trial = breaker.before_call()
+                with self.scheduler.slot(model_name, task, owner["user_id"], cost) as ticket:
+                    result = func()
+                    counts = self._settle(ticket, result, tokens)
+                breaker.record_success()
+                self._record(model_name, task, started, owner, retries=attempt, tokens=counts)
+                return result
+
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                # With a fallback model waiting, a quota error is handed back at once.
+                if attempt >= self.max_retries or (not retry_quota and isinstance(e, QUOTA_ERRORS)):
+                    self._record(model_name, task, started, owner, error=True, retries=attempt)
+                    raise
+                delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"LLM {task} on {model_name} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+            except Exception:
+                self._record(model_name, task, started, owner, error=True, retries=attempt)
+                raise
+
+            finally:
+                if trial:
+                    breaker.end_trial()
+
+
+    async def _acall(self, model_name: str, task: str, func, owner: dict, tokens=token_counts, cost: int = 0,
+                     retry_quota: bool = True):
+        breaker = self._breaker(model_name)
+        started = time.perf_counter()
+        attempt = 0
+
+        while True:
+            trial = False
+            try:
+                trial = breaker.before_call()
+                async with self.scheduler.aslot(model_name, task, owner["user_id"], cost) as ticket:
+                    result = await func()
+                    counts = self._settle(ticket, result, tokens)
+                breaker.record_success()
+                # A due usage flush writes to Postgres; keep it off the event loop.
+                await asyncio.to_thread(self._record, model_name, task, started, owner, retries=attempt,
+                                        tokens=counts)
+                return result
+
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if attempt >= self.max_retries or (not retry_quota and isinstance(e, QUOTA_ERRORS)):
+                    await asyncio.to_thread(self._record, model_name, task, started, owner, error=True,
+                                            retries=attempt)
+                    raise
+                delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"LLM {task} on {model_name} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+            except Exception:
+                await asyncio.to_thread(self._record, model_name, task, started, owner, error=True, retries=attempt)
+                raise
+
+            finally:
+                if trial:
+                    breaker.end_trial()
+
+
+    def _settle(self, ticket, result, tokens) -> tuple[int, int]:
+        counts = tokens(result) if tokens else (0, 0)
+        if sum(counts):
+            ticket.tokens = sum(counts)
+        return counts
+
+
+    def _record(self, model_name: str, task: str, started: float, owner: dict, error: bool = False,
+                retries: int = 0, tokens: tuple[int, int] = (0, 0)):
+        seconds = time.perf_counter() - started
+        prompt_tokens, output_tokens = tokens
+        self.metrics.record(model_name, task, seconds, error=error, retries=retries,
+                            prompt_tokens=prompt_tokens, output_tokens=output_tokens)
+        self.usage.record(model_name, task, errors=int(error), prompt_tokens=prompt_tokens,
+                          output_tokens=output_tokens, latency_ms=int(seconds * 1000), **owner)
+
+
+    def _breaker(self, model_name: str) -> CircuitBreaker:
+        with self._lock:
+            return self._breakers.setdefault(model_name, CircuitBreaker())
+
+
+gateway = LLMGateway()
@@ -0,0 +1,364 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+import google.generativeai as genai
+import numpy as np
+from google.api_core import exceptions as google_exceptions
+
+from cache import CachedResponse, content_hash
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+LLM_FAKE_LATENCY_MS = float(os.getenv("LLM_FAKE_LATENCY_MS", "0"))
+LLM_FAKE_LATENCY_JITTER_MS = float(os.getenv("LLM_FAKE_LATENCY_JITTER_MS", "0"))
+LLM_FAKE_ERROR_RATE = float(os.getenv("LLM_FAKE_ERROR_RATE", "0"))
+LLM_FAKE_SEED = int(os.getenv("LLM_FAKE_SEED", "0"))
+LLM_RECORD_DIR = os.getenv("LLM_RECORD_DIR", "llm_recordings")
+
+
+class ReplayMissError(Exception):
+    pass
+
+
+class GeminiBackend:
+    """The Gemini API. The key is only needed, and genai only configured,
+    when this backend is built, so the offline backends start without one."""
+
+    supports_context_cache = True
+
+
+    def __init__(self, api_key: str = None):
+        api_key = api_key or os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            raise ValueError("API Key not found! Set GOOGLE_API_KEY in your .env file, or use LLM_BACKEND=fake/replay.")
+        genai.configure(api_key=api_key)
+
+
+    def model(self, name: str):
+        return genai.GenerativeModel(name)
+
+
+    def generate(self, model, contents, *, model_name: str, task: str, **kwargs):
+        return model.generate_content(contents, **kwargs)
+
+
+    async def agenerate(self, model, contents, *, model_name: str, task: str, **kwargs):
+        return await model.generate_content_async(contents, **kwargs)
+
+
+    def embed(self, content, *, model_name: str, task: str, dimensions: int):
+        return genai.embed_content(
+            model=model_name,
+            content=content,
+            output_dimensionality=dimensions
+        )['embedding']
+
+
+    async def aembed(self, content, *, model_name: str, task: str, dimensions: int):
+        return (await genai.embed_content_async(
+            model=model_name,
+            content=content,
+            output_dimensionality=dimensions
+        ))['embedding']
+
+
+    def count_tokens(self, model, contents) -> int:
+        return model.count_tokens(contents).total_tokens
+
+
+# --- Fake backend ---
+
+class FakeBackend:
+    """Deterministic offline backend for load tests. Output depends only on
+    the task and the request contents; latency and injected 429/503 errors
+    are drawn from a seeded generator."""
+
+    supports_context_cache = False
+
+    def __init__(self, latency_ms: float = LLM_FAKE_LATENCY_MS, jitter_ms: float = LLM_FAKE_LATENCY_JITTER_MS,
+                 error_rate: float = LLM_FAKE_ERROR_RATE, seed: int = LLM_FAKE_SEED):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+
+    def model(self, name: str):
+        return name
+
+
+    def generate(self, model, contents, *, model_name: str, task: str, stream: bool = False, **kwargs):
+        self._simulate()
+        return self._response(model_name, task, contents, stream)
+
+
+    async def agenerate(self, model, contents, *, model_name: str, task: str, stream: bool = False, **kwargs):
+        await self._asimulate()
+        return self._response(model_name, task, contents, stream)
+
+
+    def embed(self, content, *, model_name: str, task: str, dimensions: int):
+        self._simulate()
+        return self._embedding(content, dimensions)
+
+
+    async def aembed(self, content, *, model_name: str, task: str, dimensions: int):
+        await self._asimulate()
+        return self._embedding(content, dimensions)
+
+
+    def count_tokens(self, model, contents):
+        return None
+
+
+    def _simulate(self):
+        delay, error = self._draw()
+        time.sleep(delay)
+        if error:
+            raise error("Injected fake backend error")
+
+
+    async def _asimulate(self):
+        delay, error = self._draw()
+        await asyncio.sleep(delay)
+        if error:
+            raise error("Injected fake backend error")
+
+
+    def _draw(self):
+        with self._lock:
+            delay = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            failed = self._random.random() < self.error_rate
+            error = self._random.choice([google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable])
+        return delay, error if failed else None
+
+
+    def _response(self, model_name: str, task: str, contents, stream: bool):
+        text = self._response_text(task, _request_key(model_name, task, contents))
+        if stream:
+            return [CachedResponse(text[i:i + 64]) for i in range(0, len(text), 64)]
+        return CachedResponse(text)
+
+
+    def _embedding(self, content, dimensions: int):
+        if isinstance(content, str):
+            return self._vector(content, dimensions)
+        return [self._vector(text, dimensions) for text in content]
+
+
+    def _vector(self, text: str, dimensions: int) -> list[float]:
+        rng = np.random.default_rng(int(content_hash(text)[:16], 16))
+        vector = rng.standard_normal(dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+    def _response_text(self, task: str, key: str) -> str:
+        rng = random.Random(key)
+        n = rng.randint(1, 99)
+
+        if task == "quiz.generate":
+            return json.dumps(self._quiz(rng, n), ensure_ascii=False)
+
+        if task == "flashcards.generate":
+            return json.dumps(self._flashcards(n), ensure_ascii=False)
+
+        if task == "study_pack.generate":
+            return json.dumps({
+                "quiz": self._quiz(rng, n),
+                "flashcards": self._flashcards(n),
+                "mindmap": self._mindmap(n),
+            }, ensure_ascii=False)
+
+        if task == "tutor.reply":
+            return json.dumps({
+                "status": rng.choice(["correct", "incorrect", "neutral"]),
+                "text": f"Visszajelzés {n}. Következő kérdés?",
+                "is_finish": False,
+            }, ensure_ascii=False)
+
+        if task == "grader.evaluate":
+            return json.dumps({
+                "overall_score": n,
+                "general_feedback": f"Összefoglaló értékelés {n}.",
+                "segments": [
+                    {"segment_text": f"Szakasz {i + 1}.", "status": rng.choice(["correct", "partial", "incorrect"]),
+                     "feedback": f"Megjegyzés {i + 1}."}
+                    for i in range(3)
+                ],
+            }, ensure_ascii=False)
+
+        if task == "study_plan.generate":
+            return json.dumps([
+                {"day": day, "topic": f"Téma {n + day}", "activities": ["Olvasás", "Kvíz", "Tanulókártyák"]}
+                for day in range(1, 4)
+            ], ensure_ascii=False)
+
+        if task == "document.validate":
+            return json.dumps({"is_valid": True, "warning_message": None, "references": [f"Forrás {n}"]},
+                              ensure_ascii=False)
+
+        if task == "document.digest":
+            return json.dumps({
+                "outline": f"* Fő téma {n}\n  * Altéma 1\n  * Altéma 2",
+                "key_terms": [{"term": item["front"], "definition": item["back"]} for item in self._flashcards(n)],
+            }, ensure_ascii=False)
+
+        if task == "mindmap.generate":
+            return self._mindmap(n)
+
+        return f"Fake {task} response {n}."
+
+
+    def _quiz(self, rng: random.Random, n: int) -> list[dict]:
+        questions = []
+        for i in range(10):
+            if i % 2:
+                questions.append({
+                    "question_text": f"Igaz-e a {n + i}. állítás?",
+                    "type": "true_false",
+                    "options": None,
+                    "correct_answer": rng.choice(["Igaz", "Hamis"]),
+                })
+            else:
+                options = [f"Válasz {n + i}{letter}" for letter in "ABCD"]
+                questions.append({
+                    "question_text": f"Melyik a helyes válasz a {n + i}. kérdésre?",
+                    "type": "multiple_choice",
+                    "options": options,
+                    "correct_answer": rng.choice(options),
+                })
+        return questions
+
+
+    def _flashcards(self, n: int) -> list[dict]:
+        return [{"front": f"Fogalom {n + i}", "back": f"Meghatározás {n + i}"} for i in range(10)]
+
+
+    def _mindmap(self, n: int) -> str:
+        return f"graph TD\n    A((Fő téma {n})) --> B(Altéma 1)\n    A --> C(Altéma 2)\n    B --> D([Részlet {n}])"
+
+
+# --- Record / replay ---
+
+class RecordingBackend:
+    """Passes calls through to a real backend and writes every response to
+    directory, keyed by model, task and request contents."""
+
+    supports_context_cache = False
+
+    def __init__(self, inner, directory: str = LLM_RECORD_DIR):
+        self.inner = inner
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+
+    def model(self, name: str):
+        return self.inner.model(name)
+
+
+    def generate(self, model, contents, *, model_name: str, task: str, stream: bool = False, **kwargs):
+        response = self.inner.generate(model, contents, model_name=model_name, task=task, stream=stream, **kwargs)
+        if stream:
+            chunks = [CachedResponse(chunk.text) for chunk in response]
+            text = "".join(chunk.text for chunk in chunks)
+        else:
+            chunks, text = None, response.text
+        _write_recording(self.directory, _request_key(model_name, task, contents, kwargs.get("generation_config")),
+                         {"model": model_name, "task": task, "text": text})
+        return chunks if stream else response
+
+
+    async def agenerate(self, model, contents, *, model_name: str, task: str, **kwargs):
+        response = await self.inner.agenerate(model, contents, model_name=model_name, task=task, **kwargs)
+        _write_recording(self.directory, _request_key(model_name, task, contents, kwargs.get("generation_config")),
+                         {"model": model_name, "task": task, "text": response.text})
+        return response
+
+
+    def embed(self, content, *, model_name: str, task: str, dimensions: int):
+        embedding = self.inner.embed(content, model_name=model_name, task=task, dimensions=dimensions)
+        _write_recording(self.directory, _request_key(model_name, task, content, dimensions),
+                         {"model": model_name, "task": task, "embedding": embedding})
+        return embedding
+
+
+    async def aembed(self, content, *, model_name: str, task: str, dimensions: int):
+        embedding = await self.inner.aembed(content, model_name=model_name, task=task, dimensions=dimensions)
+        _write_recording(self.directory, _request_key(model_name, task, content, dimensions),
+                         {"model": model_name, "task": task, "embedding": embedding})
+        return embedding
+
+
+    def count_tokens(self, model, contents) -> int:
+        return self.inner.count_tokens(model, contents)
+
+
+class ReplayBackend:
+    """Serves responses captured by RecordingBackend; a request that was
+    never recorded raises ReplayMissError."""
+
+    supports_context_cache = False
+
+    def __init__(self, directory: str = LLM_RECORD_DIR):
+        self.directory = directory
+
+
+    def model(self, name: str):
+        return name
+
+
+    def generate(self, model, contents, *, model_name: str, task: str, stream: bool = False, **kwargs):
+        text = self._read(_request_key(model_name, task, contents, kwargs.get("generation_config")))["text"]
+        return [CachedResponse(text)] if stream else CachedResponse(text)
+
+
+    async def agenerate(self, model, contents, *, model_name: str, task: str, **kwargs):
+        return self.generate(model, contents, model_name=model_name, task=task, **kwargs)
+
+
+    def embed(self, content, *, model_name: str, task: str, dimensions: int):
+        return self._read(_request_key(model_name, task, content, dimensions))["embedding"]
+
+
+    async def aembed(self, content, *, model_name: str, task: str, dimensions: int):
+        return self.embed(content, model_name=model_name, task=task, dimensions=dimensions)
+
+
+    def count_tokens(self, model, contents):
+        return None
+
+
+    def _read(self, key: str) -> dict:
+        try:
+            with open(os.path.join(self.directory, f"{key}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise ReplayMissError(f"No recorded response for {key}")
+
+
+def _request_key(model_name: str, task: str, contents, extra=None) -> str:
+    return content_hash(json.dumps([model_name, task, contents, extra], sort_keys=True, default=str))
+
+
+def _write_recording(directory: str, key: str, data: dict):
+    path = os.path.join(directory, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def make_backend(name: str = LLM_BACKEND):
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "fake":
+        return FakeBackend()
+    if name == "record":
+        return RecordingBackend(GeminiBackend())
+    if name == "replay":
+        return ReplayBackend()
+    raise ValueError(f"Unknown LLM backend: {name}")
@@ -1,16 +1,28 @@
 import os
-import fitz
-import google.generativeai as genai
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Form, status
+import asyncio
+import json
+import tempfile
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, UploadFile, File, Depends, HTTPException, Form, Query, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 from dotenv import load_dotenv
+import async_services
 import auth
 import database
 import schemas
 import services
+import ingestion
+from cache import content_cache, response_cache, semantic_answer_cache
+from extraction import pdf_extractor
+from llm import gateway as llm
+from scheduler import render_scheduler_metrics
+from singleflight import single_flight
+from uploads import MAX_UPLOAD_BYTES, save_upload, upload_too_large
+from usage import render_prometheus, usage_recorder
 from database import engine
 import models
 from typing import List
@@ -18,14 +30,8 @@ from pydantic import BaseModel
 
 load_dotenv()
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-
-if not GOOGLE_API_KEY:
-    raise ValueError("API Key not found! Check your .env file.")
-
-genai.configure(api_key=GOOGLE_API_KEY)
-
-model = genai.GenerativeModel('gemini-2.5-flash')
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "100"))
+CHAT_PAGE_MAX = 500
 
 try:
     with engine.connect() as connection:
@@ -35,9 +41,33 @@ try:
 except Exception as e:
     print(f"--- Database Connection Failed: {e} ---")
 
-app = FastAPI()
 doc_service = services.DocumentService()
 user_service = services.UserService()
+ingestion_service = ingestion.IngestionService(doc_service)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ingestion_service.resume_pending_jobs()
+    yield
+    ingestion_service.shutdown()
+    pdf_extractor.shutdown()
+    usage_recorder.flush()
+    await database.async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def reject_oversized_requests(request: Request, call_next):
+    # Reject before the multipart body is read; the form overhead gets 1 MB of slack.
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + 1024 * 1024:
+        error = upload_too_large()
+        return JSONResponse(status_code=error.status_code, content={"detail": error.detail})
+    return await call_next(request)
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -45,20 +75,25 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
-def extract_text_from_pdf(file_bytes):
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    text_content = ""
-    for page in doc:
-        text_content += page.get_text()
-    return text_content
-
-
 class ScoreSubmission(BaseModel):
     score: int
 
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # --- Auth Endpoints ---
 
 @app.post("/register")
@@ -86,7 +121,7 @@ ALLOWED_MIME_TYPES = [
     "application/vnd.openxmlformats-officedocument.presentationml.presentation"
 ]
 
-@app.post("/upload")
+@app.post("/upload", status_code=status.HTTP_202_ACCEPTED)
 async def upload_file(
         file: UploadFile = File(...),
         category: str = Form(None),
@@ -101,46 +136,60 @@ async def upload_file(
             detail=f"Invalid file type. Allowed: PDF, DOCX, PPTX. Got: {file.content_type}"
         )
 
-    file_bytes = await file.read()
-    try:
-        content = doc_service.extract_text(file_bytes, file.filename)
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        print(f"Extraction error: {e}")
-        raise HTTPException(status_code=500, detail="Failed to process file content")
+    job_id, file_path = ingestion_service.new_upload_path(file.filename)
+    await save_upload(file, file_path)
 
-    references = []
+    job = ingestion_service.create_job(db, job_id, file_path, file.filename, current_user.id, category, study_focus, force_upload)
+    ingestion_service.submit(job.id)
+    return {"job_id": job.id, "status": job.status}
 
-    if not force_upload:
-        validation_result = doc_service.validate_content(content)
 
-        if not validation_result.get("is_valid", True):
-            warning = validation_result.get("warning_message", "A dokumentum tartalma megkérdőjelezhető.")
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail=f"VALIDATION_FAILED: {warning}"
-            )
+@app.get("/jobs/{job_id}", response_model=schemas.IngestionJobResponse)
+def get_ingestion_job(
+        job_id: str,
+        db: Session = Depends(database.get_db),
+        current_user: models.User = Depends(auth.get_current_user)
+):
+    job = ingestion_service.get_job(db, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
-        if validation_result.get("warning_message"):
-            print(f"Upload proceeded with warning: {validation_result['warning_message']}")
 
-        references = validation_result.get("references", [])
+@app.get("/cache/stats")
+def get_cache_stats():
+    return {
+        **content_cache.stats.snapshot(),
+        **semantic_answer_cache.stats.snapshot(),
+        **response_cache.stats.snapshot(),
+    }
 
-    summary = doc_service.generate_summary(content, references=references, study_focus=study_focus)
-    doc = doc_service.save_document(db, file.filename, content, summary, current_user.id, category, study_focus)
-    cross_ref_note = doc_service.find_cross_references(db, doc.id, content, current_user.id)
 
-    if study_focus:
-        print(f"--- Auto generating Study Plan for {study_focus} ---")
-        plan_service = services.StudyPlanService(db)
-        plan_service.generate_study_plan(doc.id, current_user.id)
+@app.get("/llm/stats")
+def get_llm_stats():
+    return {
+        "backend": type(llm.backend).__name__,
+        "calls": llm.metrics.snapshot(),
+        "circuits": llm.breaker_states(),
+        "scheduler": llm.scheduler.snapshot(),
+        "single_flight": single_flight.snapshot(),
+    }
+
 
-    if cross_ref_note:
-        doc.summary += cross_ref_note
-        db.commit()
+@app.get("/metrics")
+def get_metrics():
+    content = render_prometheus(llm.metrics.snapshot()) + render_scheduler_metrics(llm.scheduler.snapshot())
+    return Response(content=content, media_type="text/plain; version=0.0.4")
 
-    return doc
+
+@app.get("/usage")
+def get_usage(
+        days: int = 30,
+        db: Session = Depends(database.get_db),
+        current_user: models.User = Depends(auth.get_current_user)
+):
+    usage_recorder.flush()
+    return usage_recorder.report(db, current_user.id, days=days)
 
 
 @app.get("/documents", response_model=List[schemas.DocumentResponse])
@@ -165,13 +214,14 @@ def delete_document(
 # --- Quiz Endpoints ---
 
 @app.post("/documents/{doc_id}/quizzes")
-def create_quiz(
+async def create_quiz(
         doc_id: int,
-        db: Session = Depends(database.get_db),
+        fresh: bool = False,
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    quiz_service = services.QuizService(db)
-    quiz = quiz_service.generate_quiz(doc_id, current_user.id)
+    quiz_service = async_services.AsyncQuizService(db)
+    quiz = await quiz_service.generate_quiz(doc_id, current_user.id, force_fresh=fresh)
     if not quiz:
         raise HTTPException(status_code=500, detail="Failed to generate quiz")
     return {"quiz_id": quiz.id}
@@ -214,13 +264,14 @@ def submit_quiz_score(
 # --- Flashcard Endpoints ---
 
 @app.post("/documents/{doc_id}/flashcards")
-def create_flashcards(
+async def create_flashcards(
         doc_id: int,
-        db: Session = Depends(database.get_db),
+        fresh: bool = False,
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.QuizService(db)
-    set_id = service.generate_flashcards(doc_id, current_user.id)
+    service = async_services.AsyncQuizService(db)
+    set_id = await service.generate_flashcards(doc_id, current_user.id, force_fresh=fresh)
     if not set_id:
         raise HTTPException(status_code=500, detail="Failed to generate flashcards")
     return {"set_id": set_id}
@@ -247,13 +298,14 @@ def get_flashcard(
 # --- Mind Map Endpoints ---
 
 @app.post("/documents/{doc_id}/mindmaps", response_model=schemas.MindMapResponse)
-def create_mindmap(
+async def create_mindmap(
         doc_id: int,
-        db: Session = Depends(database.get_db),
+        fresh: bool = False,
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.MindMapService(db)
-    existing = service.get_mindmap_by_doc(doc_id, current_user.id)
+    service = async_services.AsyncMindMapService(db)
+    existing = None if fresh else await service.get_mindmap_by_doc(doc_id, current_user.id)
     if existing:
         return {
             "id": existing.id,
@@ -263,7 +315,7 @@ def create_mindmap(
             "document_id": existing.document_id
         }
 
-    mindmap = service.generate_mindmap(doc_id, current_user.id)
+    mindmap = await service.generate_mindmap(doc_id, current_user.id, force_fresh=fresh)
     if not mindmap:
         raise HTTPException(status_code=500, detail="Failed to generate mindmap")
     return {
@@ -300,58 +352,140 @@ def get_mindmap_by_id(
         "document_id": mmap.document.id,
     }
 
+# --- Study Pack Endpoints ---
+
+@app.post("/documents/{doc_id}/study-pack", response_model=schemas.StudyPackResponse)
+async def create_study_pack(
+        doc_id: int,
+        fresh: bool = False,
+        db: AsyncSession = Depends(database.get_async_db),
+        current_user: models.User = Depends(auth.get_current_user)
+):
+    service = async_services.AsyncStudyPackService(db)
+    pack = await service.generate_study_pack(doc_id, current_user.id, force_fresh=fresh)
+    if not pack:
+        raise HTTPException(status_code=500, detail="Failed to generate study pack")
+
+    quiz, flashcard_set, mindmap = pack
+    return {
+        "quiz_id": quiz.id,
+        "set_id": flashcard_set.id,
+        "mindmap": {
+            "id": mindmap.id,
+            "mermaid_script": mindmap.mermaid_script,
+            "created_at": mindmap.created_at,
+            "document_filename": mindmap.document.filename,
+            "document_id": mindmap.document_id,
+        },
+    }
+
 # --- Chat Endpoints ---
 
 @app.post("/documents/{doc_id}/chat")
-def chat_with_document(
+async def chat_with_document(
         doc_id: int,
         chat_req: schemas.ChatRequest,
-        db: Session = Depends(database.get_db),
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.ChatService(db)
-    answer = service.ask_document(doc_id, chat_req.question)
+    service = async_services.AsyncChatService(db, user_id=current_user.id)
+    answer = await service.ask_document(doc_id, chat_req.question)
     return {"answer": answer}
 
+@app.post("/documents/{doc_id}/chat/stream")
+def stream_chat_with_document(
+        doc_id: int,
+        chat_req: schemas.ChatRequest,
+        db: Session = Depends(database.get_db),
+        current_user: models.User = Depends(auth.get_current_user)
+):
+    doc = db.query(models.Document).filter(
+        models.Document.id == doc_id,
+        models.Document.owner_id == current_user.id
+    ).first()
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    # The stream outlives the request-scoped session, so it opens its own.
+    def events():
+        with database.SessionLocal() as stream_db:
+            try:
+                for token in services.ChatService(stream_db, user_id=current_user.id).stream_answer(doc_id, chat_req.question):
+                    yield sse_event("token", {"text": token})
+                yield sse_event("done", {})
+            except Exception as e:
+                print(f"Chat stream error: {e}")
+                yield sse_event("error", {"detail": "Failed to generate answer"})
+
+    return sse_response(events())
+
+
 @app.get("/documents/{doc_id}/chat", response_model=List[schemas.ChatMessageResponse])
 def get_chat_history(
         doc_id: int,
+        response: Response,
         mode: str = 'chat',
+        limit: int = Query(CHAT_PAGE_SIZE, ge=1, le=CHAT_PAGE_MAX),
+        before: str | None = None,
         db: Session = Depends(database.get_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.ChatService(db)
-    return service.get_chat_history(doc_id, mode=mode)
+    """The newest `limit` messages, oldest first. When older messages exist
+    the X-Next-Cursor header holds the `before` value for the next page."""
+    try:
+        cursor = services.parse_chat_cursor(before) if before else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    service = services.ChatService(db, user_id=current_user.id)
+    # One extra row tells whether an older page exists.
+    messages = service.get_chat_history(doc_id, mode=mode, limit=limit + 1, before=cursor)
+    if len(messages) > limit:
+        messages = messages[1:]
+        response.headers["X-Next-Cursor"] = services.chat_cursor(messages[0])
+    return messages
 
 
 @app.post("/documents/{doc_id}/tutor/start")
-def start_tutor(
+async def start_tutor(
         doc_id: int,
-        db: Session = Depends(database.get_db),
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.ChatService(db)
+    service = async_services.AsyncChatService(db, user_id=current_user.id)
 
-    doc = db.query(models.Document).filter(
-        models.Document.id == doc_id,
-        models.Document.owner_id == current_user.id
-    )
+    doc = await db.run_sync(services.get_document, doc_id, current_user.id)
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    question = service.start_socratic_session(doc_id)
+    question = await service.start_socratic_session(doc_id)
     return {"message": question}
 
 
 @app.post("/documents/{doc_id}/tutor/reply")
-def reply_tutor(
+async def reply_tutor(
         doc_id: int,
         chat_req: schemas.ChatRequest,
-        db: Session = Depends(database.get_db),
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.ChatService(db)
+    service = async_services.AsyncChatService(db, user_id=current_user.id)
 
+    doc = await db.run_sync(services.get_document, doc_id, current_user.id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    response_dict = await service.handle_tutor_response(doc_id, chat_req.question)
+    return response_dict
+
+
+@app.post("/documents/{doc_id}/tutor/reply/stream")
+def stream_reply_tutor(
+        doc_id: int,
+        chat_req: schemas.ChatRequest,
+        db: Session = Depends(database.get_db),
+        current_user: models.User = Depends(auth.get_current_user)
+):
     doc = db.query(models.Document).filter(
         models.Document.id == doc_id,
         models.Document.owner_id == current_user.id
@@ -359,8 +493,19 @@ def reply_tutor(
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    response_dict = service.handle_tutor_response(doc_id, chat_req.question)
-    return response_dict
+    def events():
+        with database.SessionLocal() as stream_db:
+            try:
+                for item in services.ChatService(stream_db, user_id=current_user.id).stream_tutor_response(doc_id, chat_req.question):
+                    if isinstance(item, dict):
+                        yield sse_event("done", item)
+                    else:
+                        yield sse_event("token", {"text": item})
+            except Exception as e:
+                print(f"Tutor stream error: {e}")
+                yield sse_event("error", {"detail": "Failed to generate answer"})
+
+    return sse_response(events())
 
 
 @app.delete("/documents/{doc_id}/tutor/reset")
@@ -369,7 +514,7 @@ def reset_tutor(
         db: Session = Depends(database.get_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.ChatService(db)
+    service = services.ChatService(db, user_id=current_user.id)
     doc = db.query(models.Document).filter(
         models.Document.id == doc_id,
         models.Document.owner_id == current_user.id
@@ -457,21 +602,24 @@ def get_audios(
 async def grade_essay_file(
         doc_id: int,
         file: UploadFile = File(...),
-        db: Session = Depends(database.get_db),
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
     if file.content_type not in ALLOWED_MIME_TYPES:
         raise HTTPException(status_code=400, detail="Invalid file type")
 
-    file_bytes = await file.read()
-    try:
-        essay_content = doc_service.extract_text(file_bytes, file.filename)
+    ext = file.filename.split('.')[-1].lower()
+    with tempfile.TemporaryDirectory(dir=ingestion.UPLOAD_DIR) as tmp_dir:
+        file_path = os.path.join(tmp_dir, f"essay.{ext}")
+        await save_upload(file, file_path)
+        try:
+            essay_content = await asyncio.to_thread(doc_service.extract_text, file_path, file.filename)
 
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Text extraction failed: {str(e)}")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Text extraction failed: {str(e)}")
 
-    grader_service = services.GraderService(db)
-    result = grader_service.evaluate_essay(doc_id, current_user.id, essay_content)
+    grader_service = async_services.AsyncGraderService(db)
+    result = await grader_service.evaluate_essay(doc_id, current_user.id, essay_content)
 
     if not result:
         raise HTTPException(status_code=500, detail="Failed to grade essay")
@@ -487,23 +635,20 @@ async def grade_essay_file(
 
 
 @app.post("/documents/{doc_id}/essay/grade", response_model=schemas.EssayGradeResponse)
-def grade_essay(
+async def grade_essay(
         doc_id: int,
         submission: schemas.EssaySubmitRequest,
-        db: Session = Depends(database.get_db),
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    grader_service = services.GraderService(db)
+    grader_service = async_services.AsyncGraderService(db)
 
-    doc = db.query(models.Document).filter(
-        models.Document.id == doc_id,
-        models.Document.owner_id == current_user.id
-    ).first()
+    doc = await db.run_sync(services.get_document, doc_id, current_user.id)
 
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    result = grader_service.evaluate_essay(doc_id, current_user.id, submission.essay_text)
+    result = await grader_service.evaluate_essay(doc_id, current_user.id, submission.essay_text)
 
     if not result:
         raise HTTPException(status_code=500, detail="Failed to grade essay. AI error.")
@@ -565,13 +710,14 @@ def get_essay_detail(
 # --- Study Plan endpoints ---
 
 @app.post("/documents/{doc_id}/plan", response_model=schemas.StudyPlanResponse)
-def create_study_plan(
+async def create_study_plan(
         doc_id: int,
-        db: Session = Depends(database.get_db),
+        fresh: bool = False,
+        db: AsyncSession = Depends(database.get_async_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    service = services.StudyPlanService(db)
-    plan = service.generate_study_plan(doc_id, current_user.id)
+    service = async_services.AsyncStudyPlanService(db)
+    plan = await service.generate_study_plan(doc_id, current_user.id, force_fresh=fresh)
 
     if not plan:
         raise HTTPException(status_code=500, detail="Failed to generate study plan")
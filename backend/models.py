@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Date, DateTime, ForeignKey, Boolean, JSON, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from pgvector.sqlalchemy import Vector
@@ -30,7 +30,7 @@ class Document(Base):
     study_focus = Column(String, nullable=True)
     google_drive_id = Column(String, nullable=True)
 
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
     owner = relationship("User", back_populates="documents")
     quizzes = relationship("Quiz", back_populates="document", cascade="all, delete-orphan")
     chunks = relationship("DocumentChunk", back_populates="document", cascade="all, delete-orphan")
@@ -39,6 +39,9 @@ class Document(Base):
     mind_maps = relationship("MindMap", back_populates="document", cascade="all, delete-orphan")
     essays = relationship("EssaySubmission", back_populates="document", cascade="all, delete-orphan")
     study_plan = relationship("StudyPlan", back_populates="document", uselist=False, cascade="all, delete-orphan")
+    digest = relationship("DocumentDigest", back_populates="document", uselist=False, cascade="all, delete-orphan")
+    tutor_session = relationship("TutorSession", back_populates="document", uselist=False,
+                                 cascade="all, delete-orphan")
 
 
 class EssaySubmission(Base):
@@ -76,6 +79,12 @@ class ChatMessage(Base):
 
     document = relationship("Document", back_populates="messages")
 
+    __table_args__ = (
+        # History is read per document newest first, paged on (created_at, id). A mode spans
+        # several roles, so role is filtered on the scan; a role column would break the order.
+        Index("ix_chat_messages_document_created_id", "document_id", "created_at", "id"),
+    )
+
 
 class Quiz(Base):
     __tablename__ = "quizzes"
@@ -113,13 +122,23 @@ class DocumentChunk(Base):
     __tablename__ = "document_chunks"
 
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id"))
+    document_id = Column(Integer, ForeignKey("documents.id"), index=True)
     chunk_index = Column(Integer)
     content = Column(Text, nullable=False)
     embedding = Column(Vector(768))
 
     document = relationship("Document", back_populates="chunks")
 
+    __table_args__ = (
+        Index(
+            "ix_document_chunks_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
+    )
+
 
 class FlashcardSet(Base):
     __tablename__ = "flashcard_sets"
@@ -143,6 +162,33 @@ class Flashcard(Base):
     flashcard_set = relationship("FlashcardSet", back_populates="cards")
 
 
+class DocumentDigest(Base):
+    __tablename__ = "document_digests"
+
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), primary_key=True)
+    outline = Column(Text, nullable=False)
+    key_terms = Column(JSON, nullable=False)
+    section_summaries = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    document = relationship("Document", back_populates="digest")
+
+
+class TutorSession(Base):
+    """Per-document tutor state that keeps each turn's prompt the same size:
+    the anchor chunks the session is about, and a rolling summary of every
+    message up to summarized_through."""
+    __tablename__ = "tutor_sessions"
+
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), primary_key=True)
+    anchor_chunk_ids = Column(JSON, nullable=True)
+    summary = Column(Text, nullable=False, default="")
+    summarized_through = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    document = relationship("Document", back_populates="tutor_session")
+
+
 class MindMap(Base):
     __tablename__ = "mind_maps"
 
@@ -162,4 +208,81 @@ class StudyPlan(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     plan_json = Column(JSON, nullable=False)
 
-    document = relationship("Document", back_populates="study_plan")
\ No newline at end of file
+    document = relationship("Document", back_populates="study_plan")
+
+
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+
+    id = Column(String, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="SET NULL"), nullable=True)
+
+    filename = Column(String, nullable=False)
+    file_path = Column(String, nullable=False)
+    category = Column(String, nullable=True)
+    study_focus = Column(String, nullable=True)
+    force_upload = Column(Boolean, default=False)
+
+    status = Column(String, nullable=False, default="queued")
+    stage = Column(String, nullable=True)
+    stages = Column(JSON, nullable=False, default=dict)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    @property
+    def progress(self):
+        if not self.stages:
+            return 0.0
+        finished = [state for state in self.stages.values() if state in ("done", "skipped")]
+        return round(len(finished) / len(self.stages), 2)
+
+
+
+class ContentCacheEntry(Base):
+    __tablename__ = "content_cache"
+
+    key = Column(String, primary_key=True)
+    kind = Column(String, nullable=False, index=True)
+    value = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class EmbeddingCacheEntry(Base):
+    __tablename__ = "embedding_cache"
+
+    text_hash = Column(String, primary_key=True)
+    embedding = Column(Vector(768), nullable=False)
+
+
+class ResponseCacheEntry(Base):
+    __tablename__ = "response_cache"
+
+    key = Column(String, primary_key=True)
+    model = Column(String, nullable=False)
+    task = Column(String, nullable=True)
+    response_text = Column(Text, nullable=False)
+    size_bytes = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_used_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+class LLMUsage(Base):
+    """Model usage rolled up per day, user, document, task and model. The
+    document id is kept without a foreign key so cost history survives
+    document deletion."""
+    __tablename__ = "llm_usage"
+
+    key = Column(String, primary_key=True)
+    day = Column(Date, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)
+    document_id = Column(Integer, nullable=True)
+    task = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    calls = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    output_tokens = Column(BigInteger, nullable=False, default=0)
+    latency_ms = Column(BigInteger, nullable=False, default=0)
@@ -0,0 +1,171 @@
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from cache import content_hash
+from llm import gateway as llm
+
+# local: regex estimate only; provider: ask the model API, falling back to the estimate.
+PROMPT_TOKEN_COUNTER = os.getenv("PROMPT_TOKEN_COUNTER", "local")
+PROMPT_COUNT_CACHE_SIZE = int(os.getenv("PROMPT_COUNT_CACHE_SIZE", "4096"))
+
+# Whole-prompt token budgets per task; PROMPT_BUDGET_<TASK> overrides, e.g. PROMPT_BUDGET_QUIZ_GENERATE.
+# document.source is the one budget every generator's document source is fitted to, so
+# the fitted text, and the provider context cache keyed on it, is shared across tasks.
+DEFAULT_BUDGETS = {
+    "document.source": 9000,
+    "document.summary": 16000,
+    "document.validate": 5000,
+    "document.cross_reference": 2500,
+    "document.cross_reference_query": 1500,
+    "chat.answer": 4000,
+    "tutor.reply": 6000,
+    "tutor.summary": 3000,
+}
+DEFAULT_BUDGET = 8000
+
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def budget_for(task: str) -> int:
+    env_name = "PROMPT_BUDGET_" + re.sub(r"\W", "_", task).upper()
+    return int(os.getenv(env_name, DEFAULT_BUDGETS.get(task, DEFAULT_BUDGET)))
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly one token per 3.5 characters of a word and one per punctuation mark;
+    # long Hungarian compounds split into several tokens.
+    return sum(max(1, math.ceil(len(piece) / 3.5)) for piece in WORD_PATTERN.findall(text))
+
+
+class TokenCounter:
+    """Token counts from the provider when configured, otherwise the local
+    estimate, with an LRU cache keyed by content hash so it holds counts
+    rather than the texts. A failed provider count falls back to the
+    estimate uncached, so the provider is asked again next time."""
+
+    def __init__(self, mode: str = PROMPT_TOKEN_COUNTER, max_entries: int = PROMPT_COUNT_CACHE_SIZE):
+        self.mode = mode
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()
+
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+
+        key = content_hash(text)
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+
+        if self.mode == "provider":
+            try:
+                tokens = llm.count_tokens(text, task="prompt.count_tokens")
+            except Exception as e:
+                print(f"Token count error, using estimate: {e}")
+                tokens = None
+            if tokens is None:
+                return estimate_tokens(text)
+        else:
+            tokens = estimate_tokens(text)
+
+        with self._lock:
+            self._counts[key] = tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return tokens
+
+
+token_counter = TokenCounter()
+
+
+def count_tokens(text: str) -> int:
+    return token_counter.count(text)
+
+
+def fit_text(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """Longest prefix of text (suffix with keep_end), cut at a word
+    boundary, within max_tokens."""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+
+    # The search uses the local estimate, scaled to agree with the counter on the full text.
+    target = max_tokens * estimate_tokens(text) / tokens
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[len(text) - middle:] if keep_end else text[:middle]) <= target:
+            low = middle
+        else:
+            high = middle - 1
+
+    if keep_end:
+        kept = text[len(text) - low:]
+        space = kept.find(" ")
+        return kept[space + 1:] if 0 <= space < low * 0.1 else kept
+    cut = text.rfind(" ", 0, low)
+    return text[:cut if cut > low * 0.9 else low]
+
+
+class PromptBuilder:
+    """Fits named prompt sections into a task's token budget.
+
+    Sections are filled in priority order (0 first): instructions, then
+    retrieved or source context, then history. A section gets what it
+    needs while budget remains and is cut at a word boundary when it runs
+    out; every cut is logged. History sections added with keep_end lose
+    their oldest part first.
+    """
+
+    def __init__(self, task: str, budget: int = None):
+        self.task = task
+        self.budget = budget if budget is not None else budget_for(task)
+        self.sections = []
+
+
+    def add(self, name: str, text: str, priority: int = 0, keep_end: bool = False):
+        self.sections.append((name, text or "", priority, keep_end))
+        return self
+
+
+    def build(self) -> dict[str, str]:
+        remaining = self.budget
+        fitted = {}
+        for name, text, _, keep_end in sorted(self.sections, key=lambda section: section[2]):
+            tokens = count_tokens(text)
+            if tokens <= remaining:
+                fitted[name] = text
+                remaining -= tokens
+                continue
+
+            fitted[name] = fit_text(text, remaining, keep_end=keep_end)
+            kept = count_tokens(fitted[name])
+            print(f"Prompt budget {self.task}: cut '{name}' from {tokens} to {kept} tokens "
+                  f"({tokens - kept} dropped, budget {self.budget})")
+            remaining = max(0, remaining - kept)
+        return fitted
+
+
+    def render(self, template: str) -> str:
+        """Fills the {name} placeholders of template with the fitted sections.
+        The rest of the template counts as instructions and is never cut."""
+        fixed = template
+        for name, *_ in self.sections:
+            fixed = fixed.replace("{" + name + "}", "")
+        self.sections.append(("__template__", fixed, -1, False))
+        try:
+            fitted = self.build()
+        finally:
+            self.sections.pop()
+
+        for name, *_ in self.sections:
+            template = template.replace("{" + name + "}", fitted[name])
+        return template
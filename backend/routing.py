@@ -0,0 +1,58 @@
+import json
+import os
+
+from google.api_core import exceptions as google_exceptions
+
+DEFAULT_MODEL = os.getenv("LLM_DEFAULT_MODEL", "gemini-2.5-flash")
+
+# Tier -> model; LLM_MODEL_TIERS overrides as JSON, e.g. {"pro": "gemini-2.5-flash"} to cap spend.
+MODEL_TIERS = {
+    "lite": "gemini-2.5-flash-lite",
+    "standard": DEFAULT_MODEL,
+    "pro": "gemini-2.5-pro",
+    **json.loads(os.getenv("LLM_MODEL_TIERS", "{}")),
+}
+
+# Task -> tier. Keys match task names exactly, except keys ending in "." which
+# match every task under that prefix, the longest one winning; anything unlisted
+# runs on standard. LLM_TASK_TIERS overrides as JSON, e.g. {"tutor.": "standard"}.
+DEFAULT_TASK_TIERS = {
+    "document.validate": "lite",
+    "document.cross_reference": "lite",
+    "tutor.reply": "lite",
+    "tutor.summary": "lite",
+    "document.summary": "pro",
+    "document.summary_section": "standard",
+    "document.summary_reduce": "standard",
+    "grader.evaluate": "pro",
+}
+TASK_TIERS = {**DEFAULT_TASK_TIERS, **json.loads(os.getenv("LLM_TASK_TIERS", "{}"))}
+
+# Tiers tried in order when a model is out of quota; LLM_TIER_FALLBACKS overrides as JSON.
+TIER_FALLBACKS = {
+    "lite": ["standard"],
+    "standard": ["lite"],
+    "pro": ["standard"],
+    **json.loads(os.getenv("LLM_TIER_FALLBACKS", "{}")),
+}
+
+# Quota errors move a call to the next tier at once instead of backing off on the same model.
+QUOTA_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)
+
+
+def tier_for(task: str) -> str:
+    if task in TASK_TIERS:
+        return TASK_TIERS[task]
+    matches = [prefix for prefix in TASK_TIERS if prefix.endswith(".") and task.startswith(prefix)]
+    return TASK_TIERS[max(matches, key=len)] if matches else "standard"
+
+
+def models_for(task: str) -> list[str]:
+    """Primary model for task, then its fallbacks without repeats."""
+    tier = tier_for(task)
+    models = []
+    for name in [tier, *TIER_FALLBACKS.get(tier, [])]:
+        model = MODEL_TIERS[name]
+        if model not in models:
+            models.append(model)
+    return models
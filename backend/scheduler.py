@@ -0,0 +1,353 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+LLM_MAX_IN_FLIGHT_PER_MODEL = int(os.getenv("LLM_MAX_IN_FLIGHT_PER_MODEL", "8"))
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "1000"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "1000000"))
+# Per-model quota overrides as JSON, e.g. {"gemini-2.5-pro": [150, 2000000]} for [rpm, tpm].
+LLM_RATE_LIMITS = json.loads(os.getenv("LLM_RATE_LIMITS", "{}"))
+# Fair-share weights per user id as JSON, e.g. {"42": 2}; everyone else weighs 1.
+LLM_USER_WEIGHTS = json.loads(os.getenv("LLM_USER_WEIGHTS", "{}"))
+LLM_SCHEDULER_MAX_WAIT = float(os.getenv("LLM_SCHEDULER_MAX_WAIT", "120"))
+LLM_SCHEDULER_AGING_SECONDS = float(os.getenv("LLM_SCHEDULER_AGING_SECONDS", "30"))
+
+INTERACTIVE, STANDARD, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", STANDARD: "standard", BACKGROUND: "background"}
+
+# Longest matching task prefix wins; LLM_TASK_PRIORITIES overrides with names, e.g. {"grader.": "standard"}.
+DEFAULT_TASK_PRIORITIES = {
+    "chat.": INTERACTIVE,
+    "tutor.": INTERACTIVE,
+    "quiz.": STANDARD,
+    "flashcards.": STANDARD,
+    "mindmap.": STANDARD,
+    "study_pack.": STANDARD,
+    "prompt.": STANDARD,
+    "document.": BACKGROUND,
+    "study_plan.": BACKGROUND,
+    "grader.": BACKGROUND,
+}
+TASK_PRIORITIES = {
+    **DEFAULT_TASK_PRIORITIES,
+    **{task: {name: level for level, name in PRIORITY_NAMES.items()}[name]
+       for task, name in json.loads(os.getenv("LLM_TASK_PRIORITIES", "{}")).items()},
+}
+
+
+class SchedulerTimeoutError(Exception):
+    pass
+
+
+def priority_for(task: str) -> int:
+    matches = [prefix for prefix in TASK_PRIORITIES if task.startswith(prefix)]
+    return TASK_PRIORITIES[max(matches, key=len)] if matches else STANDARD
+
+
+class TokenBucket:
+    """Holds up to capacity tokens, refilled evenly over a minute. The level
+    may go negative when a call turns out to cost more than estimated."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+    def seconds_until(self, amount: float) -> float:
+        return max(0.0, (amount - self.tokens) / self.rate) if self.rate else float("inf")
+
+
+class Ticket:
+    """One queued or running call. Set `tokens` to the actual usage before
+    the slot is released so the TPM bucket is corrected."""
+
+    def __init__(self, model: str, priority: int, user_id, cost: int, finish: float, seq: int):
+        self.model = model
+        self.priority = priority
+        self.user_id = user_id
+        self.cost = cost
+        self.finish = finish
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.tokens = None
+        self.wake = None
+
+
+class _ModelState:
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.in_flight = 0
+        self.waiting = []
+        self.virtual_time = {}
+        self.last_finish = {}
+
+
+class Scheduler:
+    """Admits model calls within each model's requests-per-minute and
+    tokens-per-minute quota and the in-flight caps.
+
+    Waiting calls are served by priority class (interactive, standard,
+    background); a call is promoted one class for every aging_seconds it
+    waits, so bulk work is delayed but never starved. Within a class,
+    users share the quota by weighted fair queueing: each call gets a
+    finish tag of max(virtual time, the user's previous tag) + cost /
+    weight, and the smallest tag goes first. One user's ten uploads
+    therefore queue behind each other, not in front of everyone else.
+    Threads and coroutines wait in the same queues.
+    """
+
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, max_in_flight_per_model: int = LLM_MAX_IN_FLIGHT_PER_MODEL,
+                 rpm: int = LLM_RPM_LIMIT, tpm: int = LLM_TPM_LIMIT, limits: dict = None, weights: dict = None,
+                 max_wait: float = LLM_SCHEDULER_MAX_WAIT, aging_seconds: float = LLM_SCHEDULER_AGING_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_model = max_in_flight_per_model
+        self.rpm = rpm
+        self.tpm = tpm
+        self.limits = LLM_RATE_LIMITS if limits is None else limits
+        self.weights = {str(user): float(weight) for user, weight in (LLM_USER_WEIGHTS if weights is None else weights).items()}
+        self.max_wait = max_wait
+        self.aging_seconds = aging_seconds
+        self._lock = threading.Lock()
+        self._models = {}
+        self._in_flight = 0
+        self._seq = itertools.count()
+        self._stats = {}
+
+
+    # --- Blocking and coroutine entry points ---
+
+    @contextmanager
+    def slot(self, model: str, task: str, user_id=None, cost: int = 0):
+        ticket = self.acquire(model, task, user_id, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+
+    @asynccontextmanager
+    async def aslot(self, model: str, task: str, user_id=None, cost: int = 0):
+        ticket = await self.aacquire(model, task, user_id, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+
+    def acquire(self, model: str, task: str, user_id=None, cost: int = 0) -> Ticket:
+        event = threading.Event()
+        ticket = self._enqueue(model, task, user_id, cost, event.set)
+        deadline = ticket.enqueued_at + self.max_wait
+        while True:
+            with self._lock:
+                delay = self._dispatch(time.monotonic())
+                if ticket.granted:
+                    return ticket
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._abandon(ticket)
+                raise SchedulerTimeoutError(f"No {model} capacity within {self.max_wait:.0f}s")
+            if event.wait(min(remaining, delay)):
+                return ticket
+
+
+    async def aacquire(self, model: str, task: str, user_id=None, cost: int = 0) -> Ticket:
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._enqueue(model, task, user_id, cost, wake)
+        deadline = ticket.enqueued_at + self.max_wait
+        try:
+            while True:
+                with self._lock:
+                    delay = self._dispatch(time.monotonic())
+                    if ticket.granted:
+                        return ticket
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SchedulerTimeoutError(f"No {model} capacity within {self.max_wait:.0f}s")
+                done, _ = await asyncio.wait({granted}, timeout=min(remaining, delay))
+                if done:
+                    return ticket
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            state = self._models[ticket.model]
+            state.in_flight -= 1
+            self._in_flight -= 1
+            if ticket.tokens is not None:
+                state.tokens.tokens += ticket.cost - ticket.tokens
+            self._dispatch(time.monotonic())
+
+
+    # --- Queue ---
+
+    def _enqueue(self, model: str, task: str, user_id, cost: int, wake) -> Ticket:
+        priority = priority_for(task)
+        with self._lock:
+            state = self._state(model)
+            cost = min(max(0, int(cost)), state.tokens.capacity)
+            flow = (priority, user_id)
+            start = max(state.virtual_time.get(priority, 0.0), state.last_finish.get(flow, 0.0))
+            finish = start + max(1, cost) / self.weights.get(str(user_id), 1.0)
+            state.last_finish[flow] = finish
+
+            ticket = Ticket(model, priority, user_id, cost, finish, next(self._seq))
+            ticket.wake = wake
+            state.waiting.append(ticket)
+            self._stat(model, priority)["waiting"] += 1
+            return ticket
+
+
+    def _abandon(self, ticket: Ticket):
+        with self._lock:
+            if ticket.granted:
+                # Granted while giving up: hand the slot straight back.
+                state = self._models[ticket.model]
+                state.in_flight -= 1
+                self._in_flight -= 1
+                self._dispatch(time.monotonic())
+                return
+            self._models[ticket.model].waiting.remove(ticket)
+            stat = self._stat(ticket.model, ticket.priority)
+            stat["waiting"] -= 1
+            stat["timeouts"] += 1
+
+
+    def _dispatch(self, now: float) -> float:
+        """Grants every call that fits, best first. Returns how long until a
+        blocked call could fit by quota alone; callers wait at most that long
+        before dispatching again. Must hold the lock."""
+        delay = 1.0
+        while self._in_flight < self.max_in_flight:
+            heads = []
+            for state in self._models.values():
+                if state.waiting and state.in_flight < self.max_in_flight_per_model:
+                    state.requests.refill(now)
+                    state.tokens.refill(now)
+                    heads.append((min(state.waiting, key=lambda ticket: self._order(ticket, now)), state))
+            if not heads:
+                break
+
+            granted = False
+            for ticket, state in sorted(heads, key=lambda head: self._order(head[0], now)):
+                wait = max(state.requests.seconds_until(1), state.tokens.seconds_until(ticket.cost))
+                if wait > 0:
+                    delay = min(delay, wait)
+                    continue
+                self._grant(ticket, state, now)
+                granted = True
+                break
+            if not granted:
+                break
+        return max(delay, 0.01)
+
+
+    def _grant(self, ticket: Ticket, state: _ModelState, now: float):
+        state.waiting.remove(ticket)
+        state.requests.tokens -= 1
+        state.tokens.tokens -= ticket.cost
+        state.in_flight += 1
+        self._in_flight += 1
+        state.virtual_time[ticket.priority] = max(state.virtual_time.get(ticket.priority, 0.0), ticket.finish)
+        if len(state.last_finish) > 1000:
+            # A flow whose tag is behind its class clock would restart from the clock anyway.
+            state.last_finish = {flow: finish for flow, finish in state.last_finish.items()
+                                 if finish > state.virtual_time.get(flow[0], 0.0)}
+
+        waited = now - ticket.enqueued_at
+        stat = self._stat(ticket.model, ticket.priority)
+        stat["waiting"] -= 1
+        stat["granted"] += 1
+        stat["wait_seconds_total"] += waited
+        stat["wait_seconds_max"] = max(stat["wait_seconds_max"], waited)
+        ticket.granted = True
+        ticket.wake()
+
+
+    def _order(self, ticket: Ticket, now: float) -> tuple:
+        promoted = int((now - ticket.enqueued_at) / self.aging_seconds) if self.aging_seconds else 0
+        return max(INTERACTIVE, ticket.priority - promoted), ticket.finish, ticket.seq
+
+
+    def _state(self, model: str) -> _ModelState:
+        if model not in self._models:
+            rpm, tpm = self.limits.get(model, (self.rpm, self.tpm))
+            self._models[model] = _ModelState(rpm, tpm)
+        return self._models[model]
+
+
+    def _stat(self, model: str, priority: int) -> dict:
+        return self._stats.setdefault((model, priority), {
+            "waiting": 0, "granted": 0, "timeouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0,
+        })
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            for state in self._models.values():
+                state.requests.refill(now)
+                state.tokens.refill(now)
+            return {
+                "in_flight": self._in_flight,
+                "models": {
+                    model: {
+                        "in_flight": state.in_flight,
+                        "requests_available": round(state.requests.tokens, 1),
+                        "tokens_available": round(state.tokens.tokens),
+                    }
+                    for model, state in self._models.items()
+                },
+                "queues": [
+                    {
+                        "model": model,
+                        "priority": PRIORITY_NAMES[priority],
+                        **stat,
+                        "avg_wait_seconds": round(stat["wait_seconds_total"] / stat["granted"], 3) if stat["granted"] else 0.0,
+                    }
+                    for (model, priority), stat in self._stats.items()
+                ],
+            }
+
+
+# --- Prometheus exposition ---
+
+SCHEDULER_METRICS = (
+    ("llm_queue_depth", "gauge", "Model calls waiting for quota or a slot.", "waiting"),
+    ("llm_queue_granted_total", "counter", "Model calls admitted by the scheduler.", "granted"),
+    ("llm_queue_timeouts_total", "counter", "Model calls that gave up waiting.", "timeouts"),
+    ("llm_queue_wait_seconds_sum", "counter", "Total time admitted calls spent queued.", "wait_seconds_total"),
+    ("llm_queue_wait_seconds_max", "gauge", "Longest queue wait since start.", "wait_seconds_max"),
+)
+
+
+def render_scheduler_metrics(snapshot: dict) -> str:
+    lines = []
+    for name, kind, help_text, field in SCHEDULER_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for entry in snapshot["queues"]:
+            lines.append(f'{name}{{model="{entry["model"]}",priority="{entry["priority"]}"}} {entry[field]}')
+    return "\n".join(lines) + "\n"
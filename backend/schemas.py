@@ -1,7 +1,7 @@
 from pydantic import BaseModel, ConfigDict
 from pydantic.alias_generators import to_camel
 from datetime import datetime
-from typing import List, Literal
+from typing import List, Literal, Dict
 
 class DocumentBase(BaseModel):
     filename: str
@@ -40,8 +40,10 @@ class ChatResponse(BaseModel):
 
 
 class ChatMessageResponse(BaseModel):
+    id: int
     role: str
     content: str
+    created_at: datetime | None = None
 
 
 class Flashcard(BaseModel):
@@ -70,6 +72,12 @@ class MindMapResponse(BaseModel):
         from_attributes = True
 
 
+class StudyPackResponse(BaseModel):
+    quiz_id: int
+    set_id: int
+    mindmap: MindMapResponse
+
+
 class EssaySubmitRequest(BaseModel):
     essay_text: str
 
@@ -123,4 +131,20 @@ class StudyPlanListResponse(BaseModel):
 
 
 class StudyPlanUpdate(BaseModel):
-    plan_json: List[dict]
\ No newline at end of file
+    plan_json: List[dict]
+
+
+class IngestionJobResponse(BaseModel):
+    id: str
+    filename: str
+    status: str
+    stage: str | None = None
+    stages: Dict[str, str]
+    progress: float
+    error: str | None = None
+    document_id: int | None = None
+    created_at: datetime
+    updated_at: datetime | None = None
+
+    class Config:
+        from_attributes = True
@@ -1,7 +1,9 @@
+import base64
 import io
+from datetime import datetime
 import re
-import fitz
-import google.generativeai as genai
+import threading
+import time
 from gtts import gTTS
 from sqlalchemy.orm import Session, joinedload
 import models
@@ -11,45 +13,316 @@ from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
 from google.auth.transport.requests import Request
 import json
+import numpy as np
 from google.generativeai.types import GenerationConfig
 from docx import Document as DocxDocument
 from pptx import Presentation
-from sqlalchemy import text as sql_text
+from sqlalchemy import text as sql_text, insert, func, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Iterable, Iterator
+from cache import ContentCache, content_cache, content_hash, file_hash, semantic_answer_cache
+from context_cache import document_context_cache
+from extraction import pdf_extractor
+from llm import gateway as llm, EMBEDDING_MODEL
+from prompts import PromptBuilder, budget_for, count_tokens, fit_text
+from singleflight import single_flight
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))
+EMBEDDING_BATCH_CHARS = int(os.getenv("EMBEDDING_BATCH_CHARS", "60000"))
+EMBEDDING_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))
+
+SUMMARY_SECTION_CHARS = int(os.getenv("SUMMARY_SECTION_CHARS", "30000"))
+SUMMARY_REDUCE_CHARS = int(os.getenv("SUMMARY_REDUCE_CHARS", "40000"))
+SUMMARY_MAX_WORKERS = int(os.getenv("SUMMARY_MAX_WORKERS", "4"))
+
+# auto: use the digest when the raw text would be cut; digest / raw force one or the other.
+DIGEST_SOURCE_MODE = os.getenv("DIGEST_SOURCE_MODE", "auto")
+# Shorter documents fit the source budget as they are, so they get no digest.
+DIGEST_MIN_CHARS = int(os.getenv("DIGEST_MIN_CHARS", "30000"))
+
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "40"))
+VECTOR_PROBES = int(os.getenv("VECTOR_PROBES", "10"))
+# The chunk HNSW index is global, so a document filter only applies to the ef_search
+# candidates it returns; a small document would get few or no chunks back. Documents
+# up to VECTOR_EXACT_MAX_CHUNKS are scanned exactly through the document_id index,
+# larger ones use the index with an iterative scan (pgvector 0.8+; "off" for older).
+VECTOR_EXACT_MAX_CHUNKS = int(os.getenv("VECTOR_EXACT_MAX_CHUNKS", "5000"))
+VECTOR_ITERATIVE_SCAN = os.getenv("VECTOR_ITERATIVE_SCAN", "relaxed_order")
+
+# Tutor turns carry anchor chunks picked from the opening question, chunks retrieved for
+# the current answer and the recent messages; older messages are folded into a summary
+# once more than TUTOR_SUMMARY_BATCH of them have dropped out of the recent window.
+TUTOR_ANCHOR_CHUNKS = int(os.getenv("TUTOR_ANCHOR_CHUNKS", "3"))
+TUTOR_RETRIEVED_CHUNKS = int(os.getenv("TUTOR_RETRIEVED_CHUNKS", "3"))
+TUTOR_RECENT_MESSAGES = int(os.getenv("TUTOR_RECENT_MESSAGES", "4"))
+TUTOR_SUMMARY_BATCH = int(os.getenv("TUTOR_SUMMARY_BATCH", "2"))
+# The session ends with a report once this many tutor messages exist.
+TUTOR_SESSION_MESSAGES = 10
+# Unsummarized tutor messages read per turn; older ones are left out of the summary.
+TUTOR_HISTORY_WINDOW = int(os.getenv("TUTOR_HISTORY_WINDOW", "20"))
+
+CHAT_ROLES = {"chat": ['ai', 'user'], "tutor": ['tutor_ai', 'tutor_user']}
+
+# The materialized CTE keeps the planner off the ANN index: the document's chunks are
+# read through the btree and sorted by exact distance.
+EXACT_NEAREST_CHUNKS = sql_text("""
+    WITH doc_chunks AS MATERIALIZED (
+        SELECT id, content, embedding
+        FROM document_chunks
+        WHERE document_id = :doc_id AND id <> ALL(CAST(:exclude AS integer[]))
+    )
+    SELECT id, content
+    FROM doc_chunks
+    ORDER BY embedding <=> CAST(:embedding AS vector)
+    LIMIT :limit
+""")
+
+# relaxed_order may return candidates slightly out of order; the outer sort fixes that.
+INDEXED_NEAREST_CHUNKS = sql_text("""
+    WITH candidates AS MATERIALIZED (
+        SELECT id, content, embedding <=> CAST(:embedding AS vector) AS distance
+        FROM document_chunks
+        WHERE document_id = :doc_id AND id <> ALL(CAST(:exclude AS integer[]))
+        ORDER BY embedding <=> CAST(:embedding AS vector)
+        LIMIT :limit
+    )
+    SELECT id, content
+    FROM candidates
+    ORDER BY distance
+""")
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+def raise_if_cancelled(cancelled: threading.Event = None):
+    if cancelled is not None and cancelled.is_set():
+        raise OperationCancelled("Cancelled")
+
+
+class TextStream:
+    """Extracted text parts handed from the extracting thread to a single
+    consumer as they arrive. Iterating blocks for the next part, stops when
+    the producer closes the stream and raises OperationCancelled when
+    extraction failed or cancelled is set."""
+
+    def __init__(self, cancelled: threading.Event = None):
+        self.cancelled = cancelled
+        self._parts = deque()
+        self._closed = False
+        self._error = None
+        self._changed = threading.Condition()
+
+
+    def put(self, part: str):
+        with self._changed:
+            self._parts.append(part)
+            self._changed.notify_all()
+
+
+    def close(self, error: Exception = None):
+        with self._changed:
+            self._closed = True
+            self._error = error
+            self._changed.notify_all()
+
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            with self._changed:
+                while not self._parts and not self._closed:
+                    raise_if_cancelled(self.cancelled)
+                    self._changed.wait(0.5)
+                if self._parts:
+                    part = self._parts.popleft()
+                elif self._error is not None:
+                    raise OperationCancelled(f"Text extraction failed: {self._error}") from self._error
+                else:
+                    return
+            yield part
+
+
+def set_vector_search_params(db: Session, ef_search: int = None, probes: int = None):
+    # Transaction-local, so it must run in the same transaction as the search query.
+    db.execute(sql_text("SELECT set_config('hnsw.ef_search', :ef_search, true), set_config('ivfflat.probes', :probes, true)"), {
+        "ef_search": str(int(ef_search or VECTOR_EF_SEARCH)),
+        "probes": str(int(probes or VECTOR_PROBES)),
+    })
+    if VECTOR_ITERATIVE_SCAN != "off":
+        db.execute(sql_text("SELECT set_config('hnsw.iterative_scan', :mode, true)"), {"mode": VECTOR_ITERATIVE_SCAN})
+
+
+def nearest_chunks(db: Session, doc_id: int, embedding: list, limit: int, exclude: list[int] = (),
+                   ef_search: int = None) -> list:
+    """(id, content) of the chunks of one document nearest to embedding,
+    nearest first, skipping the ids in exclude."""
+    chunk_count = db.query(func.count(models.DocumentChunk.id)).filter(
+        models.DocumentChunk.document_id == doc_id
+    ).scalar()
+    if chunk_count <= VECTOR_EXACT_MAX_CHUNKS:
+        query = EXACT_NEAREST_CHUNKS
+    else:
+        set_vector_search_params(db, ef_search=ef_search)
+        query = INDEXED_NEAREST_CHUNKS
+    return db.execute(query, {
+        "doc_id": doc_id, "embedding": str(embedding), "limit": limit, "exclude": list(exclude)
+    }).fetchall()
+
+
+def get_document(db: Session, doc_id: int, user_id: int = None) -> models.Document | None:
+    """Document with its digest loaded, so document_source needs no further
+    query; user_id restricts the lookup to that owner."""
+    query = db.query(models.Document).options(joinedload(models.Document.digest)).filter(models.Document.id == doc_id)
+    if user_id is not None:
+        query = query.filter(models.Document.owner_id == user_id)
+    return query.first()
+
+
+# Newest generated result per feature, for single-flight coalescing.
+
+def latest_quiz(db: Session, document_id: int, user_id: int) -> models.Quiz | None:
+    return db.query(models.Quiz).filter(
+        models.Quiz.document_id == document_id,
+        models.Quiz.owner_id == user_id
+    ).order_by(models.Quiz.id.desc()).first()
+
+
+def latest_flashcard_set(db: Session, document_id: int, user_id: int) -> models.FlashcardSet | None:
+    return db.query(models.FlashcardSet).join(models.Document).filter(
+        models.FlashcardSet.document_id == document_id,
+        models.Document.owner_id == user_id
+    ).order_by(models.FlashcardSet.id.desc()).first()
+
+
+def latest_flashcard_set_id(db: Session, document_id: int, user_id: int) -> int | None:
+    flashcard_set = latest_flashcard_set(db, document_id, user_id)
+    return flashcard_set.id if flashcard_set else None
+
+
+def latest_mindmap(db: Session, document_id: int, user_id: int) -> models.MindMap | None:
+    return db.query(models.MindMap).options(joinedload(models.MindMap.document)).join(models.Document).filter(
+        models.MindMap.document_id == document_id,
+        models.Document.owner_id == user_id
+    ).order_by(models.MindMap.id.desc()).first()
+
+
+def latest_study_pack(db: Session, document_id: int, user_id: int):
+    pack = (latest_quiz(db, document_id, user_id), latest_flashcard_set(db, document_id, user_id),
+            latest_mindmap(db, document_id, user_id))
+    return pack if all(pack) else None
+
+
+def latest_study_plan(db: Session, document_id: int, user_id: int) -> models.StudyPlan | None:
+    # The plan row is updated in place, so reload it rather than trust the identity map.
+    return db.query(models.StudyPlan).populate_existing().join(models.Document).filter(
+        models.StudyPlan.document_id == document_id,
+        models.Document.owner_id == user_id
+    ).first()
+
+
+def study_pack_version(pack) -> tuple:
+    return tuple(item.id for item in pack)
+
+
+def study_plan_version(plan: models.StudyPlan) -> str:
+    return json.dumps(plan.plan_json, sort_keys=True)
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+def chat_cursor(message: models.ChatMessage) -> str:
+    """Opaque cursor for the page of messages older than message."""
+    return base64.urlsafe_b64encode(f"{message.created_at.isoformat()}|{message.id}".encode()).decode()
+
+
+def parse_chat_cursor(cursor: str) -> tuple:
+    """(created_at, id) from a chat_cursor; raises ValueError when malformed."""
+    created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(created_at), int(message_id)
+
+
+def document_source(doc: models.Document) -> str:
+    """Source material for doc, fitted to the shared document.source budget.
+    Every generator gets the same text, so they all reuse one provider
+    context cache per document."""
+    budget = budget_for("document.source")
+    digest = doc.digest
+    use_digest = digest is not None and (
+        DIGEST_SOURCE_MODE == "digest" or (DIGEST_SOURCE_MODE == "auto" and count_tokens(doc.content) > budget)
+    )
+    source = render_digest(digest, budget) if use_digest else doc.content
+    return PromptBuilder("document.source", budget).add("source", source, priority=1).build()["source"]
+
+
+def render_digest(digest: models.DocumentDigest, max_tokens: int) -> str:
+    terms = "\n".join(f"* {item['term']}: {item['definition']}" for item in digest.key_terms)
+    header = f"Outline:\n{digest.outline}\n\nKey terms:\n{terms}\n\nSection summaries:\n"
+
+    # Every section gets an equal share of what is left, so late chapters are not dropped.
+    sections = digest.section_summaries or []
+    share = max(0, max_tokens - count_tokens(header)) // max(1, len(sections))
+    return header + "\n\n".join(f"[{i + 1}] {fit_text(summary, share)}" for i, summary in enumerate(sections))
 
 # --- Document services ---
 
 class DocumentService:
-    def __init__(self):
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
-        self.embedding_model = "models/gemini-embedding-001"
+    def __init__(self, cache: ContentCache = None):
+        self.embedding_model = EMBEDDING_MODEL
+        self.cache = cache or content_cache
+
+    def extract_text(self, source: str | bytes, filename: str, stream: TextStream = None) -> str:
+        """Text of the file. With a stream, every page is also put on it as
+        soon as it is extracted, so chunking and embedding can start before
+        the whole document is parsed; the stream is closed either way."""
+        try:
+            ext = filename.split('.')[-1].lower()
+            source_hash = file_hash(source) if isinstance(source, str) else content_hash(source)
+            cache_key = f"{ext}:{source_hash}"
+            cached = self.cache.get("extract", cache_key)
+            if cached is not None:
+                if stream:
+                    stream.put(cached)
+                    stream.close()
+                return cached
+
+            parts = []
+            for part in self.iter_text(source, filename):
+                parts.append(part)
+                if stream:
+                    stream.put(part)
+            text = "".join(parts)
+        except Exception as e:
+            if stream:
+                stream.close(e)
+            raise
+        if stream:
+            stream.close()
+
+        self.cache.set("extract", cache_key, text)
+        return text
 
-    def extract_text(self, file_bytes: bytes, filename: str) -> str:
+
+    def iter_text(self, source: str | bytes, filename: str) -> Iterator[str]:
+        # source is either a file path or the raw file bytes.
         ext = filename.split('.')[-1].lower()
         if ext == 'pdf':
-            return self._extract_from_pdf(file_bytes)
+            return pdf_extractor.iter_pages(source)
         elif ext == 'docx':
-            return self._extract_from_docx(file_bytes)
+            return iter([self._extract_from_docx(source)])
         elif ext == 'pptx':
-            return self._extract_from_pptx(file_bytes)
+            return iter([self._extract_from_pptx(source)])
         else:
             raise ValueError(f"Unsupported file type: {ext}")
 
 
-    def _extract_from_pdf(self, file_bytes: bytes):
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        return "".join([page.get_text() for page in doc])
-
-
-    def _extract_from_docx(self, file_bytes: bytes):
-        cod = DocxDocument(io.BytesIO(file_bytes))
+    def _extract_from_docx(self, source: str | bytes):
+        cod = DocxDocument(io.BytesIO(source) if isinstance(source, bytes) else source)
         return "\n".join([para.text for para in cod.paragraphs])
 
 
-    def _extract_from_pptx(self, file_bytes: bytes):
-        prs = Presentation(io.BytesIO(file_bytes))
+    def _extract_from_pptx(self, source: str | bytes):
+        prs = Presentation(io.BytesIO(source) if isinstance(source, bytes) else source)
         text_content = []
 
         for slide in prs.slides:
@@ -60,10 +333,16 @@ class DocumentService:
         return "\n".join(text_content)
 
 
-    def generate_summary(self, text: str, references: list[str] = None, study_focus: str = None) -> str:
-        ref_text = ""
-        if references:
-            ref_text = "\n\n### 📚 Ajálott irodalom & Források\n" + "\n".join([f"* {ref}" for ref in references])
+    def generate_summary(self, text: str, references: list[str] = None, study_focus: str = None, user_id: int = None,
+                         cancelled: threading.Event = None) -> str:
+        """cancelled is checked before every model call; once set the
+        summary stops with OperationCancelled."""
+        ref_text = self.format_references(references)
+
+        cache_key = content_hash(f"{study_focus or ''}\n{text}")
+        cached = self.cache.get("summary", cache_key)
+        if cached is not None:
+            return cached + ref_text
 
         if study_focus:
             instruction = f"""
@@ -78,10 +357,10 @@ class DocumentService:
         else:
             instruction = "Analyze the following document. Output the summary explicitly in HUNGARIAN."
 
-        prompt = f"""
+        template = f"""
         {instruction}
         Structure it for a student.
-        Text content (partial): {text[:50000]}
+        {{content_label}}: {{content}}
         
         IMPORTANT FORMATTING RULES:
         1. Do NOT use code blocks (```) for the text.
@@ -89,16 +368,194 @@ class DocumentService:
         3. Do NOT indent nested bullet points with more than 2 spaces.
         4. Use bolding (**text**) for key terms.
         """
+
         try:
-            response = self.model.generate_content(prompt)
+            # Documents over the summary budget are summarized section by
+            # section and reduced, so nothing past the budget is dropped.
+            content_label, content = "Text content", text
+            if count_tokens(text) > budget_for("document.summary") - count_tokens(template):
+                reduced = self._reduce_summaries(self.summarize_sections(text, study_focus, user_id, cancelled), user_id,
+                                                 cancelled)
+                if reduced:
+                    content_label, content = "Section summaries of the full document", reduced
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            print(f"Section summary error, falling back to the document start: {e}")
+            content_label, content = "Text content", text
+
+        prompt = PromptBuilder("document.summary").add("content_label", content_label).add(
+            "content", content, priority=1
+        ).render(template)
+        raise_if_cancelled(cancelled)
+        try:
+            response = llm.generate(prompt, task="document.summary", user_id=user_id)
             summary = response.text
+            self.cache.set("summary", cache_key, summary)
             return summary + ref_text
         except Exception as e:
             print(f"AI Error: {e}")
             return "Hiba történt az összefoglaló generálása közben."
 
 
-    def save_document(self, db: Session, filename: str, content: str, summary: str, user_id: int, category: str = None, study_focus: str = None):
+    def summarize_sections(self, text: str, study_focus: str = None, user_id: int = None,
+                           cancelled: threading.Event = None) -> list[str]:
+        cache_key = content_hash(f"{study_focus or ''}\n{text}")
+        cached = self.cache.get("sections", cache_key)
+        if cached is not None:
+            return cached
+
+        sections = self._split_sections(text, SUMMARY_SECTION_CHARS)
+        with ThreadPoolExecutor(max_workers=min(SUMMARY_MAX_WORKERS, len(sections))) as pool:
+            summaries = pool.map(
+                lambda item: self._summarize_section(item[0], len(sections), item[1], study_focus, user_id, cancelled),
+                enumerate(sections)
+            )
+            summaries = [summary for summary in summaries if summary]
+
+        self.cache.set("sections", cache_key, summaries)
+        return summaries
+
+
+    def build_digest(self, db: Session, doc_id: int, text: str, user_id: int = None) -> models.DocumentDigest | None:
+        """Section summaries, outline and key terms, built once at ingestion
+        and used by the generators in place of a raw text prefix. Returns None
+        for documents shorter than DIGEST_MIN_CHARS."""
+        if len(text) < DIGEST_MIN_CHARS:
+            return None
+
+        cache_key = content_hash(text)
+        data = self.cache.get("digest", cache_key)
+        if data is None:
+            data = self._digest_data(text, doc_id, user_id)
+            self.cache.set("digest", cache_key, data)
+
+        digest = db.get(models.DocumentDigest, doc_id) or models.DocumentDigest(document_id=doc_id)
+        digest.outline = data["outline"]
+        digest.key_terms = data["key_terms"]
+        digest.section_summaries = data["section_summaries"]
+        db.add(digest)
+        db.commit()
+        return digest
+
+
+    def _digest_data(self, text: str, doc_id: int, user_id: int = None) -> dict:
+        section_summaries = self.summarize_sections(text, user_id=user_id)
+        overview = self._reduce_summaries(list(section_summaries), user_id)
+
+        prompt = f"""
+        Below are summaries of every section of a document, in order.
+        Build a study digest in HUNGARIAN.
+
+        Output JSON format ONLY:
+        {{
+            "outline": "Nested bullet list (*) of the document's chapters and main topics, at most 3 levels",
+            "key_terms": [{{ "term": "Key term", "definition": "One-sentence definition" }}]
+        }}
+        List at most 30 key terms, the most important ones first.
+
+        Section summaries:
+        {overview}
+        """
+
+        config = GenerationConfig(response_mime_type="application/json")
+        response = llm.generate(prompt, task="document.digest", generation_config=config, user_id=user_id,
+                                document_id=doc_id)
+        data = json.loads(response.text)
+        return {
+            "outline": data.get("outline", ""),
+            "key_terms": [item for item in data.get("key_terms", []) if item.get("term")],
+            "section_summaries": list(section_summaries),
+        }
+
+
+    def _summarize_section(self, index: int, total: int, section: str, study_focus: str = None, user_id: int = None,
+                           cancelled: threading.Event = None) -> str:
+        raise_if_cancelled(cancelled)
+        focus_rule = ""
+        if study_focus:
+            focus_rule = f'Only cover content related to "{study_focus}". If this section has none, output nothing.'
+
+        prompt = f"""
+        Summarize section {index + 1} of {total} of a longer document for a student, in HUNGARIAN.
+        Keep key terms, definitions, names, dates and formulas. Use bullet points (*).
+        {focus_rule}
+
+        Section:
+        {section}
+        """
+        return llm.generate(prompt, task="document.summary_section", user_id=user_id).text.strip()
+
+
+    def _reduce_summaries(self, summaries: list[str], user_id: int = None, cancelled: threading.Event = None) -> str:
+        # Groups hold at least two summaries, so every level at least halves the count.
+        while len(summaries) > 1 and sum(len(summary) for summary in summaries) > SUMMARY_REDUCE_CHARS:
+            raise_if_cancelled(cancelled)
+            groups = list(self._group_summaries(summaries, SUMMARY_REDUCE_CHARS))
+            with ThreadPoolExecutor(max_workers=min(SUMMARY_MAX_WORKERS, len(groups))) as pool:
+                summaries = list(pool.map(lambda group: self._merge_summaries(group, user_id), groups))
+        return "\n\n".join(summaries)
+
+
+    def _merge_summaries(self, summaries: list[str], user_id: int = None) -> str:
+        if len(summaries) == 1:
+            return summaries[0]
+
+        joined = "\n\n".join(summaries)
+        prompt = f"""
+        Merge these summaries of consecutive document sections into one shorter summary, in HUNGARIAN.
+        Keep the original order, the key terms and the most important facts. Use bullet points (*).
+
+        Summaries:
+        {joined}
+        """
+        return llm.generate(prompt, task="document.summary_reduce", user_id=user_id).text.strip()
+
+
+    def _group_summaries(self, summaries: list[str], max_chars: int):
+        group, group_chars = [], 0
+        for summary in summaries:
+            if len(group) >= 2 and group_chars + len(summary) > max_chars:
+                yield group
+                group, group_chars = [], 0
+            group.append(summary)
+            group_chars += len(summary)
+
+        if group:
+            yield group
+
+
+    def _split_sections(self, text: str, max_chars: int) -> list[str]:
+        # Sections end on paragraph breaks; a paragraph longer than max_chars is cut.
+        sections, current = [], ""
+        for paragraph in re.split(r"\n\s*\n", text):
+            while len(paragraph) > max_chars:
+                if current:
+                    sections.append(current)
+                    current = ""
+                sections.append(paragraph[:max_chars])
+                paragraph = paragraph[max_chars:]
+            if current and len(current) + len(paragraph) + 2 > max_chars:
+                sections.append(current)
+                current = ""
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+
+        if current.strip():
+            sections.append(current)
+        return sections
+
+
+    def format_references(self, references: list[str] = None) -> str:
+        if not references:
+            return ""
+        return "\n\n### 📚 Ajálott irodalom & Források\n" + "\n".join([f"* {ref}" for ref in references])
+
+
+    def save_document(self, db: Session, filename: str, content: str, summary: str, user_id: int, category: str = None,
+                      study_focus: str = None, before_commit=None, embedded: dict = None):
+        """Saves the document and its chunks in one transaction. before_commit(db, doc)
+        runs inside it and may raise to abandon the save. embedded is the result
+        of embed_chunks, when the chunks were already embedded."""
         new_doc = models.Document(
             filename=filename,
             content=content,
@@ -108,37 +565,144 @@ class DocumentService:
             study_focus=study_focus
         )
         db.add(new_doc)
+        db.flush()
+
+        stats = self.ingest_chunks(db, new_doc.id, content, commit=False, embedded=embedded, user_id=user_id)
+        if before_commit:
+            before_commit(db, new_doc)
         db.commit()
         db.refresh(new_doc)
+        print(
+            f"--- Ingested {stats['chunks']} chunks in {stats['batches']} embedding batches "
+            f"(embed: {stats['embed_seconds']:.2f}s, insert: {stats['insert_seconds']:.2f}s) ---"
+        )
+        return new_doc
+
 
+    def embed_chunks(self, parts: Iterable[str], cancelled: threading.Event = None, user_id: int = None,
+                     document_id: int = None) -> dict:
+        """Embeddings of the chunks of the text made of parts, in order, with
+        the batch count and the seconds spent embedding; the chunks are the
+        ones _chunk_text would cut. parts may be a TextStream,
+        so a round of EMBEDDING_MAX_WORKERS batches goes out as soon as the
+        pages for it are extracted. cancelled is checked before each round,
+        so a rejected upload stops spending quota. user_id and document_id
+        are recorded against every embedding call."""
+        round_size = EMBEDDING_BATCH_SIZE * EMBEDDING_MAX_WORKERS
+        result = {"vectors": [], "batches": 0, "embed_seconds": 0.0}
+
+        def embed_round(chunks: list[str]):
+            raise_if_cancelled(cancelled)
+            started = time.perf_counter()
+            vectors, batch_count = self._get_embeddings(chunks, user_id, document_id)
+            result["vectors"].extend(vectors)
+            result["batches"] += batch_count
+            result["embed_seconds"] += time.perf_counter() - started
+
+        pending = []
+        for chunk in self._iter_chunks(parts):
+            pending.append(chunk)
+            if len(pending) == round_size:
+                embed_round(pending)
+                pending = []
+        if pending:
+            embed_round(pending)
+        return result
+
+
+    def ingest_chunks(self, db: Session, doc_id: int, content: str, commit: bool = True, embedded: dict = None,
+                      user_id: int = None) -> dict:
         chunks = self._chunk_text(content)
-        for idx, chunk_text in enumerate(chunks):
-            vector = self._get_embedding(chunk_text)
-
-            db_chunk = models.DocumentChunk(
-                document_id=new_doc.id,
-                chunk_index=idx,
-                content=chunk_text,
-                embedding=vector,
+
+        if embedded is None:
+            embedded = self.embed_chunks([content], user_id=user_id, document_id=doc_id)
+        vectors = embedded["vectors"]
+
+        started = time.perf_counter()
+        if chunks:
+            db.execute(insert(models.DocumentChunk), [
+                {
+                    "document_id": doc_id,
+                    "chunk_index": idx,
+                    "content": chunk_text,
+                    "embedding": vector,
+                }
+                for idx, (chunk_text, vector) in enumerate(zip(chunks, vectors))
+            ])
+            db.query(models.Document).filter(models.Document.id == doc_id).update(
+                {"embedding": self._centroid(vectors)}, synchronize_session=False
             )
-            db.add(db_chunk)
+        if commit:
+            db.commit()
+        insert_seconds = time.perf_counter() - started
 
-        db.commit()
-        return new_doc
+        return {
+            "chunks": len(chunks),
+            "batches": embedded["batches"],
+            "embed_seconds": embedded["embed_seconds"],
+            "insert_seconds": insert_seconds,
+        }
+
+
+    def _centroid(self, vectors: list) -> list[float]:
+        return np.asarray(vectors, dtype=np.float32).mean(axis=0).tolist()
 
 
     def _chunk_text(self, text: str, chunk_size: int = 1000) -> list[str]:
         return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
 
 
-    def _get_embedding(self, text: str):
-        result = genai.embed_content(
-            model=self.embedding_model,
-            content=text,
-            # task_type="retrieval_document"
-            output_dimensionality=768
-        )
-        return result['embedding']
+    def _iter_chunks(self, parts: Iterable[str], chunk_size: int = 1000) -> Iterator[str]:
+        buffer = ""
+        for part in parts:
+            buffer += part
+            whole = len(buffer) - len(buffer) % chunk_size
+            for start in range(0, whole, chunk_size):
+                yield buffer[start:start + chunk_size]
+            buffer = buffer[whole:]
+        if buffer:
+            yield buffer
+
+
+    def _get_embedding(self, text: str, user_id: int = None, document_id: int = None):
+        vectors, _ = self._get_embeddings([text], user_id, document_id)
+        return vectors[0]
+
+
+    def _get_embeddings(self, texts: list[str], user_id: int = None, document_id: int = None) -> tuple[list, int]:
+        keys = {text: self.cache.embedding_key(self.embedding_model, text) for text in texts}
+        cached = self.cache.get_embeddings(self.embedding_model, texts)
+
+        missing = [text for text, key in keys.items() if key not in cached]
+        batches = list(self._batch_texts(missing))
+        fresh = {}
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_WORKERS, len(batches))) as pool:
+                embedded = pool.map(lambda batch: self._embed_batch(batch, user_id, document_id), batches)
+                for batch, vectors in zip(batches, embedded):
+                    fresh.update(zip(batch, vectors))
+            self.cache.set_embeddings(self.embedding_model, fresh)
+
+        vectors = [fresh[text] if text in fresh else cached[keys[text]] for text in texts]
+        return vectors, len(batches)
+
+
+    def _embed_batch(self, texts: list[str], user_id: int = None, document_id: int = None) -> list:
+        return llm.embed(texts, task="document.chunk_embedding", model=self.embedding_model, user_id=user_id,
+                         document_id=document_id)
+
+
+    def _batch_texts(self, texts: list[str]):
+        batch, batch_chars = [], 0
+        for text in texts:
+            if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_chars + len(text) > EMBEDDING_BATCH_CHARS):
+                yield batch
+                batch, batch_chars = [], 0
+            batch.append(text)
+            batch_chars += len(text)
+
+        if batch:
+            yield batch
 
 
     def get_user_history(self, db: Session, user_id: int):
@@ -154,6 +718,8 @@ class DocumentService:
         if doc:
             db.delete(doc)
             db.commit()
+            semantic_answer_cache.invalidate(doc_id)
+            document_context_cache.invalidate(doc_id)
             return True
 
         return False
@@ -184,29 +750,36 @@ class DocumentService:
             raise e
 
 
-    def validate_content(self, text: str) -> dict:
-        prompt = f"""
-                Act as a strict Fact-Checker and Librarian. Analyze the text below (first 15000 chars).
+    def validate_content(self, text: str, user_id: int = None) -> dict:
+        cache_key = content_hash(text)
+        cached = self.cache.get("validate", cache_key)
+        if cached is not None:
+            return cached
+
+        prompt = PromptBuilder("document.validate").add("text", text, priority=1).render("""
+                Act as a strict Fact-Checker and Librarian. Analyze the text below (the start of the document).
 
                 Tasks:
                 1. VALIDATION: Determine if this is a coherent, factually possible text (scientific, fictional story, history, etc.) OR if it is incoherent/blatant generated nonsense/fake news.
                 2. RESOURCES: If it is Valid, provide 3 real-world book titles or reliable URLs relevant to the topic.
 
                 Text Preview:
-                {text[:15000]}
+                {text}
 
                 Output JSON format ONLY:
-                {{
+                {
                     "is_valid": boolean,
                     "warning_message": "String explaining why it looks fake (or null if valid)",
                     "references": ["Title/URL 1", "Title/URL 2", "Title/URL 3"]
-                }}
-                """
+                }
+                """)
 
         try:
             config = GenerationConfig(response_mime_type="application/json")
-            response = self.model.generate_content(prompt, generation_config=config)
-            return json.loads(response.text)
+            response = llm.generate(prompt, task="document.validate", generation_config=config, user_id=user_id)
+            result = json.loads(response.text)
+            self.cache.set("validate", cache_key, result)
+            return result
         except Exception as e:
             print("Validation error: ", e)
             return {
@@ -216,45 +789,47 @@ class DocumentService:
             }
 
 
-    def find_cross_references(self, db: Session, current_doc_id: int, content: str, user_id: int):
-        new_embedding = self._get_embedding(content[:2000])
-
-        query = sql_text(f"""
-        SELECT d.filename, dc.content, d.id
-        FROM document_chunks dc
-            JOIN documents d ON d.id = dc.document_id
-        WHERE d.id != :current_doc_id
-            AND d.owner_id = :user_id
-        ORDER BY d.embedding <=> :embedding
-        LIMIT 3 
-        """)
+    def find_cross_references(self, db: Session, current_doc_id: int, content: str, user_id: int, limit: int = 3):
+        centroid = db.query(models.Document.embedding).filter(models.Document.id == current_doc_id).scalar()
+        if centroid is not None:
+            query_embedding = [float(x) for x in centroid]
+        else:
+            query_embedding = self._get_embedding(fit_text(content, budget_for("document.cross_reference_query")),
+                                                  user_id, current_doc_id)
 
-        results = db.execute(query, {
-            "user_id": user_id,
-            "current_doc_id": current_doc_id,
-            "embedding": str(new_embedding)
-        }).fetchall()
+        results = self.related_snippets(db, current_doc_id, user_id, query_embedding, limit, exclude_content=content)
         if not results:
             return ""
 
+        # Copies of this text are left out above, so a re-upload finds the same
+        # documents and its note comes from the cache.
+        cache_key = content_hash(f"{content_hash(content)}:{','.join(str(r[2]) for r in results)}")
+        cached = self.cache.get("cross_reference", cache_key)
+        if cached is not None:
+            return cached
+
         cross_context = "\n".join([f"Source ({r[0]}): {r[1]}" for r in results])
 
-        prompt = f"""
+        # The snippets are filled first; the new document gets the rest of the budget.
+        prompt = PromptBuilder("document.cross_reference").add("snippets", cross_context, priority=1).add(
+            "document", content, priority=2
+        ).render("""
                 You are a 'Second Brain' assistant.
                 Analyze connections between the new document and previous ones.
 
-                New Document: {content[:3000]}
-                Previous Snippets: {cross_context}
+                New Document: {document}
+                Previous Snippets: {snippets}
 
                 TASK:
                 Write a concise 'Cross-Reference' note (Hungarian).
                 1. Explain the connection/similarity.
                 2. Reference the old filenames explicitly.
                 3. Do NOT include a Title or Header. Start directly with the text.
-                """
+                """)
 
         try:
-            response = self.model.generate_content(prompt)
+            response = llm.generate(prompt, task="document.cross_reference", user_id=user_id,
+                                    document_id=current_doc_id)
             ai_text = response.text.strip()
 
             ai_text_html = ai_text.replace("\n", "<br>")
@@ -272,6 +847,7 @@ class DocumentService:
                 f'</div>'
             )
 
+            self.cache.set("cross_reference", cache_key, formatted_html)
             return formatted_html
 
         except Exception as e:
@@ -279,6 +855,55 @@ class DocumentService:
             return ""
 
 
+    def related_snippets(self, db: Session, current_doc_id: int, user_id: int, embedding: list, limit: int = 3,
+                         exclude_content: str = None) -> list:
+        """(filename, best chunk, id) of the user's documents nearest to
+        embedding, nearest first, leaving out documents whose text is
+        exclude_content.
+
+        One user's documents are a small slice of the table, and the global
+        ANN index would only filter its ef_search candidates by owner, mostly
+        leaving nothing. The owner's documents are read through the owner_id
+        index and ranked exactly; DISTINCT ON picks each one's best chunk
+        through the document_id index. Texts are only compared when their
+        byte lengths match, which needs no detoasting.
+        """
+        query = sql_text("""
+        WITH candidates AS MATERIALIZED (
+            SELECT d.id, d.filename, d.embedding
+            FROM documents d
+            WHERE d.owner_id = :user_id
+                AND d.id != :current_doc_id
+                AND d.embedding IS NOT NULL
+                AND CASE WHEN octet_length(d.content) = :exclude_bytes THEN d.content <> :exclude_content
+                         ELSE true END
+        ), nearest AS MATERIALIZED (
+            SELECT c.id, c.filename, c.embedding <=> CAST(:embedding AS vector) AS distance
+            FROM candidates c
+            ORDER BY distance
+            LIMIT :limit
+        ), best AS (
+            SELECT DISTINCT ON (dc.document_id) dc.document_id, dc.content
+            FROM document_chunks dc
+            WHERE dc.document_id IN (SELECT id FROM nearest)
+            ORDER BY dc.document_id, dc.embedding <=> CAST(:embedding AS vector)
+        )
+        SELECT n.filename, b.content, n.id
+        FROM nearest n
+            JOIN best b ON b.document_id = n.id
+        ORDER BY n.distance
+        """)
+
+        return db.execute(query, {
+            "user_id": user_id,
+            "current_doc_id": current_doc_id,
+            "embedding": str(embedding),
+            "limit": limit,
+            "exclude_content": exclude_content or "",
+            "exclude_bytes": len(exclude_content.encode("utf-8")) if exclude_content else -1,
+        }).fetchall()
+
+
 # --- User services
 
 class UserService:
@@ -298,21 +923,37 @@ class UserService:
 class QuizService:
     def __init__(self, db: Session = None):
         self.db = db
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
 
 
-    def generate_quiz(self, document_id: int, user_id: int):
-        doc: models.Document | None = self.db.query(models.Document).filter(
-            models.Document.id == document_id,
-            models.Document.owner_id == user_id
-        ).first()
+    def generate_quiz(self, document_id: int, user_id: int, force_fresh: bool = False):
+        return single_flight.run(self.db, "quiz", document_id, user_id,
+                                 lambda: self._generate_quiz(document_id, user_id, force_fresh), latest_quiz)
+
 
+    def _generate_quiz(self, document_id: int, user_id: int, force_fresh: bool = False):
+        doc = get_document(self.db, document_id, user_id)
         if not doc:
             print(f"Error: Document {document_id} not found.")
             return None
 
-        prompt = f"""
-        Generate a quiz based on the text below.
+        prompt = self._quiz_prompt()
+        try:
+            config = GenerationConfig(response_mime_type="application/json")
+            source = document_source(doc)
+            response = llm.generate(prompt, task="quiz.generate", generation_config=config, cache=True,
+                                    force_fresh=force_fresh, source=source, source_id=doc.id,
+                                    user_id=user_id)
+            return self._save_quiz(doc.id, user_id, response.text)
+
+        except Exception as e:
+            print(f"!!! Quiz Generation Error: {e}")
+            return None
+
+
+    @staticmethod
+    def _quiz_prompt() -> str:
+        return f"""
+        Generate a quiz based on the source material.
         Language: HUNGARIAN.
         Format: JSON Array of objects.
         Quantity: 10 Questions.
@@ -327,105 +968,111 @@ class QuizService:
         }}
 
         Ensure the "correct_answer" exactly matches one of the strings in "options".
-
-        Text content:
-        {doc.content[:30000]}
         """
 
-        try:
-            config = GenerationConfig(response_mime_type="application/json")
-            response = self.model.generate_content(
-                prompt,
-                generation_config=config
-            )
 
-            raw_text = response.text.strip()
-            if raw_text.startswith("```"):
-                raw_text = raw_text.split("\n", 1)[1]
-                if raw_text.endswith("```"):
-                    raw_text = raw_text.rsplit("\n", 1)[0]
+    def _save_quiz(self, document_id: int, user_id: int, response_text: str) -> models.Quiz:
+        raw_text = response_text.strip()
+        if raw_text.startswith("```"):
+            raw_text = raw_text.split("\n", 1)[1]
+            if raw_text.endswith("```"):
+                raw_text = raw_text.rsplit("\n", 1)[0]
 
-            quiz_data = json.loads(raw_text)
+        new_quiz = self._add_quiz(document_id, user_id, self._unwrap_questions(json.loads(raw_text)))
+        self.db.commit()
+        print(f"--- Quiz Generated ID: {new_quiz.id} ---")
+        return new_quiz
 
-            if isinstance(quiz_data, dict):
-                if "questions" in quiz_data:
-                    quiz_data = quiz_data["questions"]
-                elif "quiz" in quiz_data:
-                    quiz_data = quiz_data["quiz"]
-                else:
-                    for val in quiz_data.values():
-                        if isinstance(val, list):
-                            quiz_data = val
-                            break
-
-            new_quiz = models.Quiz(
-                document_id=doc.id,
-                owner_id=user_id,
-                top_score=0,
-                passed=False
-            )
-            self.db.add(new_quiz)
-            self.db.commit()
-            self.db.refresh(new_quiz)
-
-            for q_data in quiz_data:
-                options = q_data.get('options')
-                if q_data.get('type') == 'true_false' and not options:
-                    options = ["Igaz", "Hamis"]
-
-                question = models.Question(
-                    quiz_id=new_quiz.id,
-                    question_text=q_data['question_text'],
-                    question_type=q_data['type'],
-                    options=options,
-                    correct_answer=q_data['correct_answer']
-                )
-                self.db.add(question)
 
-            self.db.commit()
-            print(f"--- Quiz Generated ID: {new_quiz.id} ---")
-            return new_quiz
+    def _unwrap_questions(self, quiz_data) -> list:
+        if isinstance(quiz_data, dict):
+            if "questions" in quiz_data:
+                quiz_data = quiz_data["questions"]
+            elif "quiz" in quiz_data:
+                quiz_data = quiz_data["quiz"]
+            else:
+                for val in quiz_data.values():
+                    if isinstance(val, list):
+                        quiz_data = val
+                        break
+        return quiz_data
 
-        except Exception as e:
-            print(f"!!! Quiz Generation Error: {e}")
-            return None
 
+    def _add_quiz(self, document_id: int, user_id: int, quiz_data: list) -> models.Quiz:
+        """Adds the quiz and its questions to the session without committing."""
+        new_quiz = models.Quiz(
+            document_id=document_id,
+            owner_id=user_id,
+            top_score=0,
+            passed=False
+        )
+
+        for q_data in quiz_data:
+            options = q_data.get('options')
+            if q_data.get('type') == 'true_false' and not options:
+                options = ["Igaz", "Hamis"]
 
-    def generate_flashcards(self, document_id: int, user_id: int):
-        doc = self.db.query(models.Document).filter(
-            models.Document.id == document_id,
-            models.Document.owner_id == user_id
-        ).first()
+            new_quiz.questions.append(models.Question(
+                question_text=q_data['question_text'],
+                question_type=q_data['type'],
+                options=options,
+                correct_answer=q_data['correct_answer']
+            ))
+
+        self.db.add(new_quiz)
+        self.db.flush()
+        return new_quiz
+
+
+    def generate_flashcards(self, document_id: int, user_id: int, force_fresh: bool = False):
+        return single_flight.run(self.db, "flashcards", document_id, user_id,
+                                 lambda: self._generate_flashcards(document_id, user_id, force_fresh),
+                                 latest_flashcard_set_id, version=lambda set_id: set_id)
+
+
+    def _generate_flashcards(self, document_id: int, user_id: int, force_fresh: bool = False):
+        doc = get_document(self.db, document_id, user_id)
         if not doc:
             return None
 
-        prompt = f"""
-        Analyze the text below and generate 10 flashcards. 
+        prompt = self._flashcards_prompt()
+        try:
+            config = GenerationConfig(response_mime_type="application/json")
+            source = document_source(doc)
+            response = llm.generate(prompt, task="flashcards.generate", generation_config=config, cache=True,
+                                    force_fresh=force_fresh, source=source, source_id=doc.id,
+                                    user_id=user_id)
+            return self._save_flashcards(doc.id, response.text)
+
+        except Exception as e:
+            print(f"!!! Flashcard Generation Error: {e}")
+            return None
+
+
+    @staticmethod
+    def _flashcards_prompt() -> str:
+        return f"""
+        Analyze the source material and generate 10 flashcards. 
         Output PURE JSON: [{{ "front": "term", "back": "definition" }}]
         Language: HUNGARIAN.
-        Text: {doc.content[:30000]}
         """
 
-        try:
-            config = GenerationConfig(response_mime_type="application/json")
-            response = self.model.generate_content(prompt, generation_config=config)
-            cards_data = json.loads(response.text)
 
-            new_set = models.FlashcardSet(document_id=doc.id)
-            self.db.add(new_set)
-            self.db.commit()
-            self.db.refresh(new_set)
+    def _save_flashcards(self, document_id: int, response_text: str) -> int:
+        new_set = self._add_flashcard_set(document_id, json.loads(response_text))
+        self.db.commit()
+        return new_set.id
 
-            for card in cards_data:
-                db_card = models.Flashcard(set_id=new_set.id, front=card['front'], back=card['back'])
-                self.db.add(db_card)
 
-            self.db.commit()
-            return new_set.id
+    def _add_flashcard_set(self, document_id: int, cards_data: list) -> models.FlashcardSet:
+        """Adds the set and its cards to the session without committing."""
+        new_set = models.FlashcardSet(document_id=document_id)
+        for card in cards_data:
+            new_set.cards.append(models.Flashcard(front=card['front'], back=card['back']))
 
-        except Exception as e:
-            print(f"!!! Flashcard Generation Error: {e}")
-            return None
+        self.db.add(new_set)
+        self.db.flush()
+        return new_set
 
 
     def get_flashcard_set(self, set_id: int):
@@ -489,82 +1136,127 @@ class QuizService:
 
 # --- Chat services
 
+TUTOR_FALLBACK = {"status": "neutral", "text": "Hiba történt. Folytassuk...", "is_finish": False}
+
+
 class ChatService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, user_id: int = None):
         self.db = db
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        self.user_id = user_id
 
-    def ask_document(self, doc_id: int, question: str):
-        usr_msg = models.ChatMessage(document_id=doc_id, role='user', content=question)
-        self.db.add(usr_msg)
-        self.db.commit()
+    def ask_document(self, doc_id: int, question: str, ef_search: int = None):
+        q_embedding, cached_answer, prompt = self._prepare_answer(doc_id, question, ef_search)
+        if cached_answer is not None:
+            self._save_message(doc_id, 'ai', cached_answer)
+            return cached_answer
 
-        q_embedding = genai.embed_content(
-            model='models/gemini-embedding-001',
-            content=question,
-            # task_type='retrieval_query'
-            output_dimensionality=768
-        )['embedding']
+        response = llm.generate(prompt, task="chat.answer", user_id=self.user_id, document_id=doc_id)
+        answer_text = response.text
+        semantic_answer_cache.store(doc_id, q_embedding, answer_text)
 
-        query = sql_text("""
-            SELECT content
-            FROM document_chunks
-            WHERE document_id = :doc_id
-            ORDER BY embedding <=> :q_embedding
-            LIMIT 3
-        """)
+        self._save_message(doc_id, 'ai', answer_text)
+        return answer_text
 
-        results = self.db.execute(query, {"doc_id": doc_id, "q_embedding": str(q_embedding)}).fetchall()
-        context_text = "\n\n".join([row[0] for row in results])
 
-        prompt = f"""
+    def stream_answer(self, doc_id: int, question: str, ef_search: int = None):
+        q_embedding, cached_answer, prompt = self._prepare_answer(doc_id, question, ef_search)
+        if cached_answer is not None:
+            self._save_message(doc_id, 'ai', cached_answer)
+            yield cached_answer
+            return
+
+        parts = []
+        for chunk in llm.stream(prompt, task="chat.answer", user_id=self.user_id, document_id=doc_id):
+            if chunk.text:
+                parts.append(chunk.text)
+                yield chunk.text
+
+        answer_text = "".join(parts)
+        semantic_answer_cache.store(doc_id, q_embedding, answer_text)
+        self._save_message(doc_id, 'ai', answer_text)
+
+
+    def _prepare_answer(self, doc_id: int, question: str, ef_search: int = None):
+        self._save_message(doc_id, 'user', question)
+
+        q_embedding = llm.embed(question, task="chat.query_embedding", user_id=self.user_id, document_id=doc_id)
+
+        cached_answer = semantic_answer_cache.lookup(doc_id, q_embedding)
+        if cached_answer is not None:
+            return q_embedding, cached_answer, None
+
+        return q_embedding, None, self._answer_prompt(doc_id, question, q_embedding, ef_search)
+
+
+    def _answer_prompt(self, doc_id: int, question: str, q_embedding: list, ef_search: int = None) -> str:
+        results = nearest_chunks(self.db, doc_id, q_embedding, 3, ef_search=ef_search)
+        context_text = "\n\n".join([row[1] for row in results])
+
+        return PromptBuilder("chat.answer").add("context", context_text, priority=1).render(f"""
         You are a helpful tutor. Answer the question based ONLY on the context below.
         
         Context: 
-        {context_text}
+        {{context}}
         
         Question: {question}
         Answer (in Hungarian):
-        """
+        """)
 
-        response = self.model.generate_content(prompt)
-        answer_text = response.text
 
-        ai_msg = models.ChatMessage(document_id=doc_id, role='ai', content=answer_text)
-        self.db.add(ai_msg)
+    def _save_message(self, doc_id: int, role: str, content: str):
+        msg = models.ChatMessage(document_id=doc_id, role=role, content=content)
+        self.db.add(msg)
         self.db.commit()
 
-        return answer_text
+
+    def get_chat_history(self, doc_id: int, mode: str = 'chat', limit: int = None, before: tuple = None):
+        """Messages of one mode, oldest first. With a limit only the newest
+        `limit` are read, older than the (created_at, id) cursor `before`
+        when one is given."""
+        query = self._history_query(doc_id, mode)
+        if before is not None:
+            query = query.filter(tuple_(models.ChatMessage.created_at, models.ChatMessage.id) < before)
+        if limit is None:
+            return query.order_by(models.ChatMessage.created_at.asc(), models.ChatMessage.id.asc()).all()
+
+        newest = query.order_by(models.ChatMessage.created_at.desc(), models.ChatMessage.id.desc()).limit(limit)
+        return newest.all()[::-1]
 
 
-    def get_chat_history(self, doc_id: int, mode: str = 'chat'):
-        query = self.db.query(models.ChatMessage).filter(
+    def _history_query(self, doc_id: int, mode: str):
+        return self.db.query(models.ChatMessage).filter(
             models.ChatMessage.document_id == doc_id,
+            models.ChatMessage.role.in_(CHAT_ROLES.get(mode, CHAT_ROLES['chat']))
         )
 
-        if mode == 'tutor':
-            query = query.filter(models.ChatMessage.role.in_(['tutor_ai', 'tutor_user']))
-        else:
-            query = query.filter(models.ChatMessage.role.in_(['ai', 'user']))
-
-        return query.order_by(models.ChatMessage.created_at.asc()).all()
 
     def start_socratic_session(self, doc_id: int):
-        doc = self.db.query(models.Document).filter(
-            models.Document.id == doc_id
-        ).first()
+        doc = get_document(self.db, doc_id)
         if not doc:
             return None
 
-        existing_history = self.db.query(models.ChatMessage).filter(
-            models.ChatMessage.document_id == doc_id,
-            models.ChatMessage.role.in_(['tutor_ai', 'tutor_user'])
-        ).all()
-        if existing_history:
-            return existing_history[-1].content
+        last_message = self._last_tutor_message(doc_id)
+        if last_message is not None:
+            return last_message
 
-        prompt = f"""
-                You are a Socratic Tutor. Your goal is to test the student's understanding of the text below.
+        prompt = self._tutor_start_prompt()
+        response = llm.generate(prompt, task="tutor.start", source=document_source(doc),
+                                source_id=doc.id, user_id=self.user_id)
+        ai_question = response.text
+
+        self._save_message(doc_id, 'tutor_ai', ai_question)
+        return ai_question
+
+
+    def _last_tutor_message(self, doc_id: int) -> str | None:
+        last = self.get_chat_history(doc_id, mode='tutor', limit=1)
+        return last[0].content if last else None
+
+
+    @staticmethod
+    def _tutor_start_prompt() -> str:
+        return f"""
+                You are a Socratic Tutor. Your goal is to test the student's understanding of the source material.
 
                 RULES:
                 1. Do NOT summarize the text.
@@ -572,44 +1264,180 @@ class ChatService:
                 3. The question should require understanding, not just copy-pasting.
                 4. Output language: HUNGARIAN.
 
-                Text to teach:
-                {doc.content[:30000]}
-
                 Start with the first question now.
                 """
 
-        response = self.model.generate_content(prompt)
-        ai_question = response.text
 
-        ai_msg = models.ChatMessage(document_id=doc_id, role='tutor_ai', content=ai_question)
-        self.db.add(ai_msg)
-        self.db.commit()
+    def handle_tutor_response(self, doc_id: int, user_answer: str):
+        try:
+            # Building the prompt makes model calls too (summary, embeddings).
+            prompt = self._tutor_prompt(doc_id, user_answer)
+            config = GenerationConfig(response_mime_type="application/json")
+            response = llm.generate(prompt, task="tutor.reply", generation_config=config, user_id=self.user_id,
+                                    document_id=doc_id)
+            return self._finish_tutor_turn(doc_id, response.text)
 
-        return ai_question
+        except Exception as e:
+            print(f"Tutor Error: {e}")
+            # Fallback
+            return dict(TUTOR_FALLBACK)
 
 
-    def handle_tutor_response(self, doc_id: int, user_answer: str):
-        usr_msg = models.ChatMessage(document_id=doc_id, role='tutor_user', content=user_answer)
-        self.db.add(usr_msg)
+    def stream_tutor_response(self, doc_id: int, user_answer: str):
+        """Yields raw JSON fragments as they arrive, then the parsed turn
+        as the final item once the message has been saved."""
+        parts = []
+        try:
+            prompt = self._tutor_prompt(doc_id, user_answer)
+            config = GenerationConfig(response_mime_type="application/json")
+            for chunk in llm.stream(prompt, task="tutor.reply", generation_config=config, user_id=self.user_id,
+                                    document_id=doc_id):
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            yield self._finish_tutor_turn(doc_id, "".join(parts))
+
+        except Exception as e:
+            print(f"Tutor Error: {e}")
+            yield dict(TUTOR_FALLBACK)
+
+
+    def _finish_tutor_turn(self, doc_id: int, response_text: str) -> dict:
+        response_data = json.loads(response_text)
+        self._save_message(doc_id, 'tutor_ai', response_text)
+        return response_data
+
+
+    def _tutor_prompt(self, doc_id: int, user_answer: str) -> str:
+        """Prompt for the student's latest answer. Its size stays flat over the
+        session: anchor chunks and the chunks retrieved for this answer stand
+        in for the document, and messages that leave the recent window are
+        folded into the session's rolling summary."""
+        turn = self._begin_tutor_turn(doc_id, user_answer)
+        if turn["fold"]:
+            response = llm.generate(self._tutor_summary_prompt(turn["summary"], turn["fold"]), task="tutor.summary",
+                                    user_id=self.user_id, document_id=doc_id)
+            turn["summary"] = self._save_tutor_summary(doc_id, response.text, turn["fold_through"])
+
+        embeddings = llm.embed(turn["queries"], task="tutor.query_embedding", user_id=self.user_id,
+                               document_id=doc_id)
+        anchors, retrieved = self._tutor_context(doc_id, turn["anchor_ids"], embeddings)
+        return self._render_tutor_prompt(turn, user_answer, anchors, retrieved)
+
+
+    def _begin_tutor_turn(self, doc_id: int, user_answer: str) -> dict:
+        """Saves the answer and loads what the prompt needs: the summary,
+        the messages after it and the texts to embed, the current question
+        and answer first, then the opening question while the session has
+        no anchors yet."""
+        self._save_message(doc_id, 'tutor_user', user_answer)
+        self.db.execute(pg_insert(models.TutorSession).values(document_id=doc_id).on_conflict_do_nothing())
+        session = self.db.get(models.TutorSession, doc_id)
+
+        tutor_messages = self._history_query(doc_id, 'tutor')
+        messages = tutor_messages.filter(models.ChatMessage.id > session.summarized_through).order_by(
+            models.ChatMessage.created_at.desc(), models.ChatMessage.id.desc()
+        ).limit(TUTOR_HISTORY_WINDOW).all()[::-1]
+        message_count = tutor_messages.with_entities(func.count(models.ChatMessage.id)).scalar()
+
+        fold, recent = [], messages
+        if len(messages) > TUTOR_RECENT_MESSAGES + TUTOR_SUMMARY_BATCH:
+            fold, recent = messages[:-TUTOR_RECENT_MESSAGES], messages[-TUTOR_RECENT_MESSAGES:]
+
+        question = next((self._tutor_text(msg.content) for msg in reversed(messages) if msg.role == 'tutor_ai'), "")
+        queries = [f"{question}\n{user_answer}"]
+        if session.anchor_chunk_ids is None:
+            opening = tutor_messages.filter(models.ChatMessage.role == 'tutor_ai').order_by(
+                models.ChatMessage.created_at.asc(), models.ChatMessage.id.asc()
+            ).first()
+            if opening is not None:
+                queries.append(self._tutor_text(opening.content))
+
+        turn = {
+            "summary": session.summary,
+            "fold": [self._tutor_line(msg) for msg in fold],
+            "fold_through": fold[-1].id if fold else None,
+            "recent": [self._tutor_line(msg) for msg in recent],
+            "is_final": message_count >= TUTOR_SESSION_MESSAGES,
+            "anchor_ids": session.anchor_chunk_ids,
+            "queries": queries,
+        }
         self.db.commit()
+        return turn
 
-        history = self.get_chat_history(doc_id, mode='tutor')
-        is_final_turn = len(history) >= 10
 
-        doc = self.db.query(models.Document).filter(
-            models.Document.id == doc_id,
-        ).first()
-        context_text = doc.content[:30000]
+    def _tutor_context(self, doc_id: int, anchor_ids: list[int] | None, embeddings: list) -> tuple[str, str]:
+        """Anchor chunks and the chunks nearest to the current answer. A new
+        session takes its anchors from the opening question, the last
+        embedding, and keeps them."""
+        if anchor_ids is None:
+            anchor_rows = nearest_chunks(self.db, doc_id, embeddings[-1], TUTOR_ANCHOR_CHUNKS)
+            anchor_ids = [row[0] for row in anchor_rows]
+            self.db.get(models.TutorSession, doc_id).anchor_chunk_ids = anchor_ids or None
+        else:
+            contents = dict(self.db.query(models.DocumentChunk.id, models.DocumentChunk.content).filter(
+                models.DocumentChunk.id.in_(anchor_ids)
+            ).all())
+            anchor_rows = [(chunk_id, contents[chunk_id]) for chunk_id in anchor_ids if chunk_id in contents]
+        retrieved_rows = nearest_chunks(self.db, doc_id, embeddings[0], TUTOR_RETRIEVED_CHUNKS, anchor_ids)
+        self.db.commit()
+
+        if not anchor_rows and not retrieved_rows:
+            # Not chunked yet; fall back to the fitted document.
+            return document_source(get_document(self.db, doc_id)), ""
+        return "\n\n".join(row[1] for row in anchor_rows), "\n\n".join(row[1] for row in retrieved_rows)
+
+
+    def _save_tutor_summary(self, doc_id: int, summary: str, through: int) -> str:
+        session = self.db.get(models.TutorSession, doc_id)
+        # A concurrent turn may have folded further already; keep the newer summary.
+        if through > session.summarized_through:
+            session.summary = summary
+            session.summarized_through = through
+            self.db.commit()
+        return session.summary
+
+
+    @staticmethod
+    def _tutor_text(content: str) -> str:
+        # Tutor replies are stored as the model's JSON; only their text is history.
+        try:
+            data = json.loads(content)
+        except ValueError:
+            return content
+        return data.get("text", content) if isinstance(data, dict) else content
+
 
-        conversation_history = "\n".join(
-            [f"{'AI' if 'ai' in msg.role else 'Student'}: {msg.content}" for msg in history[-10:]])
+    @classmethod
+    def _tutor_line(cls, msg: models.ChatMessage) -> str:
+        return f"{'AI' if 'ai' in msg.role else 'Student'}: {cls._tutor_text(msg.content)}"
 
-        if is_final_turn:
+
+    @staticmethod
+    def _tutor_summary_prompt(summary: str, lines: list[str]) -> str:
+        return PromptBuilder("tutor.summary").add("summary", summary, priority=1).add(
+            "turns", "\n".join(lines), priority=2, keep_end=True
+        ).render(f"""
+                Update the running summary of a Socratic tutoring session with the new turns.
+
+                Summary so far: {{summary}}
+                New turns: {{turns}}
+
+                Keep which questions were asked, what the student understood and what they got wrong.
+                At most 150 words, plain text. Language: HUNGARIAN.
+                """)
+
+
+    @staticmethod
+    def _render_tutor_prompt(turn: dict, user_answer: str, anchors: str, retrieved: str) -> str:
+        if turn["is_final"]:
             prompt = f"""
                         The tutoring session is over. Generate a Final Report based on the student's performance.
 
-                        Context: {context_text}
-                        History: {conversation_history}
+                        Core material: {{anchors}}
+                        Related material: {{retrieved}}
+                        Earlier in the session: {{summary}}
+                        History: {{history}}
 
                         Output strictly JSON:
                         {{
@@ -623,8 +1451,10 @@ class ChatService:
             prompt = f"""
                         You are a Socratic Tutor. Analyze the user's answer.
 
-                        Context: {context_text}
-                        History: {conversation_history}
+                        Core material: {{anchors}}
+                        Related material: {{retrieved}}
+                        Earlier in the session: {{summary}}
+                        History: {{history}}
                         User Answer: {user_answer}
 
                         Output strictly JSON:
@@ -636,27 +1466,17 @@ class ChatService:
                         Language: HUNGARIAN.
                         """
 
-        try:
-            config = GenerationConfig(response_mime_type="application/json")
-            response = self.model.generate_content(prompt, generation_config=config)
-            response_data = json.loads(response.text)
-
-            ai_msg = models.ChatMessage(document_id=doc_id, role='tutor_ai', content=response.text)
-            self.db.add(ai_msg)
-            self.db.commit()
-
-            return response_data
-
-        except Exception as e:
-            print(f"Tutor Error: {e}")
-            # Fallback
-            return {"status": "neutral", "text": "Hiba történt. Folytassuk...", "is_finish": False}
+        return PromptBuilder("tutor.reply").add("anchors", anchors, priority=1).add(
+            "retrieved", retrieved, priority=1
+        ).add("summary", turn["summary"], priority=2).add(
+            "history", "\n".join(turn["recent"]), priority=2, keep_end=True
+        ).render(prompt)
 
 
     def reset_tutor_history(self, doc_id: int):
-        self.db.query(models.ChatMessage).filter(
-            models.ChatMessage.document_id == doc_id,
-            models.ChatMessage.role.in_(['tutor_ai', 'tutor_user'])
+        self._history_query(doc_id, 'tutor').delete(synchronize_session=False)
+        self.db.query(models.TutorSession).filter(
+            models.TutorSession.document_id == doc_id
         ).delete(synchronize_session=False)
 
         self.db.commit()
@@ -667,19 +1487,33 @@ class ChatService:
 class MindMapService:
     def __init__(self, db: Session):
         self.db = db
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
 
 
-    def generate_mindmap(self, doc_id: int, user_id: int):
-        doc = self.db.query(models.Document).filter(
-            models.Document.id == doc_id,
-            models.Document.owner_id == user_id
-        ).first()
+    def generate_mindmap(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        return single_flight.run(self.db, "mindmap", doc_id, user_id,
+                                 lambda: self._generate_mindmap(doc_id, user_id, force_fresh), latest_mindmap)
 
+
+    def _generate_mindmap(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        doc = get_document(self.db, doc_id, user_id)
         if not doc:
             return None
 
-        prompt = f"""
+        prompt = self._mindmap_prompt()
+        try:
+            source = document_source(doc)
+            response = llm.generate(prompt, task="mindmap.generate", cache=True, force_fresh=force_fresh,
+                                    source=source, source_id=doc.id, user_id=user_id)
+            return self._save_mindmap(doc.id, response.text)
+
+        except Exception as e:
+            print(f"!!! MindMap Generation Error: {e}")
+            return None
+
+
+    @staticmethod
+    def _mindmap_prompt() -> str:
+        return f"""
                 Create a hierarchical mind map using Mermaid.js `graph TD` syntax.
 
                 STRICT RULES:
@@ -693,44 +1527,46 @@ class MindMapService:
                 5. **Sanitization**: Remove all special characters `( ) [ ] " '` from labels.
                 6. Language: HUNGARIAN.
 
-                Text to analyze:
-                {doc.content[:30000]}
+                Analyze the source material.
                 """
 
-        try:
-            response = self.model.generate_content(prompt)
-            script = response.text.strip()
 
-            if script.startswith("```mermaid"):
-                script = script.replace("```mermaid", "").replace("```", "")
-            elif script.startswith("```"):
-                script = script.replace("```", "")
+    def _save_mindmap(self, doc_id: int, response_text: str) -> models.MindMap:
+        new_map = models.MindMap(
+            document_id=doc_id,
+            mermaid_script=self._clean_script(response_text)
+        )
+        self.db.add(new_map)
+        self.db.commit()
+        self.db.refresh(new_map)
+        # Loaded here for the response; the async endpoints cannot lazy-load.
+        new_map.document
+        return new_map
 
-            script = script.strip()
 
-            if "graph LR" in script:
-                script = script.replace("graph LR", "graph TD")
+    def _clean_script(self, script: str) -> str:
+        script = script.strip()
 
-            if not script.startswith("graph"):
-                script = "graph TD\n" + script
+        if script.startswith("```mermaid"):
+            script = script.replace("```mermaid", "").replace("```", "")
+        elif script.startswith("```"):
+            script = script.replace("```", "")
 
-            new_map = models.MindMap(
-                document_id=doc_id,
-                mermaid_script=script
-            )
-            self.db.add(new_map)
-            self.db.commit()
-            self.db.refresh(new_map)
+        script = script.strip()
 
-            return new_map
+        if "graph LR" in script:
+            script = script.replace("graph LR", "graph TD")
 
-        except Exception as e:
-            print(f"!!! MindMap Generation Error: {e}")
-            return None
+        if not script.startswith("graph"):
+            script = "graph TD\n" + script
+
+        return script
 
 
     def get_mindmap_by_doc(self, doc_id: int, user_id: int):
-        return self.db.query(models.MindMap).join(models.Document).filter(
+        return self.db.query(models.MindMap).options(
+            joinedload(models.MindMap.document)
+        ).join(models.Document).filter(
             models.MindMap.document_id == doc_id,
             models.Document.owner_id == user_id
         ).first()
@@ -754,6 +1590,91 @@ class MindMapService:
             })
         return results
 
+# --- Study pack services
+
+class StudyPackService:
+    """Quiz, flashcards and mind map from a single model call, so the
+    document text is sent once instead of three times."""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+
+    def generate_study_pack(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        return single_flight.run(self.db, "study_pack", doc_id, user_id,
+                                 lambda: self._generate_study_pack(doc_id, user_id, force_fresh),
+                                 latest_study_pack, version=study_pack_version)
+
+
+    def _generate_study_pack(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        doc = get_document(self.db, doc_id, user_id)
+        if not doc:
+            return None
+
+        prompt = self._pack_prompt()
+        try:
+            config = GenerationConfig(response_mime_type="application/json")
+            source = document_source(doc)
+            response = llm.generate(prompt, task="study_pack.generate", generation_config=config, cache=True,
+                                    force_fresh=force_fresh, source=source, source_id=doc.id,
+                                    user_id=user_id)
+            return self._save_pack(doc.id, user_id, response.text)
+
+        except Exception as e:
+            self.db.rollback()
+            print(f"!!! Study Pack Generation Error: {e}")
+            return None
+
+
+    @staticmethod
+    def _pack_prompt() -> str:
+        return f"""
+        Create a study pack from the source material.
+        Language: HUNGARIAN.
+        Output PURE JSON with exactly these keys:
+        {{
+            "quiz": [10 objects],
+            "flashcards": [10 objects],
+            "mindmap": "Mermaid.js script"
+        }}
+
+        "quiz": mix of "multiple_choice" and "true_false" questions. Schema for each object:
+        {{
+            "question_text": "The question string",
+            "type": "multiple_choice" OR "true_false",
+            "options": ["Option A", "Option B", "Option C", "Option D"] (OR null if true_false),
+            "correct_answer": "The exact string matching one of the options or 'Igaz'/'Hamis'"
+        }}
+        Ensure the "correct_answer" exactly matches one of the strings in "options".
+
+        "flashcards": [{{ "front": "term", "back": "definition" }}]
+
+        "mindmap": a hierarchical mind map in Mermaid.js `graph TD` syntax, as one JSON string.
+        1. Use `graph TD` (Top-Down) layout. Do NOT use the `mindmap` keyword.
+        2. Shapes: Root `A((Main Topic))`, Branches `B(Sub Topic)`, Leaves `C([Detail])`.
+        3. Connections: use standard arrows `-->`.
+        4. Remove all special characters `( ) [ ] " '` from labels.
+        """
+
+
+    def _save_pack(self, doc_id: int, user_id: int, response_text: str):
+        pack = json.loads(response_text)
+
+        quiz_service = QuizService(self.db)
+        new_quiz = quiz_service._add_quiz(doc_id, user_id, quiz_service._unwrap_questions(pack["quiz"]))
+        new_set = quiz_service._add_flashcard_set(doc_id, pack["flashcards"])
+        new_map = models.MindMap(
+            document_id=doc_id,
+            mermaid_script=MindMapService(self.db)._clean_script(pack["mindmap"])
+        )
+        self.db.add(new_map)
+        self.db.commit()
+        self.db.refresh(new_map)
+        new_map.document
+
+        print(f"--- Study Pack Generated: quiz {new_quiz.id}, flashcards {new_set.id}, mindmap {new_map.id} ---")
+        return new_quiz, new_set, new_map
+
 # --- Google Drive services
 
 class GoogleDriveService:
@@ -803,22 +1724,30 @@ class GoogleDriveService:
 class GraderService:
     def __init__(self, db: Session):
         self.db = db
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
 
 
     def evaluate_essay(self, doc_id: int, user_id: int, essay_text: str):
-        doc = self.db.query(models.Document).filter(
-            models.Document.id == doc_id
-        ).first()
-
+        doc = get_document(self.db, doc_id)
         if not doc:
             raise ValueError("Document not found.")
 
-        prompt = f"""
-                You are a strict academic professor. Your task is to grade a Student Essay based ONLY on the provided Source Material.
+        prompt = self._grading_prompt(essay_text)
+        try:
+            config = GenerationConfig(response_mime_type='application/json')
+            source = document_source(doc)
+            response = llm.generate(prompt, task="grader.evaluate", generation_config=config,
+                                    source=source, source_id=doc.id, user_id=user_id)
+            return self._save_submission(doc.id, user_id, essay_text, response.text)
+
+        except Exception as e:
+            print(f"Grading Error: {e}")
+            return None
 
-                Source Material:
-                {doc.content[:30000]}
+
+    @staticmethod
+    def _grading_prompt(essay_text: str) -> str:
+        return f"""
+                You are a strict academic professor. Your task is to grade a Student Essay based ONLY on the provided Source Material.
 
                 Student Essay:
                 {essay_text}
@@ -854,30 +1783,25 @@ class GraderService:
                 Language: HUNGARIAN.
                 """
 
-        try:
-            config = GenerationConfig(response_mime_type='application/json')
-            response = self.model.generate_content(prompt, generation_config=config)
-
-            result_json = json.loads(response.text)
 
-            submission = models.EssaySubmission(
-                document_id=doc_id,
-                owner_id=user_id,
-                essay_content=essay_text,
-                feedback_json=result_json.get('segments', []),
-                overall_score=result_json.get('overall_score', 0),
-                general_feedback=result_json.get('general_feedback', "Nincs általános visszajelzés.")
-            )
+    def _save_submission(self, doc_id: int, user_id: int, essay_text: str, response_text: str) -> models.EssaySubmission:
+        result_json = json.loads(response_text)
 
-            self.db.add(submission)
-            self.db.commit()
-            self.db.refresh(submission)
+        submission = models.EssaySubmission(
+            document_id=doc_id,
+            owner_id=user_id,
+            essay_content=essay_text,
+            feedback_json=result_json.get('segments', []),
+            overall_score=result_json.get('overall_score', 0),
+            general_feedback=result_json.get('general_feedback', "Nincs általános visszajelzés.")
+        )
 
-            return submission
+        self.db.add(submission)
+        self.db.commit()
+        self.db.refresh(submission)
+        submission.document
 
-        except Exception as e:
-            print(f"Grading Error: {e}")
-            return None
+        return submission
 
 
     def get_user_essays(self, user_id: int):
@@ -901,25 +1825,42 @@ class GraderService:
 class StudyPlanService:
     def __init__(self, db: Session):
         self.db = db
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
 
 
-    def generate_study_plan(self, doc_id: int, user_id: int):
-        doc = self.db.query(models.Document).filter(
-            models.Document.id == doc_id,
-            models.Document.owner_id == user_id
-        ).first()
+    def generate_study_plan(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        return single_flight.run(self.db, "study_plan", doc_id, user_id,
+                                 lambda: self._generate_study_plan(doc_id, user_id, force_fresh),
+                                 latest_study_plan, version=study_plan_version)
+
 
+    def _generate_study_plan(self, doc_id: int, user_id: int, force_fresh: bool = False):
+        doc = get_document(self.db, doc_id, user_id)
         if not doc:
             return None
 
+        prompt = self._plan_prompt(doc)
+        try:
+            config = GenerationConfig(response_mime_type='application/json')
+            source = document_source(doc)
+            response = llm.generate(prompt, task="study_plan.generate", generation_config=config, cache=True,
+                                    force_fresh=force_fresh, source=source, source_id=doc.id,
+                                    user_id=user_id)
+            return self._save_plan(doc.id, response.text)
+
+        except Exception as e:
+            print(f"Study Plan error: {e}")
+            return None
+
+
+    @staticmethod
+    def _plan_prompt(doc: models.Document) -> str:
         focus_instruction = ""
         if doc.study_focus:
             focus_instruction = f"The student ONLY wants to learn about: '{doc.study_focus}'. Ignore other topics in the text."
 
-        prompt = f"""
+        return f"""
         Act as a professional educational consultant. 
-        Create a structured Study Plan based on the text below.
+        Create a structured Study Plan based on the source material.
         
         {focus_instruction}
         
@@ -939,37 +1880,29 @@ class StudyPlanService:
             }},
             ...
         ]
-        
-        Text:
-        {doc.content[:60000]}
         """
 
-        try:
-            config = GenerationConfig(response_mime_type='application/json')
-            response = self.model.generate_content(prompt, generation_config=config)
-            plan_json = json.loads(response.text)
 
-            existing_plan = self.db.query(models.StudyPlan).filter(
-                models.StudyPlan.document_id == doc_id
-            ).first()
+    def _save_plan(self, doc_id: int, response_text: str) -> models.StudyPlan:
+        plan_json = json.loads(response_text)
 
-            if existing_plan:
-                existing_plan.plan_json = plan_json
-                self.db.commit()
-                return existing_plan
-            else:
-                new_plan = models.StudyPlan(
-                    document_id=doc_id,
-                    plan_json=plan_json,
-                )
-                self.db.add(new_plan)
-                self.db.commit()
-                self.db.refresh(new_plan)
-                return new_plan
+        existing_plan = self.db.query(models.StudyPlan).filter(
+            models.StudyPlan.document_id == doc_id
+        ).first()
 
-        except Exception as e:
-            print(f"Study Plan error: {e}")
-            return None
+        if existing_plan:
+            existing_plan.plan_json = plan_json
+            self.db.commit()
+            return existing_plan
+        else:
+            new_plan = models.StudyPlan(
+                document_id=doc_id,
+                plan_json=plan_json,
+            )
+            self.db.add(new_plan)
+            self.db.commit()
+            self.db.refresh(new_plan)
+            return new_plan
 
 
     def get_user_study_plans(self, user_id: int):
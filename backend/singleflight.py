@@ -0,0 +1,181 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from sqlalchemy import text as sql_text
+
+from cache import content_hash
+
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.getenv("SINGLE_FLIGHT_WAIT_SECONDS", "300"))
+SINGLE_FLIGHT_POLL_SECONDS = float(os.getenv("SINGLE_FLIGHT_POLL_SECONDS", "0.2"))
+
+TRY_LOCK = sql_text("SELECT pg_try_advisory_lock(:key)")
+UNLOCK = sql_text("SELECT pg_advisory_unlock(:key)")
+
+
+def flight_key(feature: str, document_id: int, user_id: int) -> int:
+    # Advisory locks take a signed 64-bit key.
+    return int.from_bytes(bytes.fromhex(content_hash(f"{feature}:{document_id}:{user_id}")[:16]), "big", signed=True)
+
+
+def _row_id(result):
+    return result.id
+
+
+class SingleFlight:
+    """Coalesces concurrent generations of the same feature for one document
+    and user, e.g. a double-clicked "generate quiz".
+
+    The first caller generates; callers that arrive meanwhile wait for it and
+    return its result instead of paying for a second model call and
+    inserting a duplicate row. Callers in one process queue on a local lock.
+    Across worker processes a session-level Postgres advisory lock, held on
+    an autocommit connection of its own, holds them back until the leader
+    has saved. The caller's session is committed before the wait, so no
+    transaction stays open while the leader awaits the model. A waiter that gets through compares `latest` with what it saw on
+    arrival: a newer result is returned as is, an unchanged one (the leader
+    failed) means it generates itself.
+
+    `latest(db, document_id, user_id)` returns the current result in the
+    shape `produce` returns, or None; `version` maps a result to a value
+    that changes with every generation.
+    """
+
+    def __init__(self, wait_seconds: float = SINGLE_FLIGHT_WAIT_SECONDS,
+                 poll_seconds: float = SINGLE_FLIGHT_POLL_SECONDS):
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._async_locks = {}
+        self._counters = {}
+
+
+    def run(self, db, feature: str, document_id: int, user_id: int, produce, latest, version=_row_id):
+        key = flight_key(feature, document_id, user_id)
+        before = self._version(latest(db, document_id, user_id), version)
+        db.commit()
+
+        with self._local_lock(key), self._advisory_lock(db.get_bind(), feature, key):
+            current = latest(db, document_id, user_id)
+            db.commit()
+            if self._version(current, version) != before:
+                self._count(feature, "coalesced")
+                return current
+
+            self._count(feature, "generated")
+            return produce()
+
+
+    async def arun(self, db, feature: str, document_id: int, user_id: int, produce, latest, version=_row_id):
+        """Coroutine version of run for an AsyncSession; produce is awaited
+        and latest runs through run_sync."""
+        key = flight_key(feature, document_id, user_id)
+        before = self._version(await db.run_sync(latest, document_id, user_id), version)
+        await db.commit()
+
+        async with self._async_local_lock(key), self._async_advisory_lock(db.bind, feature, key):
+            current = await db.run_sync(latest, document_id, user_id)
+            await db.commit()
+            if self._version(current, version) != before:
+                self._count(feature, "coalesced")
+                return current
+
+            self._count(feature, "generated")
+            return await produce()
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {feature: dict(counters) for feature, counters in self._counters.items()}
+
+
+    def _version(self, result, version):
+        return None if result is None else version(result)
+
+
+    def _count(self, feature: str, outcome: str):
+        with self._lock:
+            counters = self._counters.setdefault(feature, {"generated": 0, "coalesced": 0, "timeouts": 0})
+            counters[outcome] += 1
+
+
+    @contextmanager
+    def _advisory_lock(self, engine, feature: str, key: int):
+        # Waits up to wait_seconds, then lets the caller through unlocked.
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            deadline = time.monotonic() + self.wait_seconds
+            locked = conn.execute(TRY_LOCK, {"key": key}).scalar()
+            while not locked and time.monotonic() < deadline:
+                time.sleep(self.poll_seconds)
+                locked = conn.execute(TRY_LOCK, {"key": key}).scalar()
+            if not locked:
+                self._count(feature, "timeouts")
+            try:
+                yield
+            finally:
+                if locked:
+                    try:
+                        conn.execute(UNLOCK, {"key": key})
+                    except BaseException:
+                        # Back in the pool the connection would keep the lock; drop it instead.
+                        conn.invalidate()
+                        raise
+
+
+    @asynccontextmanager
+    async def _async_advisory_lock(self, engine, feature: str, key: int):
+        async with engine.connect() as conn:
+            await conn.execution_options(isolation_level="AUTOCOMMIT")
+            deadline = time.monotonic() + self.wait_seconds
+            locked = (await conn.execute(TRY_LOCK, {"key": key})).scalar()
+            while not locked and time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_seconds)
+                locked = (await conn.execute(TRY_LOCK, {"key": key})).scalar()
+            if not locked:
+                self._count(feature, "timeouts")
+            try:
+                yield
+            finally:
+                if locked:
+                    try:
+                        await conn.execute(UNLOCK, {"key": key})
+                    except BaseException:
+                        await conn.invalidate()
+                        raise
+
+
+    @contextmanager
+    def _local_lock(self, key: int):
+        # Entries are reference counted so the map only holds keys in flight.
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+    @asynccontextmanager
+    async def _async_local_lock(self, key: int):
+        with self._lock:
+            entry = self._async_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._async_locks[key]
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,37 @@
+import os
+
+from fastapi import HTTPException, UploadFile, status
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def upload_too_large(max_bytes: int = MAX_UPLOAD_BYTES) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File too large. Maximum size is {max_bytes // (1024 * 1024)} MB."
+    )
+
+
+async def save_upload(file: UploadFile, path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> int:
+    """Streams an upload to disk in fixed-size chunks, so at most one chunk
+    of the file is held in memory. Oversized files are rejected before the
+    first write when the size is known, otherwise as soon as the cap is
+    crossed, and the partial file is removed."""
+    if file.size is not None and file.size > max_bytes:
+        raise upload_too_large(max_bytes)
+
+    written = 0
+    try:
+        with open(path, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if written > max_bytes:
+                    raise upload_too_large(max_bytes)
+                out.write(chunk)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    return written
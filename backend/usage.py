@@ -0,0 +1,148 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+import models
+from cache import content_hash
+from database import SessionLocal
+
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+USAGE_FLUSH_EVERY = int(os.getenv("USAGE_FLUSH_EVERY", "200"))
+
+# USD per million (input, output) tokens; LLM_PRICES overrides with the same shape as JSON.
+DEFAULT_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-pro": (1.25, 10.00),
+    "models/gemini-embedding-001": (0.15, 0.0),
+}
+LLM_PRICES = {**DEFAULT_PRICES, **json.loads(os.getenv("LLM_PRICES", "{}"))}
+
+COUNTERS = ("calls", "errors", "prompt_tokens", "output_tokens", "latency_ms")
+
+
+def token_counts(response) -> tuple[int, int]:
+    meta = getattr(response, "usage_metadata", None)
+    if meta is None:
+        return 0, 0
+    return getattr(meta, "prompt_token_count", 0) or 0, getattr(meta, "candidates_token_count", 0) or 0
+
+
+def estimate_cost(model: str, prompt_tokens: int, output_tokens: int) -> float:
+    input_price, output_price = LLM_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+class UsageRecorder:
+    """Accumulates per-call usage in memory and upserts it into llm_usage,
+    one row per day, user, document, task and model. Pending counts are
+    flushed every flush_seconds or flush_every calls, and on shutdown."""
+
+    def __init__(self, session_factory=SessionLocal, flush_seconds: float = USAGE_FLUSH_SECONDS,
+                 flush_every: int = USAGE_FLUSH_EVERY):
+        self.session_factory = session_factory
+        self.flush_seconds = flush_seconds
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_calls = 0
+        self._last_flush = time.monotonic()
+
+
+    def record(self, model: str, task: str, *, document_id: int = None, user_id: int = None, calls: int = 1,
+               errors: int = 0, prompt_tokens: int = 0, output_tokens: int = 0, latency_ms: int = 0):
+        key = (datetime.date.today(), user_id, document_id, task, model)
+        with self._lock:
+            entry = self._pending.setdefault(key, dict.fromkeys(COUNTERS, 0))
+            entry["calls"] += calls
+            entry["errors"] += errors
+            entry["prompt_tokens"] += prompt_tokens
+            entry["output_tokens"] += output_tokens
+            entry["latency_ms"] += latency_ms
+            self._pending_calls += calls
+            due = (self._pending_calls >= self.flush_every
+                   or time.monotonic() - self._last_flush >= self.flush_seconds)
+        if due:
+            self.flush()
+
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_calls = 0
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+
+        try:
+            with self.session_factory() as db:
+                for (day, user_id, document_id, task, model), counts in pending.items():
+                    statement = pg_insert(models.LLMUsage).values(
+                        key=content_hash(f"{day}|{user_id}|{document_id}|{task}|{model}"),
+                        day=day, user_id=user_id, document_id=document_id, task=task, model=model, **counts
+                    )
+                    db.execute(statement.on_conflict_do_update(
+                        index_elements=["key"],
+                        set_={name: getattr(models.LLMUsage, name) + statement.excluded[name] for name in COUNTERS},
+                    ))
+                db.commit()
+        except Exception as e:
+            print(f"Usage flush error: {e}")
+
+
+    def report(self, db, user_id: int, days: int = 30) -> list[dict]:
+        since = datetime.date.today() - datetime.timedelta(days=days - 1)
+        rows = db.query(
+            models.LLMUsage.task,
+            models.LLMUsage.model,
+            *[func.sum(getattr(models.LLMUsage, name)).label(name) for name in COUNTERS],
+        ).filter(
+            models.LLMUsage.user_id == user_id,
+            models.LLMUsage.day >= since
+        ).group_by(models.LLMUsage.task, models.LLMUsage.model).all()
+
+        return [
+            {
+                "task": row.task,
+                "model": row.model,
+                **{name: int(getattr(row, name)) for name in COUNTERS},
+                "estimated_cost_usd": round(estimate_cost(row.model, int(row.prompt_tokens), int(row.output_tokens)), 6),
+            }
+            for row in rows
+        ]
+
+
+usage_recorder = UsageRecorder()
+
+
+# --- Prometheus exposition ---
+
+PROMETHEUS_METRICS = (
+    ("llm_calls_total", "counter", "Model calls that completed or failed.", "calls"),
+    ("llm_errors_total", "counter", "Model calls that failed after retries.", "errors"),
+    ("llm_retries_total", "counter", "Retried model call attempts.", "retries"),
+    ("llm_fallbacks_total", "counter", "Calls moved to the next model tier after a quota error.", "fallbacks"),
+    ("llm_prompt_tokens_total", "counter", "Prompt tokens reported by the provider.", "prompt_tokens"),
+    ("llm_output_tokens_total", "counter", "Output tokens reported by the provider.", "output_tokens"),
+    ("llm_call_duration_seconds_sum", "counter", "Total model call latency including retries.", "total_seconds"),
+    ("llm_call_duration_seconds_max", "gauge", "Slowest model call since start.", "max_seconds"),
+)
+
+
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(snapshot: list[dict]) -> str:
+    lines = []
+    for name, kind, help_text, field in PROMETHEUS_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for entry in snapshot:
+            lines.append(f'{name}{{model="{_label(entry["model"])}",task="{_label(entry["task"])}"}} {entry[field]}')
+    return "\n".join(lines) + "\n"
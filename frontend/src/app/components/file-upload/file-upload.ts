@@ -5,6 +5,7 @@ import { DragDropDirective } from '../../directives/drag-drop';
 import { MarkdownModule } from 'ngx-markdown';
 import { HttpRequestService } from '../../services/http-request.service';
 import { Router } from '@angular/router';
+import { switchMap, takeWhile, timer } from 'rxjs';
 
 @Component({
   selector: 'app-file-upload',
@@ -95,20 +96,44 @@ export class FileUploadComponent {
 
     this.httpService.uploadFileRequest(file, finalCategory, focusTopic, force)
       .subscribe({
-        next: () => {
-          this.isLoading.set(false);
-          this.uploadStatus.set('Done!');
-          this.router.navigate(['/history']);
-        },
+        next: (job) => this.pollJob(job.job_id),
         error: (error) => {
           this.isLoading.set(false);
+          this.uploadStatus.set('Error uploading file!');
+          console.error(error);
+        }
+      });
+  }
 
-          if (error.status === 409) {
-            this.handleValidationError(error.error.detail);
-          } else {
-            this.uploadStatus.set('Error uploading file!');
-            console.error(error);
+  pollJob(jobId: string) {
+    timer(0, 2000)
+      .pipe(
+        switchMap(() => this.httpService.getIngestionJobRequest(jobId)),
+        takeWhile(job => job.status !== 'completed' && job.status !== 'failed', true)
+      )
+      .subscribe({
+        next: (job) => {
+          if (job.status === 'completed') {
+            this.isLoading.set(false);
+            this.uploadStatus.set('Done!');
+            this.router.navigate(['/history']);
+          } else if (job.status === 'failed') {
+            this.isLoading.set(false);
+
+            if (job.error?.startsWith('VALIDATION_FAILED')) {
+              this.handleValidationError(job.error);
+            } else {
+              this.uploadStatus.set('Error processing file!');
+              console.error(job.error);
+            }
+          } else if (job.stage) {
+            this.uploadStatus.set(`Processing: ${job.stage} (${Math.round(job.progress * 100)}%)`);
           }
+        },
+        error: (error) => {
+          this.isLoading.set(false);
+          this.uploadStatus.set('Error uploading file!');
+          console.error(error);
         }
       });
   }
@@ -37,6 +37,8 @@ export class HistoryComponent implements AfterViewChecked {
   chatMessages = signal<{ role: string, text: string, status?: string }[]>([]);
   chatInput = signal('');
   isChatLoading = signal(false);
+  olderCursor = signal<string | null>(null);
+  isLoadingOlder = signal(false);
   showChat = signal(false);
   activeTab = signal<'summary' | 'chat' | 'tutor' | 'grader'>('summary');
   isTyping = signal(false);
@@ -46,6 +48,8 @@ export class HistoryComponent implements AfterViewChecked {
   isGeneratingCards = signal(false);
   isGeneratingMindMap = signal(false);
   isGeneratingAudio = signal(false);
+  // "<docId>:<kind>" for everything generated this session; generating it again is a regenerate.
+  generated = signal<Set<string>>(new Set());
 
   essayInputMode = signal<'type' | 'upload'>('type');
   essayText = signal('');
@@ -77,7 +81,7 @@ export class HistoryComponent implements AfterViewChecked {
     const mode = this.activeTab() === 'tutor' ? 'tutor' : 'chat';
 
     this.httpService.loadChatHistoryRequest(docId, mode).subscribe({
-      next: (msgs) => this.mapMessages(msgs)
+      next: (res) => this.mapMessages(res.body ?? [], res.headers.get('X-Next-Cursor'))
     });
   }
 
@@ -114,10 +118,11 @@ export class HistoryComponent implements AfterViewChecked {
     const docId = this.selectedDocId();
     if (!docId) return;
     this.isGeneratingQuiz.set(true);
-    this.httpService.generateQuizRequest(docId)
+    this.httpService.generateQuizRequest(docId, this.isGenerated('quiz'))
       .pipe(finalize(() => this.isGeneratingQuiz.set(false)))
       .subscribe({
         next: (res) => {
+          this.markGenerated(docId, 'quiz');
           const idToPlay = res.quiz_id || res.id;
           if (idToPlay) this.router.navigate(['/quiz-player', idToPlay]);
         },
@@ -129,10 +134,13 @@ export class HistoryComponent implements AfterViewChecked {
     const docId = this.selectedDocId();
     if (!docId) return;
     this.isGeneratingCards.set(true);
-    this.httpService.generateFlashcardRequest(docId)
+    this.httpService.generateFlashcardRequest(docId, this.isGenerated('flashcards'))
       .pipe(finalize(() => this.isGeneratingCards.set(false)))
       .subscribe({
-        next: (res) => this.router.navigate(['/flashcard-player', res.set_id]),
+        next: (res) => {
+          this.markGenerated(docId, 'flashcards');
+          this.router.navigate(['/flashcard-player', res.set_id]);
+        },
         error: (error) => console.error('Failed to start flashcards: ', error)
       });
   }
@@ -141,14 +149,25 @@ export class HistoryComponent implements AfterViewChecked {
     const docId = this.selectedDocId();
     if (!docId) return;
     this.isGeneratingMindMap.set(true);
-    this.httpService.generateMindMapRequest(docId)
+    this.httpService.generateMindMapRequest(docId, this.isGenerated('mindmap'))
       .pipe(finalize(() => this.isGeneratingMindMap.set(false)))
       .subscribe({
-        next: (res) => this.router.navigate(['/mindmap-player', res.id]),
+        next: (res) => {
+          this.markGenerated(docId, 'mindmap');
+          this.router.navigate(['/mindmap-player', res.id]);
+        },
         error: (error) => alert('Could not generate mind map.')
       });
   }
 
+  isGenerated(kind: string) {
+    return this.generated().has(`${this.selectedDocId()}:${kind}`);
+  }
+
+  private markGenerated(docId: number, kind: string) {
+    this.generated.update(keys => new Set(keys).add(`${docId}:${kind}`));
+  }
+
   generateAudio() {
     const docId = this.selectedDocId();
     if (!docId) return;
@@ -210,29 +229,50 @@ export class HistoryComponent implements AfterViewChecked {
     const mode = tab === 'tutor' ? 'tutor' : 'chat';
     this.httpService.loadChatHistoryRequest(docId!, mode)
       .pipe(finalize(() => this.isChatLoading.set(false)))
-      .subscribe(msgs => {
-        this.mapMessages(msgs);
+      .subscribe(res => {
+        const msgs = res.body ?? [];
+        this.mapMessages(msgs, res.headers.get('X-Next-Cursor'));
         if (tab === 'tutor' && msgs.length === 0) {
           this.startTutor();
         }
       });
   }
 
-  mapMessages(msgs: any[]) {
-    let finishedFound = false;
-    const formatted = msgs.map(m => {
+  mapMessages(msgs: any[], olderCursor: string | null = null) {
+    this.chatMessages.set(this.formatMessages(msgs));
+    this.olderCursor.set(olderCursor);
+    if (this.activeTab() === 'tutor') {
+      this.sessionFinished.set(msgs.some(m => this.parseMessage(m.content).is_finish));
+    }
+  }
+
+  loadOlderMessages() {
+    const docId = this.selectedDocId();
+    const cursor = this.olderCursor();
+    if (!docId || !cursor) return;
+    const mode = this.activeTab() === 'tutor' ? 'tutor' : 'chat';
+
+    this.isLoadingOlder.set(true);
+    this.httpService.loadChatHistoryRequest(docId, mode, cursor)
+      .pipe(finalize(() => this.isLoadingOlder.set(false)))
+      .subscribe({
+        next: (res) => {
+          this.chatMessages.update(list => [...this.formatMessages(res.body ?? []), ...list]);
+          this.olderCursor.set(res.headers.get('X-Next-Cursor'));
+        },
+        error: (error) => console.error('Failed to load older messages: ', error)
+      });
+  }
+
+  private formatMessages(msgs: any[]) {
+    return msgs.map(m => {
       const parsed = this.parseMessage(m.content);
-      if (parsed.is_finish) finishedFound = true;
       return {
         role: (m.role === 'user' || m.role === 'tutor_user') ? 'user' : 'ai',
         text: parsed.text,
         status: parsed.status || 'neutral',
       };
     });
-    this.chatMessages.set(formatted);
-    if (this.activeTab() === 'tutor') {
-      this.sessionFinished.set(finishedFound);
-    }
   }
 
   startTutor() {
@@ -48,6 +48,10 @@ export class HttpRequestService {
     return this.http.post<any>(`${this.baseUrl}/upload`, formData, { headers: this.getHeaders() });
   }
 
+  getIngestionJobRequest(jobId: string) {
+    return this.http.get<any>(`${this.baseUrl}/jobs/${jobId}`, { headers: this.getHeaders() });
+  }
+
   loadHistoryRequest() {
     return this.http.get<any>(`${this.baseUrl}/documents`, { headers: this.getHeaders() });
   }
@@ -58,8 +62,9 @@ export class HttpRequestService {
 
   // quiz services
 
-  generateQuizRequest(docId: number){
-    return this.http.post<any>(`${this.baseUrl}/documents/${docId}/quizzes`, {}, { headers: this.getHeaders() });
+  // fresh skips the server's response cache, for an explicit regenerate.
+  generateQuizRequest(docId: number, fresh = false){
+    return this.http.post<any>(`${this.baseUrl}/documents/${docId}/quizzes`, {}, { headers: this.getHeaders(), params: { fresh } });
   }
 
   loadQuizzesRequest(){
@@ -76,8 +81,8 @@ export class HttpRequestService {
 
   // flashcard services
 
-  generateFlashcardRequest(docId: number) {
-    return this.http.post<any>(`${this.baseUrl}/documents/${docId}/flashcards`, {}, { headers: this.getHeaders() });
+  generateFlashcardRequest(docId: number, fresh = false) {
+    return this.http.post<any>(`${this.baseUrl}/documents/${docId}/flashcards`, {}, { headers: this.getHeaders(), params: { fresh } });
   }
 
   loadFlashcardsRequest() {
@@ -90,8 +95,8 @@ export class HttpRequestService {
 
   // mindmap services
 
-  generateMindMapRequest(docId: number) {
-    return this.http.post<any>(`${this.baseUrl}/documents/${docId}/mindmaps`, {}, { headers: this.getHeaders() });
+  generateMindMapRequest(docId: number, fresh = false) {
+    return this.http.post<any>(`${this.baseUrl}/documents/${docId}/mindmaps`, {}, { headers: this.getHeaders(), params: { fresh } });
   }
 
   loadMindMapsRequest() {
@@ -108,8 +113,10 @@ export class HttpRequestService {
     return this.http.post<any>(`${this.baseUrl}/documents/${docId}/chat`, { question }, { headers: this.getHeaders() });
   }
 
-  loadChatHistoryRequest(docId: number, mode: 'chat' | 'tutor' = 'chat') {
-    return this.http.get<any[]>(`${this.baseUrl}/documents/${docId}/chat?mode=${mode}`, { headers: this.getHeaders() });
+  // The newest page of messages; its X-Next-Cursor header, when set, is the `before` for the next older page.
+  loadChatHistoryRequest(docId: number, mode: 'chat' | 'tutor' = 'chat', before?: string) {
+    const params: Record<string, string> = before ? { mode, before } : { mode };
+    return this.http.get<any[]>(`${this.baseUrl}/documents/${docId}/chat`, { headers: this.getHeaders(), params, observe: 'response' });
   }
 
   startTutorSessionRequest(docId: number) {